@@ -13,23 +13,17 @@
 ###############################################################################################
 
 from __future__ import division
-import signal
-import socket
 import time
-import string
+IMPORT_START = time.time()
+import errno
+import signal
 import sys
 import getopt
 import math
-import threading
-from array import *
-import smbus
-import select
 import os
 import struct
 import logging
-
-import RPi.GPIO as RPIO
-from RPIO import PWM
+import collections
 
 import subprocess
 from datetime import datetime
@@ -38,17 +32,123 @@ import ctypes
 from ctypes.util import find_library
 import random
 
+import qcrecorder
+
+############################################################################################
+#
+# Hardware backend: the real Raspberry Pi smbus / RPIO libraries, or the qcsim register-level
+# simulator of the MPU6050, GPIO and PWM so the flight code can run on any Linux box.
+#
+############################################################################################
+smbus = None
+RPIO = None
+PWM = None
+hardware = None
+gpiochip = None
+
+def SetBackend(backend, replay_file=None, i2c='smbus', gpio='rpio'):
+	global smbus
+	global RPIO
+	global PWM
+	global hardware
+	global gpiochip
+	global time
+
+	if backend == 'sim':
+		import qcsim
+		hardware = qcsim.SimBackend()
+		smbus = hardware
+		RPIO = hardware.gpio
+		PWM = hardware.pwm
+
+	elif backend == 'replay':
+		#-----------------------------------------------------------------------------------
+		# Replay runs on the simulator's virtual clock, so sleeps cost nothing and time_now
+		# comes from the capture.
+		#-----------------------------------------------------------------------------------
+		import qcsim
+		hardware = qcsim.ReplayBackend(replay_file, replay_file + ".pulses.csv")
+		smbus = hardware
+		RPIO = hardware.gpio
+		PWM = hardware.pwm
+		time = hardware.clock
+
+	else:
+		import smbus
+		import RPi.GPIO as RPIO
+		from RPIO import PWM
+
+	#---------------------------------------------------------------------------------------
+	# Optionally replace python-smbus with single ioctl I2C transfers on /dev/i2c-1, served
+	# by a loopback from the simulated devices when there's no real bus
+	#---------------------------------------------------------------------------------------
+	if i2c == 'rdwr':
+		import qci2c
+		if backend == 'pi':
+			smbus = qci2c
+		else:
+			smbus = qci2c.Loopback(hardware.bus.devices)
+
+	#---------------------------------------------------------------------------------------
+	# Optionally take the data ready edges, kernel timestamped, from the GPIO character
+	# device rather than RPIO, fed from the simulated MPU6050 when there's no real chip
+	#---------------------------------------------------------------------------------------
+	if gpio == 'chardev':
+		if backend == 'pi':
+			import qcgpio
+			gpiochip = qcgpio
+		else:
+			gpiochip = hardware
+
+############################################################################################
+#
+# The typed failure the I2C layer raises once a call has used up its retry budget.  It's an
+# IOError with the errno of the last attempt, so anything already catching those still does.
+#
+############################################################################################
+class I2CError(IOError):
+
+	def __init__(self, errno_value, strerror, address, reg, attempts):
+		IOError.__init__(self, errno_value, strerror)
+		self.address = address
+		self.reg = reg
+		self.attempts = attempts
+
 ############################################################################################
 #
-#  Adafruit i2c interface enhanced with performance / error handling enhancements
+#  Adafruit i2c interface enhanced with performance / error handling enhancements.  Each call
+#  retries a failed transfer at most RETRIES times, and never past DEADLINE seconds after the
+#  first failure, then raises I2CError; failures are counted per errno rather than logged.
 #
 ############################################################################################
 class I2C:
 
-	def __init__(self, address, bus=smbus.SMBus(1)):
+	RETRIES = 3
+	DEADLINE = 0.002
+	SMBUS_BLOCK_SIZE = 32
+	__RETRY_BACKOFF = 0.0001
+
+	def __init__(self, address, bus=None):
+		if bus is None:
+			bus = smbus.SMBus(1)
 		self.address = address
 		self.bus = bus
 		self.misses = 0
+		self.errors = {}
+
+		#---------------------------------------------------------------------------
+		# A bus that can read straight into a buffer, with no list in between, may
+		# also take bigger blocks than SMBus
+		#---------------------------------------------------------------------------
+		self.readinto = getattr(bus, 'readinto', None)
+		self.block_size = getattr(bus, 'block_size', self.SMBUS_BLOCK_SIZE)
+		self.retry_deadline = 0.0
+
+		#---------------------------------------------------------------------------
+		# Debug logging is decided once here rather than formatted and thrown away on
+		# every transfer
+		#---------------------------------------------------------------------------
+		self.debug = logger.isEnabledFor(logging.DEBUG)
 
 	def reverseByteOrder(self, data):
 		"Reverses the byte order of an int (16-bit) or long (32-bit) value"
@@ -62,107 +162,126 @@ class I2C:
 			data >>= 8
 		return val
 
+	def retry(self, err, reg, attempts):
+		"Counts a failed transfer, then backs off for another attempt or raises I2CError"
+		error = err.errno if err.errno is not None else errno.EIO
+		self.misses += 1
+		self.errors[error] = self.errors.get(error, 0) + 1
+
+		now = time.time()
+		if attempts == 0:
+			self.retry_deadline = now + self.DEADLINE
+		attempts += 1
+		if attempts > self.RETRIES or now >= self.retry_deadline:
+			raise I2CError(error, "device 0x%02X register 0x%02X failed %d times, last: %s" % (self.address, reg, attempts, err.strerror), self.address, reg, attempts)
+
+		time.sleep(self.__RETRY_BACKOFF)
+		return attempts
+
 	def write8(self, reg, value):
 		"Writes an 8-bit value to the specified register/address"
+		attempts = 0
 		while True:
 			try:
 				self.bus.write_byte_data(self.address, reg, value)
-				logger.debug('I2C: Wrote 0x%02X to register 0x%02X', value, reg)
 				break
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+			except IOError as err:
+				attempts = self.retry(err, reg, attempts)
+		if self.debug:
+			logger.debug('I2C: Wrote 0x%02X to register 0x%02X', value, reg)
 
 	def writeList(self, reg, list):
 		"Writes an array of bytes using I2C format"
+		attempts = 0
 		while True:
 			try:
 				self.bus.write_i2c_block_data(self.address, reg, list)
 				break
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+			except IOError as err:
+				attempts = self.retry(err, reg, attempts)
 
 	def readU8(self, reg):
 		"Read an unsigned byte from the I2C device"
+		attempts = 0
 		while True:
 			try:
 				result = self.bus.read_byte_data(self.address, reg)
-				logger.debug('I2C: Device 0x%02X returned 0x%02X from reg 0x%02X', self.address, result & 0xFF, reg)
-				return result
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+				break
+			except IOError as err:
+				attempts = self.retry(err, reg, attempts)
+		if self.debug:
+			logger.debug('I2C: Device 0x%02X returned 0x%02X from reg 0x%02X', self.address, result & 0xFF, reg)
+		return result
 
 	def readS8(self, reg):
 		"Reads a signed byte from the I2C device"
-		while True:
-			try:
-				result = self.bus.read_byte_data(self.address, reg)
-				logger.debug('I2C: Device 0x%02X returned 0x%02X from reg 0x%02X', self.address, result & 0xFF, reg)
-				if (result > 127):
-					return result - 256
-				else:
-					return result
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+		result = self.readU8(reg)
+		if (result > 127):
+			return result - 256
+		else:
+			return result
 
 	def readU16(self, reg):
 		"Reads an unsigned 16-bit value from the I2C device"
+		#---------------------------------------------------------------------------
+		# A max value read is treated as a failed transfer, counted under ERANGE
+		#---------------------------------------------------------------------------
+		attempts = 0
 		while True:
 			try:
 				hibyte = self.bus.read_byte_data(self.address, reg)
 				result = (hibyte << 8) + self.bus.read_byte_data(self.address, reg+1)
-				logger.debug('I2C: Device 0x%02X returned 0x%04X from reg 0x%02X', self.address, result & 0xFFFF, reg)
 				if result == 0x7FFF or result == 0x8000:
-					logger.critical('I2C read max value')
-					time.sleep(0.0005)
-				else:
-					return result
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+					raise IOError(errno.ERANGE, "I2C read max value")
+				break
+			except IOError as err:
+				attempts = self.retry(err, reg, attempts)
+		if self.debug:
+			logger.debug('I2C: Device 0x%02X returned 0x%04X from reg 0x%02X', self.address, result & 0xFFFF, reg)
+		return result
 
 	def readS16(self, reg):
 		"Reads a signed 16-bit value from the I2C device"
-		while True:
-			try:
-				hibyte = self.bus.read_byte_data(self.address, reg)
-				if (hibyte > 127):
-					hibyte -= 256
-				result = (hibyte << 8) + self.bus.read_byte_data(self.address, reg+1)
-				logger.debug('I2C: Device 0x%02X returned 0x%04X from reg 0x%02X', self.address, result & 0xFFFF, reg)
-				if result == 0x7FFF or result == 0x8000:
-					logger.critical('I2C read max value')
-					time.sleep(0.0005)
-				else:
-					return result
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+		result = self.readU16(reg)
+		if (result > 32767):
+			return result - 65536
+		else:
+			return result
 				
 	def readList(self, reg, length):
 		"Reads a a byte array value from the I2C device"
+		attempts = 0
 		while True:
 			try:
 				result = self.bus.read_i2c_block_data(self.address, reg, length)
-				logger.debug('I2C: Device 0x%02X from reg 0x%02X', self.address, reg)
-				return result
-			except IOError, err:
-				self.misses += 1
-				logger.exception('Error %d, %s accessing 0x%02X: Check your I2C address', err.errno, err.strerror, self.address)
-				time.sleep(0.0001)
+				break
+			except IOError as err:
+				attempts = self.retry(err, reg, attempts)
+		if self.debug:
+			logger.debug('I2C: Device 0x%02X from reg 0x%02X', self.address, reg)
+		return result
+
+	def readListInto(self, reg, buffer, offset, length):
+		"Reads a byte array from the I2C device into a preallocated bytearray"
+		attempts = 0
+		while True:
+			try:
+				if self.readinto is not None:
+					self.readinto(self.address, reg, buffer, offset, length)
+				else:
+					buffer[offset:offset + length] = self.bus.read_i2c_block_data(self.address, reg, length)
+				break
+			except IOError as err:
+				attempts = self.retry(err, reg, attempts)
+		if self.debug:
+			logger.debug('I2C: Device 0x%02X from reg 0x%02X', self.address, reg)
 
 	def getMisses(self):
 		return self.misses
 
+	def getErrors(self):
+		return self.errors
+
 
 ############################################################################################
 #
@@ -286,149 +405,401 @@ class MPU6050 :
 
 	__CALIBRATION_ITERATIONS = 100
 
-	def __init__(self, address=0x68, dlpf=6):
+	#-------------------------------------------------------------------------------
+	# Bring-up polls the chip every millisecond for up to a second at each stage,
+	# and each configuration write gets three tries.
+	#-------------------------------------------------------------------------------
+	__BRING_UP_TIMEOUT = 1.0
+	__BRING_UP_POLL = 0.001
+	__CONFIGURE_ATTEMPTS = 3
+
+	#-------------------------------------------------------------------------------
+	# A sample whose read fails is skipped and counted as a miss, but after this many
+	# in a row the I2CError is passed on: the sensor has gone.
+	#-------------------------------------------------------------------------------
+	__FAILED_SAMPLES_LIMIT = 10
+
+	#-------------------------------------------------------------------------------
+	# The raw temperatures whose compensation values are kept; it only drifts a few
+	# counts a minute, so this covers a flight many times over.
+	#-------------------------------------------------------------------------------
+	__COMPENSATION_CACHE_SIZE = 256
+
+	#-------------------------------------------------------------------------------
+	# Accelerometer offset and gain trend lines against raw temperature, unless
+	# fitted ones are loaded from a coefficients file
+	#-------------------------------------------------------------------------------
+	ax_offset_m = -0.008672274
+	ax_offset_c = -95.85877449
+	ay_offset_m =  0.001811116
+	ay_offset_c =  152.3654568
+	az_offset_m =  0.086221252
+	az_offset_c =  1245.398862
+
+	ax_gain_m = -0.000000104005
+	ax_gain_c =  0.994343914
+	ay_gain_m = -0.000000134932
+	ay_gain_c =  0.991553647
+	az_gain_m = -0.000000177587
+	az_gain_c =  0.999063422
+
+	#-------------------------------------------------------------------------------
+	# FIFO frame layout is accel X/Y/Z, temp, gyro X/Y/Z - the same 14 bytes as the
+	# ACCEL_XOUT_H onwards data registers.  The FIFO is drained in blocks of whole
+	# frames, as many as the bus takes in one read: 2 for SMBus's 32 bytes, all of
+	# them for the I2C_RDWR bus.
+	#-------------------------------------------------------------------------------
+	__FIFO_FRAME_SIZE = 14
+	__FIFO_SIZE = 1024
+
+	#-------------------------------------------------------------------------------
+	# Precompiled decoders for the 7 big-endian shorts of a sensor frame and the
+	# FIFO byte count.
+	#-------------------------------------------------------------------------------
+	__SENSOR_STRUCT = struct.Struct('>7h')
+	__FIFO_COUNT_STRUCT = struct.Struct('>H')
+
+	def __init__(self, address=0x68, dlpf=6, fifo=False, coefficients=None):
 		self.i2c = I2C(address)
 		self.address = address
-		self.sensor_data = array('B', [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
-		self.result_array = array('h', [0, 0, 0, 0, 0, 0, 0])
+
+		#---------------------------------------------------------------------------
+		# Fitted coefficients become plain attributes, so readSensors() is unchanged
+		#---------------------------------------------------------------------------
+		if coefficients is not None:
+			for name in COEFFICIENT_NAMES:
+				m, c = coefficients[name]
+				setattr(self, name + '_m', m)
+				setattr(self, name + '_c', c)
+
+		#---------------------------------------------------------------------------
+		# Offsets and gains for the last raw temperature seen, and a bounded cache
+		# of those for other recent temperatures
+		#---------------------------------------------------------------------------
+		self.compensation_temp = None
+		self.compensation = None
+		self.compensation_cache = {}
+		self.compensation_repeats = 0
+		self.compensation_hits = 0
+		self.compensation_misses = 0
 		self.misses = 0
+		self.failed_samples = 0
+		self.capture = None
+		self.acquisition = None
+		self.tracer = None
+		self.data_ready = None
+
+		#---------------------------------------------------------------------------
+		# Buffers reused for every read so the sampling loop doesn't allocate them
+		#---------------------------------------------------------------------------
+		self.sensor_data = bytearray(self.__FIFO_FRAME_SIZE)
+		self.fifo_count_data = bytearray(2)
+		self.fifo_data = bytearray(self.__FIFO_SIZE)
+		self.fifo_block_size = self.i2c.block_size // self.__FIFO_FRAME_SIZE * self.__FIFO_FRAME_SIZE
+
+		self.fifo = fifo
+		self.fifo_overflows = 0
+		self.fifo_frames = 0
+		self.fifo_index = 0
+		self.fifo_time = 0.0
 
 		self.gx_offset = 0.0
 		self.gy_offset = 0.0
 		self.gz_offset = 0.0
 
-		self.ax_offset_m = -0.008672274
-		self.ax_offset_c = -95.85877449
-		self.ay_offset_m =  0.001811116
-		self.ay_offset_c =  152.3654568
-		self.az_offset_m =  0.086221252
-		self.az_offset_c =  1245.398862
-
-		self.ax_gain_m = -0.000000104005
-		self.ax_gain_c =  0.994343914
-		self.ay_gain_m = -0.000000134932
-		self.ay_gain_c =  0.991553647
-		self.az_gain_m = -0.000000177587
-		self.az_gain_c =  0.999063422
-
 		logger.info('Reseting MPU-6050')
+		bring_up_start = time.time()
+
 		#---------------------------------------------------------------------------
-		# Ensure chip has completed boot
+		# Ensure chip has completed boot: it answers WHO_AM_I with its address
 		#---------------------------------------------------------------------------
-		time.sleep(0.5)
+		if not self.pollRegister(self.__MPU6050_RA_WHO_AM_I, 0x7E, 0x68):
+			logger.critical('MPU-6050 did not answer WHO_AM_I within %.1fs', self.__BRING_UP_TIMEOUT)
+			CleanShutdown()
+		boot_done = time.time()
 
 		#---------------------------------------------------------------------------
-		# Reset all registers
+		# Reset all registers, and wait for the chip to clear the reset bit again
 		#---------------------------------------------------------------------------
 		logger.debug('Reset all registers')
 		self.i2c.write8(self.__MPU6050_RA_PWR_MGMT_1, 0x80)
-		time.sleep(5.0)
-	
+		if not self.pollRegister(self.__MPU6050_RA_PWR_MGMT_1, 0x80, 0x00) or not self.pollRegister(self.__MPU6050_RA_WHO_AM_I, 0x7E, 0x68):
+			logger.critical('MPU-6050 did not come out of reset within %.1fs', self.__BRING_UP_TIMEOUT)
+			CleanShutdown()
+		reset_done = time.time()
+
 		#---------------------------------------------------------------------------
-		# Sets sample rate to 1kHz/1+0 = 1kHz or 1ms
+		# The configuration, written in as few transfers as the register map allows
+		# and each checked by reading it back.
+		#
+		# SMPLRT_DIV, CONFIG, GYRO_CONFIG and ACCEL_CONFIG are consecutive:
+		# - Sets sample rate to 1kHz/1+0 = 1kHz or 1ms
+		# - Disable FSync, Use of DLPF => 1kHz sample frequency used above divided by the
+		#   sample divide factor.
+		#   0x01 = 180Hz
+		#   0x02 =  100Hz
+		#   0x03 =  45Hz
+		#   0x04 =  20Hz
+		#   0x05 =  10Hz
+		#   0x06 =   5Hz
+		# - Disable gyro self tests, scale of
+		#   0x00 =  +/- 250 degrees/s
+		#   0x08 =  +/- 500 degrees/s
+		#   0x10 = +/- 1000 degrees/s
+		#   0x18 = +/- 2000 degrees/s
+		#   See SCALE_GYRO for converstion from raw data to units of radians per second
+		#   int(math.log(degrees / 250, 2)) << 3
+		# - Disable accel self tests, scale of +/-2g
+		#   0x00 =  +/- 2g
+		#   0x08 =  +/- 4g
+		#   0x10 =  +/- 8g
+		#   0x18 = +/- 16g
+		#   See SCALE_ACCEL for convertion from raw data to units of meters per second squared
+		#   int(math.log(g / 2, 2)) << 3
+		#
+		# INT_PIN_CFG and INT_ENABLE are consecutive:
+		# - Setup INT pin to latch and AUX I2C pass through; 0x10 for edge detection, 0x20
+		#   for polling
+		# - Enable data ready interrupt
+		#
+		# PWR_MGMT_1 sets the clock source to gyro reference w/ PLL, which also wakes the
+		# chip, so it's last.
+		#
+		# The sample period follows from what's written: the gyro output rate is 8kHz
+		# with the DLPF disabled (0 or 7), 1kHz otherwise, divided by 1 + SMPLRT_DIV.
+		# Older FIFO frames are stamped back from the newest by it.
 		#---------------------------------------------------------------------------
-		logger.debug('Sample rate 1kHz')
-		self.i2c.write8(self.__MPU6050_RA_SMPLRT_DIV, 0x0)
-		time.sleep(0.1)
-	
+		smplrt_div = 0x00
+		self.sample_period = (1 + smplrt_div) / (8000 if dlpf in (0, 7) else 1000)
+		logger.debug('Sample rate %dHz, DLPF %d, gyro +/-250 degrees/s, accel +/- 2g', round(1 / self.sample_period), dlpf)
+		self.configure(self.__MPU6050_RA_SMPLRT_DIV, [smplrt_div, dlpf, 0x00, 0x00])
+
+		logger.debug('Enable data ready interrupt')
+		self.configure(self.__MPU6050_RA_INT_PIN_CFG, [0x10, 0x01])
+
 		#---------------------------------------------------------------------------
-		# Sets clock source to gyro reference w/ PLL
+		# Optionally let the chip buffer accel, temp and gyro frames in its FIFO so
+		# samples are drained in bulk rather than lost when Python stalls.
 		#---------------------------------------------------------------------------
+		if self.fifo:
+			logger.debug('Enable FIFO for accel, temp and gyro')
+			self.configure(self.__MPU6050_RA_FIFO_EN, [0xF8])
+
 		logger.debug('Clock gyro PLL')
-		self.i2c.write8(self.__MPU6050_RA_PWR_MGMT_1, 0x02)
-		time.sleep(0.1)
+		self.configure(self.__MPU6050_RA_PWR_MGMT_1, [0x02])
 
+		if self.fifo:
+			self.resetFIFO()
+		configure_done = time.time()
+
+		logger.critical('MPU-6050 ready in %.3fs: boot %.3fs, reset %.3fs, configure %.3fs', configure_done - bring_up_start, boot_done - bring_up_start, reset_done - boot_done, configure_done - reset_done)
+
+
+	def pollRegister(self, reg, mask, value):
 		#---------------------------------------------------------------------------
-		# Disable FSync, Use of DLPF => 1kHz sample frequency used above divided by the
-		# sample divide factor.
-		# 0x01 = 180Hz
-		# 0x02 =  100Hz
-		# 0x03 =  45Hz
-		# 0x04 =  20Hz
-		# 0x05 =  10Hz
-		# 0x06 =   5Hz
+		# Poll until (register & mask) == value.  While the chip is booting or
+		# resetting it may not acknowledge at all, so errors just mean not yet.
 		#---------------------------------------------------------------------------
-		logger.debug('configurable DLPF to filter out non-gravitational acceleration for Euler')
-		self.i2c.write8(self.__MPU6050_RA_CONFIG, dlpf)
-		time.sleep(0.1)
-	
+		deadline = time.time() + self.__BRING_UP_TIMEOUT
+		while True:
+			try:
+				if self.i2c.bus.read_byte_data(self.address, reg) & mask == value:
+					return True
+			except IOError:
+				pass
+
+			if time.time() >= deadline:
+				return False
+			time.sleep(self.__BRING_UP_POLL)
+
+
+	def configure(self, reg, values):
 		#---------------------------------------------------------------------------
-		# Disable gyro self tests, scale of
-		# 0x00 =  +/- 250 degrees/s
-		# 0x08 =  +/- 500 degrees/s
-		# 0x10 = +/- 1000 degrees/s
-		# 0x18 = +/- 2000 degrees/s
-		# See SCALE_GYRO for converstion from raw data to units of radians per second
+		# Write a run of consecutive registers in one transfer, then read them back,
+		# retrying a few times before giving up on the chip.
 		#---------------------------------------------------------------------------
-		# int(math.log(degrees / 250, 2)) << 3
-		logger.debug('Gyro +/-250 degrees/s')
-		self.i2c.write8(self.__MPU6050_RA_GYRO_CONFIG, 0x00)
-		time.sleep(0.1)
-	
+		for attempt in range(0, self.__CONFIGURE_ATTEMPTS):
+			try:
+				if len(values) == 1:
+					self.i2c.write8(reg, values[0])
+					readback = [self.i2c.readU8(reg)]
+				else:
+					self.i2c.writeList(reg, values)
+					readback = self.i2c.readList(reg, len(values))
+			except I2CError as err:
+				logger.warning('Register 0x%02X configuration: %s', reg, err)
+				continue
+			if list(readback) == list(values):
+				return
+			logger.warning('Register 0x%02X read back %s, not %s', reg, readback, values)
+
+		logger.critical('MPU-6050 register 0x%02X configuration failed', reg)
+		CleanShutdown()
+
+
+	def resetFIFO(self):
 		#---------------------------------------------------------------------------
-		# Disable accel self tests, scale of +/-2g
-		# 0x00 =  +/- 2g
-		# 0x08 =  +/- 4g
-		# 0x10 =  +/- 8g
-		# 0x18 = +/- 16g
-		# See SCALE_ACCEL for convertion from raw data to units of meters per second squared
+		# Flush the FIFO contents and then (re)start buffering frames
 		#---------------------------------------------------------------------------
-		# int(math.log(g / 2, 2)) << 3
+		self.i2c.write8(self.__MPU6050_RA_USER_CTRL, 0x04)
+		self.i2c.write8(self.__MPU6050_RA_USER_CTRL, 0x40)
+		self.fifo_frames = 0
+		self.fifo_index = 0
+
+
+	def readFIFOCount(self):
+		self.i2c.readListInto(self.__MPU6050_RA_FIFO_COUNTH, self.fifo_count_data, 0, 2)
+		return self.__FIFO_COUNT_STRUCT.unpack_from(self.fifo_count_data)[0]
 
-		logger.debug('Accel +/- 2g')
-		self.i2c.write8(self.__MPU6050_RA_ACCEL_CONFIG, 0x00)
-		time.sleep(0.1)
 
+	def readFIFORaw(self):
 		#---------------------------------------------------------------------------
-		# Setup INT pin to latch and AUX I2C pass through
+		# Wait for the data ready interrupt, then drain every complete frame buffered
+		# since the last wakeup into fifo_data.  Returns the number of frames in the
+		# batch, 0 if the FIFO overflowed and had to be reset.
 		#---------------------------------------------------------------------------
-		logger.debug('Enable interrupt')
-		self.i2c.write8(self.__MPU6050_RA_INT_PIN_CFG, 0x10) # 0x10 for edge detection, 0x20 for polling
-		time.sleep(0.1)
-	
+		if self.data_ready is None:
+			RPIO.edge_detect_wait(RPIO_DATA_READY_INTERRUPT)
+		else:
+			edge_time = self.data_ready.wait()
+		if self.tracer is not None:
+			self.tracer.probe(TRACE_EDGE)
+
+		try:
+			fifo_count = self.readFIFOCount()
+
+			#-----------------------------------------------------------------------
+			# Once full, the FIFO overwrites the oldest data and frame alignment is
+			# lost, so the only safe recovery is to count it and start again.
+			#-----------------------------------------------------------------------
+			if fifo_count >= self.__FIFO_SIZE:
+				self.fifo_overflows += 1
+				self.resetFIFO()
+				return 0
+
+			num_frames = fifo_count // self.__FIFO_FRAME_SIZE
+			bytes_total = num_frames * self.__FIFO_FRAME_SIZE
+			bytes_read = 0
+			while bytes_read < bytes_total:
+				block_size = min(bytes_total - bytes_read, self.fifo_block_size)
+				self.i2c.readListInto(self.__MPU6050_RA_FIFO_R_W, self.fifo_data, bytes_read, block_size)
+				bytes_read += block_size
+
 		#---------------------------------------------------------------------------
-		# Enable data ready interrupt
+		# A failed drain may have left a partial frame behind, so as for an overflow
+		# the FIFO is started again
 		#---------------------------------------------------------------------------
-		logger.debug('Interrupt data ready')
-		self.i2c.write8(self.__MPU6050_RA_INT_ENABLE, 0x01)
-		time.sleep(0.1)
+		except I2CError:
+			if self.sampleFailed():
+				raise
+			self.resetFIFO()
+			return 0
+
+		self.failed_samples = 0
+		if self.tracer is not None:
+			self.tracer.probe(TRACE_I2C)
 
 		#---------------------------------------------------------------------------
-		# Check DLPF programming has worked.
+		# The newest frame is stamped now, or with its data ready edge's kernel time
+		# stamp, older frames one sample period earlier each.
 		#---------------------------------------------------------------------------
-		check_dlpf = self.i2c.readU8(self.__MPU6050_RA_CONFIG)
-		if check_dlpf != dlpf:
-			logger.critical("dlpf_check = %d, dlpf_config = %d", dlpf_check, dlpf_config);
-			CleanShutdown()
+		if self.data_ready is None:
+			self.fifo_time = time.time()
+		else:
+			self.fifo_time = edge_time
+
+		return num_frames
 
 
 	def readSensorsRaw(self):
 		global time_now
 
-                #---------------------------------------------------------------------------
-                # Wait for the data ready interrupt
-                #---------------------------------------------------------------------------
-		RPIO.edge_detect_wait(RPIO_DATA_READY_INTERRUPT)
+		#---------------------------------------------------------------------------
+		# With an acquisition process, it has already waited for, read and time
+		# stamped the sample; just take the next one from the ring.
+		#---------------------------------------------------------------------------
+		if self.acquisition is not None:
+			time_now, sensors = self.acquisition.read()
+			if self.tracer is not None:
+				self.tracer.probe(TRACE_DECODE)
+			if self.capture is not None:
+				self.capture.record(time_now, *sensors)
+			return sensors
 
 		#---------------------------------------------------------------------------
-		# For speed of reading, read all the sensors and parse to SHORTs after.  This
-		# also ensures a self consistent set of sensor data compared to reading each
-		# individually where the sensor data registers could be updated between reads.
+		# In FIFO mode, hand out the batch from the last wakeup one frame at a time,
+		# only going back to the chip once it's used up.
 		#---------------------------------------------------------------------------
-		sensor_data = self.i2c.readList(self.__MPU6050_RA_ACCEL_XOUT_H, 14)
+		if self.fifo:
+			while self.fifo_index == self.fifo_frames:
+				self.fifo_frames = self.readFIFORaw()
+				self.fifo_index = 0
+
+			time_now = self.fifo_time - (self.fifo_frames - 1 - self.fifo_index) * self.sample_period
+			sensors = self.__SENSOR_STRUCT.unpack_from(self.fifo_data, self.fifo_index * self.__FIFO_FRAME_SIZE)
+			self.fifo_index += 1
+			if self.tracer is not None:
+				self.tracer.probe(TRACE_DECODE)
+			if self.capture is not None:
+				self.capture.record(time_now, *sensors)
+			return sensors
+
+		while True:
+			#-----------------------------------------------------------------------
+			# Wait for the data ready interrupt
+			#-----------------------------------------------------------------------
+			if self.data_ready is None:
+				RPIO.edge_detect_wait(RPIO_DATA_READY_INTERRUPT)
+			else:
+				edge_time = self.data_ready.wait()
+			if self.tracer is not None:
+				self.tracer.probe(TRACE_EDGE)
+
+			#-----------------------------------------------------------------------
+			# For speed of reading, read all the sensors and parse to SHORTs after.
+			# This also ensures a self consistent set of sensor data compared to
+			# reading each individually where the sensor data registers could be
+			# updated between reads.  If the read fails, wait for the next sample.
+			#-----------------------------------------------------------------------
+			try:
+				self.i2c.readListInto(self.__MPU6050_RA_ACCEL_XOUT_H, self.sensor_data, 0, self.__FIFO_FRAME_SIZE)
+				break
+			except I2CError:
+				if self.sampleFailed():
+					raise
+
+		self.failed_samples = 0
+		if self.tracer is not None:
+			self.tracer.probe(TRACE_I2C)
 
 		#---------------------------------------------------------------------------
 		# Time stamp the data for the best integration possible in the main
-		# processing loop
+		# processing loop: best of all, when the kernel stamped the data ready edge
 		#---------------------------------------------------------------------------
-		time_now = time.time()
+		if self.data_ready is None:
+			time_now = time.time()
+		else:
+			time_now = edge_time
 
-		for index in range(0, 14, 2):
-			if (sensor_data[index] > 127):
-				sensor_data[index] -= 256
-			self.result_array[int(index / 2)] = (sensor_data[index] << 8) + sensor_data[index + 1]
+		#---------------------------------------------------------------------------
+		# Unpack all seven big-endian signed shorts in one go
+		#---------------------------------------------------------------------------
+		sensors = self.__SENSOR_STRUCT.unpack_from(self.sensor_data)
+		if self.tracer is not None:
+			self.tracer.probe(TRACE_DECODE)
+		if self.capture is not None:
+			self.capture.record(time_now, *sensors)
+		return sensors
+
+	def sampleFailed(self):
+		#---------------------------------------------------------------------------
+		# Count a failed sample; True once too many in a row have failed, when the
+		# caller passes its I2CError on
+		#---------------------------------------------------------------------------
+		self.misses += 1
+		self.failed_samples += 1
+		return self.failed_samples > self.__FAILED_SAMPLES_LIMIT
 
-		return self.result_array
 
 	def readSensors(self):
 		#---------------------------------------------------------------------------
@@ -437,12 +808,15 @@ class MPU6050 :
 		#---------------------------------------------------------------------------
 		[ax, ay, az, temp, gx, gy, gz] = self.readSensorsRaw()
 
-		ax_offset = temp * self.ax_offset_m + self.ax_offset_c
-		ay_offset = temp * self.ay_offset_m + self.ay_offset_c
-		az_offset = temp * self.az_offset_m + self.az_offset_c
-		ax_gain = temp * self.ax_gain_m + self.ax_gain_c
-		ay_gain = temp * self.ay_gain_m + self.ay_gain_c
-		az_gain = temp * self.az_gain_m + self.az_gain_c
+		#---------------------------------------------------------------------------
+		# The offsets and gains only change when the raw temperature does
+		#---------------------------------------------------------------------------
+		if temp != self.compensation_temp:
+			self.compensation_temp = temp
+			self.compensation = self.compensationFor(temp)
+		else:
+			self.compensation_repeats += 1
+		ax_offset, ay_offset, az_offset, ax_gain, ay_gain, az_gain = self.compensation
 
 		qax = (ax + ax_offset) * ax_gain
 		qay = (ay + ay_offset) * ay_gain
@@ -455,6 +829,30 @@ class MPU6050 :
 		return qax, qay, qaz, qgx, -qgy, qgz
 	
 
+	def compensationFor(self, temp):
+		compensation = self.compensation_cache.get(temp)
+		if compensation is not None:
+			self.compensation_hits += 1
+			return compensation
+
+		self.compensation_misses += 1
+		if len(self.compensation_cache) >= self.__COMPENSATION_CACHE_SIZE:
+			self.compensation_cache.clear()
+
+		compensation = (temp * self.ax_offset_m + self.ax_offset_c,
+		                temp * self.ay_offset_m + self.ay_offset_c,
+		                temp * self.az_offset_m + self.az_offset_c,
+		                temp * self.ax_gain_m + self.ax_gain_c,
+		                temp * self.ay_gain_m + self.ay_gain_c,
+		                temp * self.az_gain_m + self.az_gain_c)
+		self.compensation_cache[temp] = compensation
+		return compensation
+
+
+	def getCompensationCounts(self):
+		return self.compensation_repeats, self.compensation_hits, self.compensation_misses
+
+
 	def calibrateGyros(self):
 		self.gx_offset = 0.0
 		self.gy_offset = 0.0
@@ -471,6 +869,32 @@ class MPU6050 :
 		self.gz_offset /= self.__CALIBRATION_ITERATIONS
 
 
+	def measureCalibration(self, samples):
+		#---------------------------------------------------------------------------
+		# A short read to check a saved calibration against: the last raw
+		# temperature, the average raw gyros and the average compensated gravity
+		# vector in g
+		#---------------------------------------------------------------------------
+		gx_total = 0.0
+		gy_total = 0.0
+		gz_total = 0.0
+		gravity_x = 0.0
+		gravity_y = 0.0
+		gravity_z = 0.0
+
+		for loop_count in range(0, samples):
+			[ax, ay, az, temp, gx, gy, gz] = self.readSensorsRaw()
+			ax_offset, ay_offset, az_offset, ax_gain, ay_gain, az_gain = self.compensationFor(temp)
+			gravity_x += (ax + ax_offset) * ax_gain
+			gravity_y += (ay + ay_offset) * ay_gain
+			gravity_z += (az + az_offset) * az_gain
+			gx_total += gx
+			gy_total += gy
+			gz_total += gz
+
+		return temp, gx_total / samples, gy_total / samples, gz_total / samples, gravity_x * SCALE_ACCEL / samples, gravity_y * SCALE_ACCEL / samples, gravity_z * SCALE_ACCEL / samples
+
+
 	def calibrateGravity(self, file_name):
 		gravity_x = 0.0
 		gravity_y = 0.0
@@ -505,7 +929,7 @@ class MPU6050 :
 				cfg_file.write('%f\n' % gravity_z)
 				cfg_file.flush()
 
-		except IOError, err:
+		except IOError as err:
 			logger.critical('Could not open offset config file: %s for writing', file_name)
 			cfg_rc = False
 
@@ -519,9 +943,53 @@ class MPU6050 :
 		return temp
 
 
+	def startAcquisition(self):
+		#---------------------------------------------------------------------------
+		# The acquisition process is forked from here, so it must start out with
+		# neither the ring nor the capture: the control process records that from
+		# what it reads.
+		#---------------------------------------------------------------------------
+		import qcacquire
+
+		capture = self.capture
+		self.capture = None
+		acquisition = qcacquire.Acquisition(self.readSensorsStamped, self.getCounters)
+		acquisition.start()
+		self.acquisition = acquisition
+		self.capture = capture
+
+
+	def stopAcquisition(self):
+		#---------------------------------------------------------------------------
+		# The misses and FIFO overflows happened in the acquisition process
+		#---------------------------------------------------------------------------
+		if self.acquisition is None:
+			return
+
+		counters = self.acquisition.stop()
+		if counters is not None:
+			self.misses, self.i2c.misses, self.i2c.errors, self.fifo_overflows, data_ready_counts = counters
+			if self.data_ready is not None:
+				self.data_ready.edges, self.data_ready.missed = data_ready_counts
+
+
+	def readSensorsStamped(self):
+		sensors = self.readSensorsRaw()
+		return time_now, sensors
+
+
+	def getCounters(self):
+		data_ready_counts = None if self.data_ready is None else self.data_ready.getCounts()
+		return self.misses, self.i2c.misses, self.i2c.errors, self.fifo_overflows, data_ready_counts
+
+
 	def getMisses(self):
 		i2c_misses = self.i2c.getMisses()
 		return self.misses, i2c_misses
+
+
+	def getFIFOOverflows(self):
+		return self.fifo_overflows
 		
 
 
@@ -598,6 +1066,210 @@ class PID:
 		#---------------------------------------------------------------------------
 		return p_output, i_output, d_output
 
+############################################################################################
+#
+# Mahony style quaternion attitude estimator, updated on every sensor sample rather than once
+# per motion tick.  The gyro rates turn the quaternion; the accelerometer's view of gravity
+# pulls it back into line via a proportional (and optional integral) correction, with 1 / kp
+# playing the part tau plays in the complementary filter.  An update is only multiply-adds
+# and a square root; trig is only needed to hand angles to the motion processing.
+#
+# Angles follow the rest of the code: pitch is positive with +ax and integrates the negated
+# y gyro that readSensors() returns, roll integrates the x gyro and yaw the z gyro.
+#
+############################################################################################
+class QuaternionAHRS:
+
+	def __init__(self, pitch, roll, kp, ki=0.0):
+		self.kp = kp
+		self.ki = ki
+
+		self.ix = 0.0
+		self.iy = 0.0
+		self.iz = 0.0
+
+		#---------------------------------------------------------------------------
+		# Start from the take-off platform slope with zero yaw
+		#---------------------------------------------------------------------------
+		c_pa = math.cos(-pitch / 2)
+		s_pa = math.sin(-pitch / 2)
+		c_ra = math.cos(roll / 2)
+		s_ra = math.sin(roll / 2)
+
+		self.qw = c_ra * c_pa
+		self.qx = s_ra * c_pa
+		self.qy = c_ra * s_pa
+		self.qz = -s_ra * s_pa
+
+
+	def update(self, qgx, qgy, qgz, qax, qay, qaz, dt):
+		qw = self.qw
+		qx = self.qx
+		qy = self.qy
+		qz = self.qz
+
+		#---------------------------------------------------------------------------
+		# Body rates in radians per second, undoing the y gyro negation
+		#---------------------------------------------------------------------------
+		gx = qgx * SCALE_GYRO
+		gy = -qgy * SCALE_GYRO
+		gz = qgz * SCALE_GYRO
+
+		#---------------------------------------------------------------------------
+		# The error is the cross product of the measured and estimated gravity directions
+		#---------------------------------------------------------------------------
+		a_norm = qax * qax + qay * qay + qaz * qaz
+		if a_norm > 0.0:
+			a_norm = 1 / math.sqrt(a_norm)
+			qax *= a_norm
+			qay *= a_norm
+			qaz *= a_norm
+
+			vx = 2 * (qx * qz - qw * qy)
+			vy = 2 * (qw * qx + qy * qz)
+			vz = qw * qw - qx * qx - qy * qy + qz * qz
+
+			ex = qay * vz - qaz * vy
+			ey = qaz * vx - qax * vz
+			ez = qax * vy - qay * vx
+
+			if self.ki != 0.0:
+				self.ix += self.ki * ex * dt
+				self.iy += self.ki * ey * dt
+				self.iz += self.ki * ez * dt
+				gx += self.ix
+				gy += self.iy
+				gz += self.iz
+
+			gx += self.kp * ex
+			gy += self.kp * ey
+			gz += self.kp * ez
+
+		#---------------------------------------------------------------------------
+		# Integrate the quaternion rate, q' = q x (0, w) / 2
+		#---------------------------------------------------------------------------
+		half_dt = 0.5 * dt
+		self.qw = qw + (-qx * gx - qy * gy - qz * gz) * half_dt
+		self.qx = qx + (qw * gx + qy * gz - qz * gy) * half_dt
+		self.qy = qy + (qw * gy - qx * gz + qz * gx) * half_dt
+		self.qz = qz + (qw * gz + qx * gy - qy * gx) * half_dt
+
+		#---------------------------------------------------------------------------
+		# The step barely changes the norm, so a first order renormalization will do
+		#---------------------------------------------------------------------------
+		q_norm = 1.5 - 0.5 * (self.qw * self.qw + self.qx * self.qx + self.qy * self.qy + self.qz * self.qz)
+		self.qw *= q_norm
+		self.qx *= q_norm
+		self.qy *= q_norm
+		self.qz *= q_norm
+
+
+	def getAngles(self):
+		qw = self.qw
+		qx = self.qx
+		qy = self.qy
+		qz = self.qz
+
+		sin_pa = 2 * (qx * qz - qw * qy)
+		if sin_pa > 1.0:
+			sin_pa = 1.0
+		elif sin_pa < -1.0:
+			sin_pa = -1.0
+
+		pitch = math.asin(sin_pa)
+		roll = math.atan2(2 * (qw * qx + qy * qz), 1 - 2 * (qx * qx + qy * qy))
+		yaw = math.atan2(2 * (qw * qz + qx * qy), 1 - 2 * (qy * qy + qz * qz))
+		return pitch, roll, yaw
+
+
+	def getRotationMatrix(self):
+		#---------------------------------------------------------------------------
+		# The earth- to quadcopter-frame matrix, as used by E2QFrame
+		#---------------------------------------------------------------------------
+		qw = self.qw
+		qx = self.qx
+		qy = self.qy
+		qz = self.qz
+
+		return ((1 - 2 * (qy * qy + qz * qz), 2 * (qx * qy + qw * qz), 2 * (qx * qz - qw * qy)),
+			(2 * (qx * qy - qw * qz), 1 - 2 * (qx * qx + qz * qz), 2 * (qy * qz + qw * qx)),
+			(2 * (qx * qz + qw * qy), 2 * (qy * qz - qw * qx), 1 - 2 * (qx * qx + qy * qy)))
+
+############################################################################################
+#
+# Linear Kalman filter for the quad-frame velocities in place of the open-loop integral of the
+# gravity-free accelerometer.  Each axis has two states, velocity and accelerometer bias, the
+# latter being what makes the plain integral drift.  With no velocity sensor on board, the
+# only measurement there is is that the quad isn't moving while it's known to be at rest: on
+# the ground while the motors spin up to hover speed.  That makes the bias observable before
+# take-off; in flight nothing says what the velocity is - the flight plan's targets are only
+# what it should be - so the filter just integrates with the bias it has learned.
+#
+# State and covariance live in preallocated flat lists and every step is written out in closed
+# form, so a motion tick always costs the same few dozen float operations.
+#
+############################################################################################
+class VelocityKalman:
+
+	#-----------------------------------------------------------------------------------
+	# Noise densities: velocity and bias random walks per second, and the zero velocity
+	# observation at rest
+	#-----------------------------------------------------------------------------------
+	VELOCITY_NOISE = 1e-4
+	BIAS_NOISE = 1e-6
+	MEASUREMENT_NOISE = 1e-3
+
+	def __init__(self):
+		#---------------------------------------------------------------------------
+		# Per axis: [velocity, bias] and the symmetric covariance [p00, p01, p11]
+		#---------------------------------------------------------------------------
+		self.x = [0.0] * 6
+		self.p = [0.0, 0.0, 1e-4] * 3
+
+
+	def update(self, qax, qay, qaz, dt, at_rest=False):
+		x = self.x
+		p = self.p
+		g_dt = GRAV_ACCEL * dt
+		q_v = self.VELOCITY_NOISE * dt
+		q_b = self.BIAS_NOISE * dt
+		r = self.MEASUREMENT_NOISE
+
+		for axis, accel in ((0, qax), (1, qay), (2, qaz)):
+			xi = 2 * axis
+			pi = 3 * axis
+
+			#-------------------------------------------------------------------
+			# Predict: v += (a - b) * g * dt, with F = |1 -g*dt; 0 1|
+			#-------------------------------------------------------------------
+			v = x[xi] + (accel - x[xi + 1]) * g_dt
+			b = x[xi + 1]
+			p00 = p[pi] - 2 * g_dt * p[pi + 1] + g_dt * g_dt * p[pi + 2] + q_v
+			p01 = p[pi + 1] - g_dt * p[pi + 2]
+			p11 = p[pi + 2] + q_b
+
+			if not at_rest:
+				x[xi] = v
+				p[pi] = p00
+				p[pi + 1] = p01
+				p[pi + 2] = p11
+				continue
+
+			#-------------------------------------------------------------------
+			# Update against the zero velocity observation, H = |1 0|
+			#-------------------------------------------------------------------
+			s = p00 + r
+			k0 = p00 / s
+			k1 = p01 / s
+
+			x[xi] = v - k0 * v
+			x[xi + 1] = b - k1 * v
+			p[pi] = p00 - k0 * p00
+			p[pi + 1] = p01 - k0 * p01
+			p[pi + 2] = p11 - k1 * p01
+
+		return x[0], x[2], x[4]
+
 ############################################################################################
 #
 #  Class for managing each blade + motor configuration via its ESC
@@ -606,18 +1278,12 @@ class PID:
 class ESC:
 	pwm = None
 
-	def __init__(self, pin, location, rotation, name):
+	def __init__(self, pin, name):
 		#---------------------------------------------------------------------------
 		# The GPIO BCM numbered pin providing PWM signal for this ESC
 		#---------------------------------------------------------------------------
 		self.bcm_pin = pin
 
-		#---------------------------------------------------------------------------
-		# The location on the quad, and the direction of the motor controlled by this ESC
-		#---------------------------------------------------------------------------
-		self.motor_location = location
-		self.motor_rotation = rotation
-
 		#---------------------------------------------------------------------------
 		# The PWM pulse width range required by this ESC in microseconds
 		#---------------------------------------------------------------------------
@@ -632,12 +1298,13 @@ class ESC:
 		self.name = name
 
 		#---------------------------------------------------------------------------
-		# Initialize the RPIO DMA PWM for this ESC.
+		# Initialize the RPIO DMA PWM for this ESC, and note what the DMA table holds
 		#---------------------------------------------------------------------------
 		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.init_pulse_width)
+		self.applied_pulse_width = self.init_pulse_width
 
 
-	def update(self, spin_rate):
+	def pulseWidth(self, spin_rate):
 		self.current_pulse_width = int(self.min_pulse_width + spin_rate)
 
 		if self.current_pulse_width < self.min_pulse_width:
@@ -645,29 +1312,270 @@ class ESC:
 		if self.current_pulse_width > self.max_pulse_width:
 			self.current_pulse_width = self.max_pulse_width
 
-		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.current_pulse_width)
+		return self.current_pulse_width
+
+
+	def update(self, spin_rate):
+		PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulseWidth(spin_rate))
+		self.applied_pulse_width = self.current_pulse_width
 
-		
 ############################################################################################
 #
-# Convert a vector to quadcopter-frame coordinates from earth-frame coordinates
+# Motor output: every ESC's pulse width is worked out first, then only those that changed are
+# written to the DMA table, together.  A PWM library with add_channel_pulses() takes them as
+# one batch; RPIO's own PWM doesn't have one, so there they go back-to-back with no mixing or
+# clipping in between, keeping the window where the motors hold a mix of old and new widths to
+# the DMA edits themselves.
 #
 ############################################################################################
-def GetEulerAngles(ax, ay, az):
-	#---------------------------------------------------------------------------
-	# What's the angle in the x and y plane from horizontal in radians?
-	#---------------------------------------------------------------------------
-	pitch = math.atan2(ax, math.pow(math.pow(ay, 2) + math.pow(az, 2), 0.5))
-	roll = math.atan2(ay, math.pow(math.pow(ax, 2) + math.pow( az, 2), 0.5))
-	tilt = math.atan2(math.pow(math.pow(ax, 2) + math.pow(ay, 2), 0.5), az)
-	return pitch, roll, tilt
+class MotorOutput:
+
+	def __init__(self, esc_list):
+		self.esc_list = esc_list
+		self.batched = hasattr(PWM, 'add_channel_pulses')
+
+		self.updates = 0
+		self.noops = 0
+
+
+	def update(self, spin_rates):
+		pulses = []
+		for esc, spin_rate in zip(self.esc_list, spin_rates):
+			pulse_width = esc.pulseWidth(spin_rate)
+			if pulse_width != esc.applied_pulse_width:
+				pulses.append((esc, pulse_width))
+
+		self.noops += len(self.esc_list) - len(pulses)
+		if len(pulses) == 0:
+			return
+		self.updates += len(pulses)
+
+		if self.batched:
+			PWM.add_channel_pulses(RPIO_DMA_CHANNEL, [(esc.bcm_pin, 0, pulse_width) for esc, pulse_width in pulses])
+		else:
+			for esc, pulse_width in pulses:
+				PWM.add_channel_pulse(RPIO_DMA_CHANNEL, esc.bcm_pin, 0, pulse_width)
+
+		for esc, pulse_width in pulses:
+			esc.applied_pulse_width = pulse_width
+
+
+	def getUpdates(self):
+		return self.updates, self.noops
 
+		
 ############################################################################################
 #
-# Convert a vector to quadcopter-frame coordinates from earth-frame coordinates
+# PID output distribution: a mixing matrix built once from the frame description gives each
+# motor's share of the pitch, roll and yaw rate outputs, so every motor's spin comes from the
+# same multiply-adds.  Each row is derived from where the motor sits and which way it turns:
 #
-############################################################################################
-def E2QFrame(evx, evy, evz, pa, ra, ya, ta):
+# - For a left downwards roll, the x gyro goes negative, so the PID error is positive, meaning
+#   PID output is positive, meaning this needs to be added to the left blades and subtracted
+#   from the right.
+#
+# - For a forward downwards pitch, the y gyro goes positive, but is negated in
+#   mpu6050.readSensors so it is consistent with the accelerometer + Euler angle calculations.
+#   The PID error is postive as a result, meaning PID output is positive, meaning this needs to
+#   be added to the front blades and subtracted from the back.
+#
+# - For CW yaw, the z gyro goes negative, so the PID error is postitive, meaning PID output is
+#   positive, meaning this need to be added to the CW blades and subtracted from the ACW blades.
+#
+# The spins are then desaturated together rather than each ESC clipping its own: if the pitch,
+# roll and yaw demands alone span more than the ESC range they are scaled down, and if the
+# fastest motor would be over the top of the range, all motors come down by the same amount,
+# or if the slowest would be below the bottom, all go up by the same amount.  Either way the
+# balance between motors - and so the attitude control - is kept.
+#
+############################################################################################
+class Mixer:
+
+	def __init__(self, frame, max_spin=1000):
+		self.max_spin = max_spin
+		self.desaturations = 0
+
+		#---------------------------------------------------------------------------
+		# Motor angles are clockwise from the front; scale the pitch and roll columns
+		# so the furthest out motors get the full PID output, as on the quad X frame
+		#---------------------------------------------------------------------------
+		pitch_list = [math.cos(math.radians(angle)) for name, pin, angle, rotation in frame]
+		roll_list = [-math.sin(math.radians(angle)) for name, pin, angle, rotation in frame]
+		yaw_list = [1.0 if rotation == MOTOR_ROTATION_CW else -1.0 for name, pin, angle, rotation in frame]
+
+		pitch_scale = max(abs(pitch) for pitch in pitch_list)
+		roll_scale = max(abs(roll) for roll in roll_list)
+
+		self.matrix = [(round(pitch / pitch_scale, 9), round(roll / roll_scale, 9), yaw) for pitch, roll, yaw in zip(pitch_list, roll_list, yaw_list)]
+
+
+	def mix(self, vert_out, pr_out, rr_out, yr_out):
+		spins = [vert_out + pitch * pr_out + roll * rr_out + yaw * yr_out for pitch, roll, yaw in self.matrix]
+
+		high = max(spins)
+		low = min(spins)
+		if high > self.max_spin or low < 0 or high - low > self.max_spin:
+			self.desaturations += 1
+
+			if high - low > self.max_spin:
+				scale = self.max_spin / (high - low)
+				spins = [vert_out + (spin - vert_out) * scale for spin in spins]
+				high = vert_out + (high - vert_out) * scale
+				low = vert_out + (low - vert_out) * scale
+
+			if high > self.max_spin:
+				spins = [spin - (high - self.max_spin) for spin in spins]
+			elif low < 0:
+				spins = [spin - low for spin in spins]
+
+		return spins
+
+
+	def getDesaturations(self):
+		return self.desaturations
+
+############################################################################################
+#
+# Frame descriptions: each motor's name, ESC BCM pin, angle clockwise from the front and
+# rotation, either one of the FRAMES below or a file of "name, pin, angle, CW|ACW" lines.
+# The diagnostics record the first four motors' pulse widths, so a frame needs at least four.
+#
+############################################################################################
+def LoadFrame(frame_name):
+	if frame_name in FRAMES:
+		return FRAMES[frame_name]
+
+	frame = []
+	with open(frame_name) as frame_file:
+		for line in frame_file:
+			line = line.split('#')[0].strip()
+			if line == '':
+				continue
+			name, pin, angle, rotation = [field.strip() for field in line.split(',')]
+			frame.append((name, int(pin), float(angle), MOTOR_ROTATION_CW if rotation.upper() == 'CW' else MOTOR_ROTATION_ACW))
+
+	if len(frame) < 4:
+		raise ValueError("%s describes %d motors, not at least 4" % (frame_name, len(frame)))
+	return frame
+
+############################################################################################
+#
+# Accelerometer temperature compensation coefficients: the offset and gain trend lines against
+# raw temperature for each axis, as written by qcfit.py from the -c calibration rows in
+# qcoffsets.csv.  Each line of the file is "name, m, c".
+#
+############################################################################################
+COEFFICIENTS_FILE = "./qccoefficients.csv"
+COEFFICIENT_NAMES = ['ax_offset', 'ay_offset', 'az_offset', 'ax_gain', 'ay_gain', 'az_gain']
+
+def LoadCoefficients(file_name):
+	coefficients = {}
+	with open(file_name) as coefficients_file:
+		for line in coefficients_file:
+			line = line.split('#')[0].strip()
+			if line == '':
+				continue
+			name, m, c = [field.strip() for field in line.split(',')]
+			coefficients[name] = (float(m), float(c))
+
+	missing = [name for name in COEFFICIENT_NAMES if name not in coefficients]
+	if len(missing) != 0:
+		raise ValueError("%s has no %s coefficients" % (file_name, ', '.join(missing)))
+	return coefficients
+
+############################################################################################
+#
+# Warm restart calibration: the gyro offsets and take-off gravity vector from the last full
+# calibration, stamped with the time and raw temperature they were measured at.  Each line of
+# the file is "name, value".  A restart reads a few samples and only reuses them if the quad
+# is still as warm, as still and as level as it was then; otherwise it calibrates in full.
+#
+############################################################################################
+CALIBRATION_NAMES = ['time', 'temp', 'gx_offset', 'gy_offset', 'gz_offset', 'qfrgv_x', 'qfrgv_y', 'qfrgv_z']
+CALIBRATION_SAMPLES = 50
+
+#-------------------------------------------------------------------------------------------
+# Tolerances: 30 minutes, 1 degree C in raw temperature units, 0.25 degrees/s in raw gyro units
+# and 0.02g
+#-------------------------------------------------------------------------------------------
+CALIBRATION_MAX_AGE = 1800.0
+CALIBRATION_TEMP_TOLERANCE = 340
+CALIBRATION_GYRO_TOLERANCE = 32.75
+CALIBRATION_GRAVITY_TOLERANCE = 0.02
+
+def LoadCalibration(file_name):
+	calibration = {}
+	with open(file_name) as calibration_file:
+		for line in calibration_file:
+			line = line.split('#')[0].strip()
+			if line == '':
+				continue
+			name, value = [field.strip() for field in line.split(',')]
+			calibration[name] = float(value)
+
+	missing = [name for name in CALIBRATION_NAMES if name not in calibration]
+	if len(missing) != 0:
+		raise ValueError("%s has no %s calibration" % (file_name, ', '.join(missing)))
+	return calibration
+
+
+def SaveCalibration(file_name, calibration):
+	#---------------------------------------------------------------------------------------
+	# Written in full alongside and then renamed over the old one, so a power cut never
+	# leaves half a file; repr() floats read back bit for bit, so replay matches.
+	#---------------------------------------------------------------------------------------
+	temp_file_name = file_name + '.tmp'
+	with open(temp_file_name, 'w') as calibration_file:
+		calibration_file.write('# Saved by qc.py for warm restarts\n')
+		for name in CALIBRATION_NAMES:
+			calibration_file.write('%s, %s\n' % (name, repr(calibration[name])))
+	os.rename(temp_file_name, file_name)
+
+
+def CheckCalibration(calibration, time_now, temp, gx, gy, gz, gravity_x, gravity_y, gravity_z):
+	#---------------------------------------------------------------------------------------
+	# Why the saved calibration can't be used, or None if it can
+	#---------------------------------------------------------------------------------------
+	if calibration is None:
+		return 'none saved'
+
+	age = time_now - calibration['time']
+	if age < 0 or age > CALIBRATION_MAX_AGE:
+		return 'saved %.0fs ago' % age
+
+	if abs(temp - calibration['temp']) > CALIBRATION_TEMP_TOLERANCE:
+		return 'temperature %.2f, was %.2f' % ((temp / 340) + 36.53, (calibration['temp'] / 340) + 36.53)
+
+	for axis, offset in (('gx', gx), ('gy', gy), ('gz', gz)):
+		if abs(offset - calibration[axis + '_offset']) > CALIBRATION_GYRO_TOLERANCE:
+			return '%s offset %.1f, was %.1f' % (axis, offset, calibration[axis + '_offset'])
+
+	for axis, gravity in (('x', gravity_x), ('y', gravity_y), ('z', gravity_z)):
+		if abs(gravity - calibration['qfrgv_' + axis]) > CALIBRATION_GRAVITY_TOLERANCE:
+			return 'gravity %s %.3fg, was %.3fg' % (axis, gravity, calibration['qfrgv_' + axis])
+
+	return None
+
+############################################################################################
+#
+# Convert a vector to quadcopter-frame coordinates from earth-frame coordinates
+#
+############################################################################################
+def GetEulerAngles(ax, ay, az):
+	#---------------------------------------------------------------------------
+	# What's the angle in the x and y plane from horizontal in radians?
+	#---------------------------------------------------------------------------
+	pitch = math.atan2(ax, math.pow(math.pow(ay, 2) + math.pow(az, 2), 0.5))
+	roll = math.atan2(ay, math.pow(math.pow(ax, 2) + math.pow( az, 2), 0.5))
+	tilt = math.atan2(math.pow(math.pow(ax, 2) + math.pow(ay, 2), 0.5), az)
+	return pitch, roll, tilt
+
+############################################################################################
+#
+# Convert a vector to quadcopter-frame coordinates from earth-frame coordinates
+#
+############################################################################################
+def E2QFrame(evx, evy, evz, pa, ra, ya, ta):
 	global use_tilt
 
 	#===================================================================================
@@ -793,6 +1701,59 @@ def Q2EFrame(qvx, qvy, qvz, pa, ra, ya, ta):
 
 	return evx, evy, evz
 
+############################################################################################
+#
+# The earth- to quadcopter-frame matrix of E2QFrame, computed once per attitude and then applied
+# to as many vectors as needed, either way round - Q2EFrame is its transpose.  The transforms are
+# only multiply-adds, so they work just as well on NumPy arrays of vectors.
+#
+############################################################################################
+class Rotation:
+
+	def __init__(self, pa=0.0, ra=0.0, ya=0.0):
+		self.setAngles(pa, ra, ya)
+
+
+	def setAngles(self, pa, ra, ya):
+		c_pa = math.cos(pa)
+		s_pa = -math.sin(pa)
+		c_ra = math.cos(ra)
+		s_ra = math.sin(ra)
+		c_ya = math.cos(ya)
+		s_ya = math.sin(ya)
+
+		self.m00 = c_pa * c_ya
+		self.m01 = c_pa * s_ya
+		self.m02 = -s_pa
+		self.m10 = s_ra * s_pa * c_ya - c_ra * s_ya
+		self.m11 = s_ra * s_pa * s_ya + c_ra * c_ya
+		self.m12 = s_ra * c_pa
+		self.m20 = c_ra * s_pa * c_ya + s_ra * s_ya
+		self.m21 = c_ra * s_pa * s_ya - s_ra * c_ya
+		self.m22 = c_pa * c_ra
+
+
+	def setMatrix(self, matrix):
+		((self.m00, self.m01, self.m02), (self.m10, self.m11, self.m12), (self.m20, self.m21, self.m22)) = matrix
+
+
+	def getMatrix(self):
+		return ((self.m00, self.m01, self.m02), (self.m10, self.m11, self.m12), (self.m20, self.m21, self.m22))
+
+
+	def e2q(self, evx, evy, evz):
+		qvx = self.m00 * evx + self.m01 * evy + self.m02 * evz
+		qvy = self.m10 * evx + self.m11 * evy + self.m12 * evz
+		qvz = self.m20 * evx + self.m21 * evy + self.m22 * evz
+		return qvx, qvy, qvz
+
+
+	def q2e(self, qvx, qvy, qvz):
+		evx = self.m00 * qvx + self.m10 * qvy + self.m20 * qvz
+		evy = self.m01 * qvx + self.m11 * qvy + self.m21 * qvz
+		evz = self.m02 * qvx + self.m12 * qvy + self.m22 * qvz
+		return evx, evy, evz
+
 
 ############################################################################################
 #
@@ -827,28 +1788,38 @@ def BlinkLeds():
             BlinkLeds.counter = 0  # reset counter cause it gets to high     
 ############################################################################################
 #
-# GPIO pins initialization for MPU6050 interrupt, sounder and hardware PWM
+# GPIO pins initialization for MPU6050 interrupt, sounder and hardware PWM.  The interrupt
+# is left alone when it's read from the GPIO character device, which claims the line itself.
 #
 ############################################################################################
-def RpioSetup():
-    RPIO.setmode(RPIO.BCM)
+rpio_setup = False
+rpio_edge_detect = False
+
+def RpioSetup(edge_detect=True):
+	global rpio_setup
+	global rpio_edge_detect
+
+	RPIO.setmode(RPIO.BCM)
+	rpio_setup = True
 
 	#-----------------------------------------------------------------------------------
 	# Set the beeper output LOW
 	#-----------------------------------------------------------------------------------
-    logger.info('Set status sounder pin %s as out', RPIO_STATUS_SOUNDER)
-    RPIO.setup(RPIO_STATUS_SOUNDER, RPIO.OUT, RPIO.LOW)
-    #-----------------------------------------------------------------------------------
-    # Set LED's output
-    #-----------------------------------------------------------------------------------
-    RPIO.setup(4, RPIO.OUT, RPIO.LOW)
-    RPIO.setup(24, RPIO.OUT, RPIO.LOW)
+	logger.info('Set status sounder pin %s as out', RPIO_STATUS_SOUNDER)
+	RPIO.setup(RPIO_STATUS_SOUNDER, RPIO.OUT, RPIO.LOW)
+	#-----------------------------------------------------------------------------------
+	# Set LED's output
+	#-----------------------------------------------------------------------------------
+	RPIO.setup(4, RPIO.OUT, RPIO.LOW)
+	RPIO.setup(24, RPIO.OUT, RPIO.LOW)
 	#-----------------------------------------------------------------------------------
 	# Set the MPU6050 interrupt input
 	#-----------------------------------------------------------------------------------
-	logger.info('Setup MPU6050 interrupt input %s', RPIO_DATA_READY_INTERRUPT)
-	RPIO.setup(RPIO_DATA_READY_INTERRUPT, RPIO.IN) # , RPIO.PUD_DOWN)
-	RPIO.edge_detect_init(RPIO_DATA_READY_INTERRUPT, RPIO.RISING)
+	if edge_detect:
+		logger.info('Setup MPU6050 interrupt input %s', RPIO_DATA_READY_INTERRUPT)
+		RPIO.setup(RPIO_DATA_READY_INTERRUPT, RPIO.IN) # , RPIO.PUD_DOWN)
+		RPIO.edge_detect_init(RPIO_DATA_READY_INTERRUPT, RPIO.RISING)
+		rpio_edge_detect = True
 
 	#-----------------------------------------------------------------------------------
 	# Set up the globally shared single PWM channel
@@ -859,21 +1830,28 @@ def RpioSetup():
 
 ############################################################################################
 #
-# GPIO pins cleanup for MPU6050 interrupt, sounder and hardware PWM
+# GPIO pins cleanup for MPU6050 interrupt, sounder and hardware PWM, if they were set up
 #
 ############################################################################################
 def RpioCleanup():
+	if not rpio_setup:
+		return
+
 	PWM.cleanup()
 	RPIO.output(RPIO_STATUS_SOUNDER, RPIO.LOW)
-	RPIO.edge_detect_term(RPIO_DATA_READY_INTERRUPT)
+	if rpio_edge_detect:
+		RPIO.edge_detect_term(RPIO_DATA_READY_INTERRUPT)
 	RPIO.cleanup()
 
 
 ############################################################################################
 #
-# Check CLI validity, set calibrate_sensors / fly or sys.exit(1)
+# Check CLI validity, set calibrate_sensors / fly or sys.exit(1).  The options come back as a
+# CLIOptions, so they can be unpacked in order or picked out by name.
 #
 ############################################################################################
+CLIOptions = collections.namedtuple('CLIOptions', ['calibrate_sensors', 'fly', 'hover_target', 'video', 'vvp_gain', 'vvi_gain', 'vvd_gain', 'hvp_gain', 'hvi_gain', 'hvd_gain', 'prp_gain', 'pri_gain', 'prd_gain', 'rrp_gain', 'rri_gain', 'rrd_gain', 'test_case', 'tau', 'dlpf', 'jitter', 'motion_frequency', 'rtf_period', 'diagnostics', 'fifo', 'backend', 'capture_file', 'replay_file', 'attitude', 'kalman', 'frame', 'acquire', 'rt_cpu', 'trace_file', 'deadline', 'coefficients_file', 'calibration_file', 'i2c', 'gpio'])
+
 def CheckCLI(argv):
 	cli_fly = False
 	cli_calibrate_sensors = False
@@ -919,6 +1897,21 @@ def CheckCLI(argv):
 	cli_diagnostics = False
 	cli_motion_frequency = 37
 	cli_rtf_period = 1.0
+	cli_fifo = False
+	cli_backend = 'pi'
+	cli_capture_file = None
+	cli_replay_file = None
+	cli_attitude = 'complementary'
+	cli_kalman = False
+	cli_frame = 'quadx'
+	cli_acquire = False
+	cli_rt_cpu = None
+	cli_trace_file = None
+	cli_deadline = 'catchup'
+	cli_coefficients_file = None
+	cli_calibration_file = None
+	cli_i2c = 'smbus'
+	cli_gpio = 'rpio'
 
 	hover_target_defaulted = True
 	no_drift_control = False
@@ -933,7 +1926,7 @@ def CheckCLI(argv):
 	# Right, let's get on with reading the command line and checking consistency
 	#-----------------------------------------------------------------------------------
 	try:
-		opts, args = getopt.getopt(argv,'dfcvh:j:m:r:', ['tc=', 'vvp=', 'vvi=', 'vvd=', 'hvp=', 'hvi=', 'hvd=', 'prp=', 'pri=', 'prd=', 'rrp=', 'rri=', 'rrd=', 'tau=', 'dlpf='])
+		opts, args = getopt.getopt(argv,'dfcvh:j:m:r:', ['tc=', 'vvp=', 'vvi=', 'vvd=', 'hvp=', 'hvi=', 'hvd=', 'prp=', 'pri=', 'prd=', 'rrp=', 'rri=', 'rrd=', 'tau=', 'dlpf=', 'fifo', 'backend=', 'capture=', 'replay=', 'attitude=', 'kalman', 'frame=', 'acquire', 'rt=', 'trace=', 'deadline=', 'coefficients=', 'calibration=', 'i2c=', 'gpio='])
 	except getopt.GetoptError:
 		logger.critical('Must specify one of -f or -c or --tc')
 		logger.critical('  qcpi.py [-f] [-t speed] [-c] [-v]')
@@ -960,6 +1953,21 @@ def CheckCLI(argv):
 		logger.critical('  --tc   select which testcase to run')
 		logger.critical('  --tau  set the complementary filter period')
 		logger.critical('  --dlpf set the digital low pass filter')
+		logger.critical('  --fifo drain sensor data in batches from the MPU6050 FIFO')
+		logger.critical('  --backend ?? set the hardware backend: pi (default) or sim')
+		logger.critical('  --capture ?? save the raw sensor stream to this file for replay')
+		logger.critical('  --replay ?? replay a raw sensor capture in place of the hardware')
+		logger.critical('  --attitude ?? set the attitude estimator: complementary (default) or quaternion')
+		logger.critical('  --kalman estimate velocity with a Kalman filter rather than integrating acceleration')
+		logger.critical('  --frame ?? set the frame: quadx (default), quad+, hexa, octo or a frame description file')
+		logger.critical('  --acquire read the sensors in a separate acquisition process')
+		logger.critical('  --rt ?? run the flight loop SCHED_FIFO on this CPU, everything else on the others')
+		logger.critical('  --trace ?? record the per-stage latency trace to this file for qctrace.py, and log its histograms')
+		logger.critical('  --deadline ?? set what happens to overdue motion ticks: catchup (default), skip or coalesce')
+		logger.critical('  --coefficients ?? load accelerometer temperature coefficients from this file, default %s if it exists', COEFFICIENTS_FILE)
+		logger.critical('  --calibration ?? save gyro offsets and gravity to this file, and reuse them on a warm restart')
+		logger.critical('  --i2c ?? smbus (default) or rdwr for single ioctl transfers on /dev/i2c-1')
+		logger.critical('  --gpio ?? rpio (default) or chardev for kernel timestamped data ready edges from /dev/gpiochip0')
 		sys.exit(2)
 
 	for opt, arg in opts:
@@ -1039,7 +2047,101 @@ def CheckCLI(argv):
 		elif opt in '--dlpf':
 			cli_dlpf = int(arg)
 
-	if not cli_calibrate_sensors and not cli_fly and cli_test_case == 0:
+		elif opt in '--fifo':
+			cli_fifo = True
+
+		elif opt in '--backend':
+			cli_backend = arg
+
+		elif opt in '--capture':
+			cli_capture_file = arg
+
+		elif opt in '--replay':
+			cli_replay_file = arg
+			cli_backend = 'replay'
+
+		elif opt in '--attitude':
+			cli_attitude = arg
+
+		elif opt in '--kalman':
+			cli_kalman = True
+
+		elif opt in '--frame':
+			cli_frame = arg
+
+		elif opt in '--acquire':
+			cli_acquire = True
+
+		elif opt in '--rt':
+			cli_rt_cpu = int(arg)
+
+		elif opt in '--trace':
+			cli_trace_file = arg
+
+		elif opt in '--deadline':
+			cli_deadline = arg
+
+		elif opt in '--coefficients':
+			cli_coefficients_file = arg
+
+		elif opt in '--calibration':
+			cli_calibration_file = arg
+
+		elif opt in '--i2c':
+			cli_i2c = arg
+
+		elif opt in '--gpio':
+			cli_gpio = arg
+
+	if cli_backend not in ('pi', 'sim', 'replay') or (cli_backend == 'replay' and cli_replay_file is None):
+		logger.critical('Backend must be pi or sim, or use --replay')
+		sys.exit(2)
+
+	elif cli_attitude not in ('complementary', 'quaternion'):
+		logger.critical('Attitude estimator must be complementary or quaternion')
+		sys.exit(2)
+
+	elif cli_frame not in FRAMES and not os.path.isfile(cli_frame):
+		logger.critical('Frame must be one of %s or a frame description file', ', '.join(sorted(FRAMES)))
+		sys.exit(2)
+
+	elif cli_replay_file is not None and cli_fifo:
+		logger.critical('Replay reads the captured samples from the data registers, not the FIFO')
+		sys.exit(2)
+
+	elif cli_i2c not in ('smbus', 'rdwr'):
+		logger.critical('I2C must be smbus or rdwr')
+		sys.exit(2)
+
+	elif cli_gpio not in ('rpio', 'chardev'):
+		logger.critical('GPIO must be rpio or chardev')
+		sys.exit(2)
+
+	elif cli_replay_file is not None and cli_gpio == 'chardev':
+		logger.critical('Replay takes time_now from the capture, not from data ready edge time stamps')
+		sys.exit(2)
+
+	elif cli_replay_file is not None and not os.path.isfile(cli_replay_file):
+		logger.critical('Replay file %s does not exist', cli_replay_file)
+		sys.exit(2)
+
+	elif cli_coefficients_file is not None and not os.path.isfile(cli_coefficients_file):
+		logger.critical('Coefficients file %s does not exist', cli_coefficients_file)
+		sys.exit(2)
+
+	elif cli_deadline not in DEADLINE_POLICIES:
+		logger.critical('Deadline policy must be catchup, skip or coalesce')
+		sys.exit(2)
+
+	elif cli_rt_cpu is not None and (cli_rt_cpu < 0 or cli_rt_cpu >= CPUCount()):
+		logger.critical('RT CPU must lie in the range 0 to %d', CPUCount() - 1)
+		sys.exit(2)
+
+	elif cli_replay_file is not None and cli_acquire:
+		logger.critical('Replay runs on a virtual clock, so there are no samples for an acquisition process to miss')
+		sys.exit(2)
+
+	elif not cli_calibrate_sensors and not cli_fly and cli_test_case == 0:
 		logger.critical('Must specify one of -f, -c or --tc')
 		sys.exit(2)
 
@@ -1073,8 +2175,13 @@ def CheckCLI(argv):
 		logger.critical('You must choose a specific hover speed (-h) for all test cases.')
 		sys.exit(2)
 
+	#---------------------------------------------------------------------------------------
+	# Without --coefficients, use the default file once qcfit.py has written one
+	#---------------------------------------------------------------------------------------
+	if cli_coefficients_file is None and os.path.isfile(COEFFICIENTS_FILE):
+		cli_coefficients_file = COEFFICIENTS_FILE
 
-	return cli_calibrate_sensors, cli_fly, cli_hover_target, cli_video, cli_vvp_gain, cli_vvi_gain, cli_vvd_gain, cli_hvp_gain, cli_hvi_gain, cli_hvd_gain, cli_prp_gain, cli_pri_gain, cli_prd_gain, cli_rrp_gain, cli_rri_gain, cli_rrd_gain, cli_test_case, cli_tau, cli_dlpf, cli_jitter, cli_motion_frequency, cli_rtf_period, cli_diagnostics
+	return CLIOptions(cli_calibrate_sensors, cli_fly, cli_hover_target, cli_video, cli_vvp_gain, cli_vvi_gain, cli_vvd_gain, cli_hvp_gain, cli_hvi_gain, cli_hvd_gain, cli_prp_gain, cli_pri_gain, cli_prd_gain, cli_rrp_gain, cli_rri_gain, cli_rrd_gain, cli_test_case, cli_tau, cli_dlpf, cli_jitter, cli_motion_frequency, cli_rtf_period, cli_diagnostics, cli_fifo, cli_backend, cli_capture_file, cli_replay_file, cli_attitude, cli_kalman, cli_frame, cli_acquire, cli_rt_cpu, cli_trace_file, cli_deadline, cli_coefficients_file, cli_calibration_file, cli_i2c, cli_gpio)
 
 ############################################################################################
 #
@@ -1099,10 +2206,30 @@ def CountdownBeep(num_beeps):
 # Shutdown triggered by early Ctrl-C or end of script
 #
 ############################################################################################
+############################################################################################
+#
+# State main() shares with CleanShutdown() and SignalHandler(), bound here so that a failure
+# early in main() still shuts down cleanly
+#
+############################################################################################
+esc_list = []
+shoot_video = False
+video = None
+recorder = None
+capture = None
+trace_recorder = None
+mpu6050 = None
+keep_looping = False
+loop_count = 0
+
 def CleanShutdown():
 	global esc_list
 	global shoot_video
 	global video
+	global recorder
+	global capture
+	global trace_recorder
+	global mpu6050
 
 	#-----------------------------------------------------------------------------------
 	# Stop the signal handler
@@ -1113,7 +2240,7 @@ def CleanShutdown():
 	# Time for teddy bye byes
 	#-----------------------------------------------------------------------------------
 	for esc in esc_list:
-		logger.info('Stop blade %d spinning', esc_index)
+		logger.info('Stop blade %s spinning', esc.name)
 		esc.update(0)
 
 	#-----------------------------------------------------------------------------------
@@ -1122,18 +2249,45 @@ def CleanShutdown():
 	if shoot_video:
 		video.send_signal(signal.SIGINT)
 
+	#-----------------------------------------------------------------------------------
+	# Drain the flight recorder to file
+	#-----------------------------------------------------------------------------------
+	if recorder is not None:
+		recorder.stop()
+		if recorder.getOverruns() > 0:
+			logger.critical("flight recorder %d overruns", recorder.getOverruns())
+
+	#-----------------------------------------------------------------------------------
+	# Stop the sensor acquisition process before the capture it feeds
+	#-----------------------------------------------------------------------------------
+	if mpu6050 is not None:
+		mpu6050.stopAcquisition()
+
+	if capture is not None:
+		capture.stop()
+		if capture.getOverruns() > 0:
+			logger.critical("sensor capture %d overruns", capture.getOverruns())
+
+	if trace_recorder is not None:
+		trace_recorder.stop()
+		if trace_recorder.getOverruns() > 0:
+			logger.critical("latency trace %d overruns", trace_recorder.getOverruns())
+
 	#-----------------------------------------------------------------------------------
 	# Copy logs from /dev/shm (shared / virtual memory) to the Logs directory.
 	#-----------------------------------------------------------------------------------
 	now = datetime.now()
 	now_string = now.strftime("%y%m%d-%H:%M:%S")
 	log_file_name = "qcstats" + now_string + ".csv"
-	shutil.move("/dev/shm/qclogs", log_file_name)
+	if os.path.isfile("/dev/shm/qclogs"):
+		shutil.move("/dev/shm/qclogs", log_file_name)
 
 	#-----------------------------------------------------------------------------------
 	# Clean up PWM / GPIO
 	#-----------------------------------------------------------------------------------
 	RpioCleanup()
+	if hardware is not None:
+		logger.critical("%s", hardware.summary())
 
 	#-----------------------------------------------------------------------------------
 	# Unlock memory we've used from RAM
@@ -1160,6 +2314,61 @@ def SignalHandler(signal, frame):
 	else:
 		CleanShutdown()
 
+############################################################################################
+#
+# Motion tick deadlines: a tick is due once a motion period has passed since the last one was
+# scheduled.  If it runs more than MOTION_LATE_TOLERANCE after that it's late, and any further
+# whole periods it has overrun are deadlines missed.  What happens next depends on the policy:
+#
+# - catchup:  the next deadline is one period after this one, so the missed ticks run back to
+#             back on the following samples, each with a tiny integration period.  They were
+#             counted with the tick that overran, so aren't counted late or missed again.
+# - skip:     the missed ticks are dropped and the next deadline is the next one on the original
+#             schedule
+# - coalesce: this tick covers the whole overrun and the schedule restarts from now
+#
+############################################################################################
+MOTION_LATE_TOLERANCE = 0.002
+DEADLINE_POLICIES = ('catchup', 'skip', 'coalesce')
+
+class MotionDeadline:
+
+	def __init__(self, policy, time_now):
+		self.policy = policy
+		self.last_update = time_now
+		self.late = 0
+		self.missed = 0
+		self.catchup_ticks = 0
+
+
+	def due(self, time_now, motion_period):
+		return time_now - self.last_update >= motion_period
+
+
+	def advance(self, time_now, motion_period):
+		if self.catchup_ticks > 0:
+			self.catchup_ticks -= 1
+			self.last_update += motion_period
+			return
+
+		lateness = time_now - self.last_update - motion_period
+		if lateness > MOTION_LATE_TOLERANCE:
+			self.late += 1
+
+		overrun = int(lateness / motion_period)
+		self.missed += overrun
+		if self.policy == 'catchup':
+			self.catchup_ticks = overrun
+			self.last_update += motion_period
+		elif self.policy == 'skip':
+			self.last_update += (overrun + 1) * motion_period
+		else:
+			self.last_update = time_now
+
+
+	def getCounts(self):
+		return self.late, self.missed
+
 ############################################################################################
 #
 # Flight plan management
@@ -1210,29 +2419,15 @@ class FlightPlan:
 
 ############################################################################################
 #
-# Main
+# Global constants, logging and memory locking shared by the classes above and main below
 #
 ############################################################################################
 
 #-------------------------------------------------------------------------------------------
-# Lock code permanently in memory - no swapping to disk
+# Set up the base logging
 #-------------------------------------------------------------------------------------------
-MCL_CURRENT = 1
-MCL_FUTURE  = 2
-def mlockall(flags = MCL_CURRENT| MCL_FUTURE):
-	result = libc.mlockall(flags)
-	if result != 0:
-		raise Exception("cannot lock memmory, errno=%s" % ctypes.get_errno())
-
-def munlockall():
-	result = libc.munlockall()
-	if result != 0:
-		raise Exception("cannot lock memmory, errno=%s" % ctypes.get_errno())
-
-
-libc_name = ctypes.util.find_library("c")
-libc = ctypes.CDLL(libc_name, use_errno=True)
-mlockall()
+logger = logging.getLogger('QC logger')
+logger.setLevel(logging.INFO)
 
 #-------------------------------------------------------------------------------------------
 # Set the BCM output / intput assigned to LED and sensor interrupt respectively
@@ -1241,49 +2436,6 @@ RPIO_DMA_CHANNEL = 1
 RPIO_STATUS_SOUNDER = 27
 RPIO_DATA_READY_INTERRUPT = 25
 
-#-------------------------------------------------------------------------------------------
-# Set up the base logging
-#-------------------------------------------------------------------------------------------
-logger = logging.getLogger('QC logger')
-logger.setLevel(logging.INFO)
-
-#-------------------------------------------------------------------------------------------
-# Create file and console logger handlers
-#-------------------------------------------------------------------------------------------
-file_handler = logging.FileHandler("/dev/shm/qclogs", 'w')
-file_handler.setLevel(logging.WARNING)
-
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.CRITICAL)
-
-#-------------------------------------------------------------------------------------------
-# Create a formatter and add it to both handlers
-#-------------------------------------------------------------------------------------------
-console_formatter = logging.Formatter('%(message)s')
-console_handler.setFormatter(console_formatter)
-
-file_formatter = logging.Formatter('[%(levelname)s] (%(threadName)-10s) %(funcName)s %(lineno)d, %(message)s')
-file_handler.setFormatter(file_formatter)
-
-#-------------------------------------------------------------------------------------------
-# Add both handlers to the logger
-#-------------------------------------------------------------------------------------------
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
-
-#-------------------------------------------------------------------------------------------
-# Check the command line for calibration or flight parameters
-#-------------------------------------------------------------------------------------------
-calibrate_sensors, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, test_case, tau, dlpf, jitter, motion_frequency, rtf_period, diagnostics = CheckCLI(sys.argv[1:])
-logger.warning("calibrate_sensors = %s, fly = %s, hover_target = %d, shoot_video = %s, vvp_gain = %f, vvi_gain = %f, vvd_gain= %f, hvp_gain = %f, hvi_gain = %f, hvd_gain = %f, prp_gain = %f, pri_gain = %f, prd_gain = %f, rrp_gain = %f, rri_gain = %f, rrd_gain = %f, test_case = %d, tau = %f, dlpf = %d, jitter = %d, motion_frequency = %f, rtf_period = %f, diagnostics = %s", calibrate_sensors, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, test_case, tau, dlpf, jitter, motion_frequency, rtf_period, diagnostics)
-
-#-------------------------------------------------------------------------------------------
-# Initialize the motion processing period and jitter
-#-------------------------------------------------------------------------------------------
-motion_period = 1 / motion_frequency
-if jitter != 0:
-	motion_period *= (1 + random.uniform(-jitter, +jitter) / 100)
-
 #-------------------------------------------------------------------------------------------
 # Set up the global constants
 # - gravity in meters per second squared
@@ -1294,621 +2446,1061 @@ GRAV_ACCEL = 9.80665
 SCALE_GYRO = 500.0 * math.pi / (65536 * 180)
 SCALE_ACCEL = 4.0 / 65536
 
-
 #-------------------------------------------------------------------------------------------
-# Enable RPIO for beeper, MPU 6050 interrupts and PWM
-#-------------------------------------------------------------------------------------------
-RpioSetup()
-
-#-------------------------------------------------------------------------------------------
-# Set up the ESC to GPIO pin and location mappings and assign to each ESC
+# Set up the ESC to GPIO pin and location mappings
 #-------------------------------------------------------------------------------------------
 ESC_BCM_BL = 22
 ESC_BCM_FL = 17
 ESC_BCM_FR = 18
 ESC_BCM_BR = 23
 
-MOTOR_LOCATION_FRONT = 0b00000001
-MOTOR_LOCATION_BACK =  0b00000010
-MOTOR_LOCATION_LEFT =  0b00000100
-MOTOR_LOCATION_RIGHT = 0b00001000
+ESC_BCM_5 = 5
+ESC_BCM_6 = 6
+ESC_BCM_12 = 12
+ESC_BCM_13 = 13
 
 MOTOR_ROTATION_CW = 1
 MOTOR_ROTATION_ACW = 2
 
-pin_list = [ESC_BCM_FL, ESC_BCM_FR, ESC_BCM_BL, ESC_BCM_BR]
-location_list = [MOTOR_LOCATION_FRONT | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_FRONT | MOTOR_LOCATION_RIGHT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_RIGHT]
-rotation_list = [MOTOR_ROTATION_ACW, MOTOR_ROTATION_CW, MOTOR_ROTATION_CW, MOTOR_ROTATION_ACW]
-name_list = ['front left', 'front right', 'back left', 'back right']
-
 #-------------------------------------------------------------------------------------------
-# Prime the ESCs with the default 0 spin rotors to shut them up.
+# The built in frames.  The first four motors are the ones the diagnostics record, so the quad
+# X order matches the FL, FR, BL, BR spin columns.
 #-------------------------------------------------------------------------------------------
-esc_list = []
-for esc_index in range(0, 4):
-	esc = ESC(pin_list[esc_index], location_list[esc_index], rotation_list[esc_index], name_list[esc_index])
-	esc_list.append(esc)
+FRAMES = {
+	'quadx': [('front left', ESC_BCM_FL, -45, MOTOR_ROTATION_ACW),
+		('front right', ESC_BCM_FR, 45, MOTOR_ROTATION_CW),
+		('back left', ESC_BCM_BL, -135, MOTOR_ROTATION_CW),
+		('back right', ESC_BCM_BR, 135, MOTOR_ROTATION_ACW)],
 
-#-------------------------------------------------------------------------------------------
-# Initialize the gyroscope / accelerometer I2C object
-#-------------------------------------------------------------------------------------------
-mpu6050 = MPU6050(0x68, dlpf)
+	'quad+': [('front', ESC_BCM_FL, 0, MOTOR_ROTATION_ACW),
+		('right', ESC_BCM_FR, 90, MOTOR_ROTATION_CW),
+		('left', ESC_BCM_BL, -90, MOTOR_ROTATION_CW),
+		('back', ESC_BCM_BR, 180, MOTOR_ROTATION_ACW)],
 
-#-------------------------------------------------------------------------------------------
-# Countdown: 5 beeps prior to gyro calibration
-#-------------------------------------------------------------------------------------------
-CountdownBeep(5)
-
-#-------------------------------------------------------------------------------------------
-# Calibrate the sensors to build a trend line for sensor offsets against temperature
-#-------------------------------------------------------------------------------------------
-if calibrate_sensors:
-	mpu6050.calibrateGravity("./qcoffsets.csv")
-	sys.exit(0)
-
-#-------------------------------------------------------------------------------------------
-# Calibrate gyros - this is a one-off
-#-------------------------------------------------------------------------------------------
-mpu6050.calibrateGyros()
+	'hexa': [('front left', ESC_BCM_FL, -30, MOTOR_ROTATION_ACW),
+		('front right', ESC_BCM_FR, 30, MOTOR_ROTATION_CW),
+		('back left', ESC_BCM_BL, -150, MOTOR_ROTATION_ACW),
+		('back right', ESC_BCM_BR, 150, MOTOR_ROTATION_CW),
+		('right', ESC_BCM_5, 90, MOTOR_ROTATION_ACW),
+		('left', ESC_BCM_6, -90, MOTOR_ROTATION_CW)],
 
-#-------------------------------------------------------------------------------------------
-# Countdown: 4 beeps prior calculating take-off platform tilt
-#-------------------------------------------------------------------------------------------
-CountdownBeep(4)
+	'octo': [('front left', ESC_BCM_FL, -22.5, MOTOR_ROTATION_ACW),
+		('front right', ESC_BCM_FR, 22.5, MOTOR_ROTATION_CW),
+		('back left', ESC_BCM_BL, -157.5, MOTOR_ROTATION_CW),
+		('back right', ESC_BCM_BR, 157.5, MOTOR_ROTATION_ACW),
+		('right front', ESC_BCM_5, 67.5, MOTOR_ROTATION_ACW),
+		('right back', ESC_BCM_6, 112.5, MOTOR_ROTATION_CW),
+		('left back', ESC_BCM_12, -112.5, MOTOR_ROTATION_ACW),
+		('left front', ESC_BCM_13, -67.5, MOTOR_ROTATION_CW)],
+}
 
 #-------------------------------------------------------------------------------------------
-# Measure average gravity distribution across the quadframe
+# Lock code permanently in memory - no swapping to disk
 #-------------------------------------------------------------------------------------------
-qax_integrated = 0.0
-qay_integrated = 0.0
-qaz_integrated = 0.0
-
-prev_qax, prev_qay, prev_qaz, prev_qgx, prev_qgy, prev_qgz = mpu6050.readSensors()
-prev_time_now = time_now
-integration_start = time_now
-
-loop_count = 0
-while loop_count != 1000:
-	qax, qay, qaz, qgx, qgy, qgz = mpu6050.readSensors()
-
-	loop_count += 1
-	delta_time = time_now - prev_time_now
-	prev_time_now = time_now
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+def mlockall(flags = MCL_CURRENT| MCL_FUTURE):
+	result = Libc().mlockall(flags)
+	if result != 0:
+		raise Exception("cannot lock memmory, errno=%s" % ctypes.get_errno())
 
-	qax_integrated += (qax + prev_qax) * delta_time
-	qay_integrated += (qay + prev_qay) * delta_time
-	qaz_integrated += (qaz + prev_qaz) * delta_time
+def munlockall():
+	result = Libc().munlockall()
+	if result != 0:
+		raise Exception("cannot lock memmory, errno=%s" % ctypes.get_errno())
 
-	prev_qax = qax
-	prev_qay = qay
-	prev_qaz = qaz
 
 #-------------------------------------------------------------------------------------------
-# Work out the average acceleration due to gravity
-# Save off the quad-frame raw gravity vector
+# Real-time scheduling: pin a thread (0 for the calling one) or process to a set of CPUs, and
+# run it under SCHED_FIFO so nothing below real-time priority preempts it
 #-------------------------------------------------------------------------------------------
-integration_period = time_now - integration_start
-qfrgv_x = qax_integrated * SCALE_ACCEL / (2 * integration_period)
-qfrgv_y = qay_integrated * SCALE_ACCEL / (2 * integration_period)
-qfrgv_z = qaz_integrated * SCALE_ACCEL / (2 * integration_period)
+SCHED_FIFO = 1
+RT_PRIORITY = 50
 
-#-------------------------------------------------------------------------------------------
-# Get the take-off platform slope
-#-------------------------------------------------------------------------------------------
-qfrgv_pitch, qfrgv_roll, qfrgv_tilt = GetEulerAngles(qfrgv_x, qfrgv_y, qfrgv_z)
+class sched_param(ctypes.Structure):
+	_fields_ = [('sched_priority', ctypes.c_int)]
 
-#-------------------------------------------------------------------------------------------
-# Now measure gravity in earth axes according to the sensors
-#-------------------------------------------------------------------------------------------
-efrgv_x, efrgv_y, efrgv_z = Q2EFrame(qfrgv_x, qfrgv_y, qfrgv_z, qfrgv_pitch, qfrgv_roll, 0.0, qfrgv_tilt)
+def CPUCount():
+	return os.sysconf('SC_NPROCESSORS_ONLN')
 
-#-------------------------------------------------------------------------------------------
-# Initialize complementary filter angles
-#-------------------------------------------------------------------------------------------
-prev_c_pitch = qfrgv_pitch
-prev_c_roll = qfrgv_roll
-i_pitch = qfrgv_pitch
-i_roll = qfrgv_roll
-i_yaw = 0.0
+def SetAffinity(cpus, pid=0):
+	mask = (ctypes.c_ulong * 16)()
+	mask_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+	for cpu in cpus:
+		mask[cpu // mask_bits] |= 1 << (cpu % mask_bits)
+	result = Libc().sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask))
+	if result != 0:
+		raise Exception("cannot set CPU affinity, errno=%s" % ctypes.get_errno())
 
-#-------------------------------------------------------------------------------------------
-# Cleanup integration variables
-#-------------------------------------------------------------------------------------------
-qax_integrated = 0.0
-qay_integrated = 0.0
-qaz_integrated = 0.0
+def SetScheduler(priority, pid=0):
+	param = sched_param(priority)
+	result = Libc().sched_setscheduler(pid, SCHED_FIFO, ctypes.byref(param))
+	if result != 0:
+		raise Exception("cannot set SCHED_FIFO, errno=%s" % ctypes.get_errno())
 
-qgx_integrated = 0.0
-qgy_integrated = 0.0
-qgz_integrated = 0.0
 
 #-------------------------------------------------------------------------------------------
-# Countdown: 3 beeps prior to setting up the interrupt handler
+# libc is only loaded when first needed: find_library() runs ldconfig, which is most of the
+# time it takes to import this module otherwise
 #-------------------------------------------------------------------------------------------
-CountdownBeep(3)
+libc = None
 
-#-------------------------------------------------------------------------------------------
-# Set the signal handler here so the core processing loop can be stopped (or not started) by
-# Ctrl-C.
-#---------------------------------------------------------------------------
-loop_count = 0
-signal.signal(signal.SIGINT, SignalHandler)
+def Libc():
+	global libc
+	if libc is None:
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+	return libc
 
-#-------------------------------------------------------------------------------------------
-# Countdown: 2 beeps prior to starting the video
-#-------------------------------------------------------------------------------------------
-CountdownBeep(2)
+############################################################################################
+#
+# Interval histogram: fixed width bins counted as the loop runs, with the last bin catching
+# everything longer, summarized at shutdown
+#
+############################################################################################
+class IntervalHistogram:
 
-#-------------------------------------------------------------------------------------------
-# Start up the video camera if required - this runs from take-off through to shutdown automatically.
-# Run it in its own process group so that Ctrl-C for QC doesn't get through and stop the video
-#-------------------------------------------------------------------------------------------
-def Daemonize():
-	os.setpgrp()
+	def __init__(self, name, bin_width, bins):
+		self.name = name
+		self.bin_width = bin_width
+		self.scale = 1 / bin_width
+		self.counts = [0] * bins
+		self.last_bin = bins - 1
+		self.min_interval = None
+		self.max_interval = 0.0
 
-if shoot_video:
-	now = datetime.now()
-	now_string = now.strftime("%y%m%d-%H:%M:%S")
-	video = subprocess.Popen(["raspivid", "-rot", "180", "-w", "1280", "-h", "720", "-o", "/home/pi/Videos/qcvid_" + now_string + ".h264", "-n", "-t", "0", "-fps", "30", "-b", "5000000"], preexec_fn =  Daemonize)
 
-#-------------------------------------------------------------------------------------------
-# Countdown: 1 beep to get those blades spinning
-#-------------------------------------------------------------------------------------------
-CountdownBeep(1)
+	def add(self, interval):
+		index = int(interval * self.scale)
+		if index > self.last_bin:
+			index = self.last_bin
+		self.counts[index] += 1
 
-#------------------------------------------------------------------------------------------
-# Set up the bits of state setup before takeoff
-#-------------------------------------------------------------------------------------------
-keep_looping = True
+		if interval > self.max_interval:
+			self.max_interval = interval
+		if self.min_interval is None or interval < self.min_interval:
+			self.min_interval = interval
 
-evx_target = 0.0
-evy_target = 0.0
-evz_target = 0.0
 
-qvx_input = 0.0
-qvy_input = 0.0
-qvz_input = 0.0
+	def percentile(self, fraction):
+		#-----------------------------------------------------------------------------------
+		# The upper edge of the bin the given fraction of intervals fall within
+		#-----------------------------------------------------------------------------------
+		limit = fraction * sum(self.counts)
+		count = 0
+		for index, bin_count in enumerate(self.counts):
+			count += bin_count
+			if count >= limit:
+				return (index + 1) * self.bin_width
+		return self.max_interval
 
-pr_target = 0.0
-rr_target = 0.0
-yr_target = 0.0
 
-ya_target = 0.0
+	def summary(self):
+		total = sum(self.counts)
+		if total == 0:
+			return "%s: none" % self.name
+		return "%s: %d, min %.3fms, 50%% < %.3fms, 99%% < %.3fms, max %.3fms" % (self.name, total, self.min_interval * 1000, self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, self.max_interval * 1000)
 
-qvx_diags = "0.0, 0.0, 0.0"
-qvy_diags = "0.0, 0.0, 0.0"
-qvz_diags = "0.0, 0.0, 0.0"
-pr_diags = "0.0, 0.0, 0.0"
-rr_diags = "0.0, 0.0, 0.0"
-yr_diags = "0.0, 0.0, 0.0"
 
-hover_speed = 0
-ready_to_fly = False
+	def bins(self):
+		return ', '.join("%.3fms %d" % ((index + 1) * self.bin_width * 1000, bin_count) for index, bin_count in enumerate(self.counts) if bin_count != 0)
 
-#-------------------------------------------------------------------------------------------
-# START TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn the right way
-#-------------------------------------------------------------------------------------------
-if test_case == 1:
-	for esc in esc_list:
-		for count in range(0, hover_target, 10):
-			#-------------------------------------------------------------------
-			# Spin up to user determined (-h) hover speeds ~200
-			#-------------------------------------------------------------------
-			esc.update(count)
-			time.sleep(0.01)
-		time.sleep(2.0)
-		esc.update(0)
-	CleanShutdown()
-#-------------------------------------------------------------------------------------------
-# END TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn the right way
-#-------------------------------------------------------------------------------------------
-
-#===========================================================================================
-# Tuning: Set up the PID gains - some are hard coded mathematical approximations, some come
-# from the CLI parameters to allow for tuning
-#===========================================================================================
-# A PID is a simple algorithm which takes a desired state of a system (the "target", perhaps from a remote control)
-# and the current state (the "input" or "feedback", perhaps from a sensor), subtracts them to determine the "error" in
-# the system, and applies some simple math(s) to come up with a corrective "output". It does this repeatedly with the aim
-# that the "error" reduces and is maintained at near zero due to the "feedback".
-#
-# This mechanism allows complex systems to be broken down and corrected even when a complete mathematical model of the
-# system is too complicated or external factors mean the system cannot be modelled directly.
-#
-# In a quadcopter, the external targets (those a user control for flight) are horizontal and vertical speed plus tilt.
-#
-# - Horizontal speed error is corrected by providing the as the horizontal acceleration target
-# - The horizontal acceleration target is converted to a required rotation rate
-# - Rotation rate error is corrected proportionally by providing the corrective output to the motors' ESCs
-#
-# - Horizontal speed feedback is provided by integrated accelerometer (or GPS in future)
-# - Angular speed feedback comes directly from the gyros
-#
-# That's 2 PIDs each for horizontal X & Y axes movement - 4 in total so far.
-#
-# - Vertical speed error is corrected proportionally by providing the corrective output to the motors' ESCs (cf. angular speed above)
-#
-# - Vertical speed feedback comes from the Z-axis accelerometer integrated over time, and compensated for any tilt (cos(theta)cos(phi))
-#
-# That's 1 PID for vertical Z axis speed control.
-#
-# - Yaw speed error is corrected proportionally by providing the corrective output to the motors' ESCs
-#
-# - Yaw speed feedback comes directly from the Z-axis gyro
+############################################################################################
 #
-# That's 2 PID for Z axis yaw control.
+# Per-stage latency tracing with --trace: each probe stamps the time one stage of a loop
+# iteration finished, and at the end of the iteration the stamps go to the trace recorder as
+# one record, for qctrace.py to turn into a Chrome / Perfetto trace.  That's all the loop pays
+# for; the per-stage histograms are built from the recording once the flight is over.  Stages
+# that didn't run in an iteration - the motion processing on most samples, the edge wait and
+# I2C read for all but the first of a FIFO batch - have no stamp.
 #
-# So 7 PIDs in total
-#===========================================================================================
-
-#-------------------------------------------------------------------------------------------
-# The earth X axis speed controls forward / backward speed
-#-------------------------------------------------------------------------------------------
-PID_QVX_P_GAIN = hvp_gain
-PID_QVX_I_GAIN = hvi_gain
-PID_QVX_D_GAIN = hvd_gain	
-
-#-------------------------------------------------------------------------------------------
-# The earth Y axis speed controls left / right speed
-#-------------------------------------------------------------------------------------------
-PID_QVY_P_GAIN = hvp_gain
-PID_QVY_I_GAIN = hvi_gain
-PID_QVY_D_GAIN = hvd_gain	
-
-#-------------------------------------------------------------------------------------------
-# The earth Z axis speed controls rise / fall speed
-#-------------------------------------------------------------------------------------------
-PID_QVZ_P_GAIN = vvp_gain
-PID_QVZ_I_GAIN = vvi_gain
-PID_QVZ_D_GAIN = vvd_gain
-
-#-------------------------------------------------------------------------------------------
-# The YAW ANGLE PID maintains a stable rotation angle about the Z-axis
-#-------------------------------------------------------------------------------------------
-PID_YA_P_GAIN = 6.0
-PID_YA_I_GAIN = 3.0
-PID_YA_D_GAIN = 1.0
-
-#-------------------------------------------------------------------------------------------
-# The PITCH RATE PID controls stable rotation rate around the Y-axis
-#-------------------------------------------------------------------------------------------
-PID_PR_P_GAIN = prp_gain
-PID_PR_I_GAIN = pri_gain
-PID_PR_D_GAIN = prd_gain
-
-#-------------------------------------------------------------------------------------------
-# The ROLL RATE PID controls stable rotation rate around the X-axis
-#-------------------------------------------------------------------------------------------
-PID_RR_P_GAIN = rrp_gain
-PID_RR_I_GAIN = rri_gain
-PID_RR_D_GAIN = rrd_gain
-
-#-------------------------------------------------------------------------------------------
-# The YAW RATE PID controls stable rotation speed around the Z-axis
-#-------------------------------------------------------------------------------------------
-PID_YR_P_GAIN = rrp_gain / 2.0
-PID_YR_I_GAIN = rri_gain / 2.0
-PID_YR_D_GAIN = rrd_gain / 2.0
+############################################################################################
+TRACE_EDGE = 0
+TRACE_I2C = 1
+TRACE_DECODE = 2
+TRACE_INTEGRATE = 3
+TRACE_ESTIMATE = 4
+TRACE_PIDS = 5
+TRACE_PWM = 6
 
-logger.critical('Thunderbirds are go!')
+class StageTracer:
 
-#-------------------------------------------------------------------------------------------
-# Diagnostic log header
-#-------------------------------------------------------------------------------------------
-if diagnostics:
-	logger.warning('time, dt, loop, qgx, qgy, qgz, efrgv_x, efrgv_y, efrgv_z, qax, qay, qaz, qfrgv_x, qfrgv_y, qfrgv_z, qvx_input, qvy_input, qvz_input, i pitch, i roll, e pitch, e roll, c pitch, c roll, i yaw, e tilt, evx_target, qvx_target, qxp, qxi, qxd, pr_target, prp, pri, prd, pr_out, evy_yarget, qvy_target, qyp, qyi, qyd, rr_target, rrp, rri, rrd, rr_out, evz_target, qvz_target, qzp, qzi, qzd, qvz_out, yr_target, yrp, yri, yrd, yr_out, FL spin, FR spin, BL spin, BR spin')
+	def __init__(self, recorder):
+		self.recorder = recorder
+		self.stage_count = len(qcrecorder.TRACE_FIELDS)
+		self.stamps = [0.0] * self.stage_count
+		self.unstamped = [0.0] * self.stage_count
 
-#==========================================================================================
-# Initialize critical timing immediately before starting the PIDs.  This is done by reading
-# the sensors, and that also gives us a starting position to integrated from.
-#==========================================================================================
-prev_qax, prev_qay, prev_qaz, prev_qgx, prev_qgy, prev_qgz = mpu6050.readSensors()
 
-#-------------------------------------------------------------------------------------------
-# Start the yaw absolute angle PID
-#-------------------------------------------------------------------------------------------
-ya_pid = PID(PID_YA_P_GAIN, PID_YA_I_GAIN, PID_YA_D_GAIN, time_now)
+	def probe(self, stage):
+		self.stamps[stage] = time.time()
 
-#-------------------------------------------------------------------------------------------
-# Start the pitch, roll and yaw rate PIDs
-#-------------------------------------------------------------------------------------------
-pr_pid = PID(PID_PR_P_GAIN, PID_PR_I_GAIN, PID_PR_D_GAIN, time_now)
-rr_pid = PID(PID_RR_P_GAIN, PID_RR_I_GAIN, PID_RR_D_GAIN, time_now)
-yr_pid = PID(PID_YR_P_GAIN, PID_YR_I_GAIN, PID_YR_D_GAIN, time_now)
 
-#-------------------------------------------------------------------------------------------
-# Start the X, Y (horizontal) and Z (vertical) velocity PIDs
-#-------------------------------------------------------------------------------------------
-qvx_pid = PID(PID_QVX_P_GAIN, PID_QVX_I_GAIN, PID_QVX_D_GAIN, time_now)
-qvy_pid = PID(PID_QVY_P_GAIN, PID_QVY_I_GAIN, PID_QVY_D_GAIN, time_now)
-qvz_pid = PID(PID_QVZ_P_GAIN, PID_QVZ_I_GAIN, PID_QVZ_D_GAIN, time_now)
-
-start_time = time_now
-elapsed_time = 0.0
-last_motion_update = time_now
-integration_start = time_now
+	def commit(self):
+		self.recorder.record(*self.stamps)
+		self.stamps[:] = self.unstamped
 
-while keep_looping:
-	#===================================================================================
-	# Sensors: Read the sensor values; note that this also sets the time_now to be as
-	# accurate a time stamp for the sensor data as possible.
-	#===================================================================================
-	qax, qay, qaz, qgx, qgy, qgz = mpu6050.readSensors()
 
+def StageHistograms(records):
 	#-----------------------------------------------------------------------------------
-	# Now we have the sensor snapshot, tidy up the rest of the variable so that processing
-	# takes zero time.
+	# A histogram for each stage after the first, named by the probe ending it, of the gap
+	# since the stage before, plus the whole run from data ready edge to ESC pulse
 	#-----------------------------------------------------------------------------------
-	delta_time = time_now - start_time - elapsed_time
-	elapsed_time = time_now - start_time
-	loop_count += 1
-
-	#===================================================================================
-	# Integration: Sensor data is integrated over time, and later averaged to produce
-	# smoother yet still accurate acceleration and rotation since the last PID updates.
-	#===================================================================================
-	qgx_integrated += (prev_qgx + qgx) * delta_time
-	qgy_integrated += (prev_qgy + qgy) * delta_time
-	qgz_integrated += (prev_qgz + qgz) * delta_time
+	histograms = [IntervalHistogram(column + " stage", 0.000002, 5000) for column, code, csv_format, degrees in qcrecorder.TRACE_FIELDS[1:]]
+	edge_to_pwm = IntervalHistogram("edge to pwm", 0.00001, 5000)
 
-	prev_qgx = qgx
-	prev_qgy = qgy
-	prev_qgz = qgz
+	for stamps in records:
+		for stage in range(1, len(stamps)):
+			if stamps[stage] != 0.0 and stamps[stage - 1] != 0.0:
+				histograms[stage - 1].add(stamps[stage] - stamps[stage - 1])
 
-	qax_integrated += (prev_qax + qax) * delta_time
-	qay_integrated += (prev_qay + qay) * delta_time
-	qaz_integrated += (prev_qaz + qaz) * delta_time
+		if stamps[TRACE_PWM] != 0.0 and stamps[TRACE_EDGE] != 0.0:
+			edge_to_pwm.add(stamps[TRACE_PWM] - stamps[TRACE_EDGE])
 
-	prev_qax = qax
-	prev_qay = qay
-	prev_qaz = qaz
+	return histograms + [edge_to_pwm]
 
-	#===================================================================================
-	# Motion Processing:  Use the recorded data to produce motion data and feed in the motion PIDs
-	#===================================================================================
-	if time_now - last_motion_update >= motion_period:
-		last_motion_update += motion_period
+############################################################################################
+#
+# Startup timing: how long each phase from the start of the import to take-off took, on the
+# wall clock even when replay swaps in the virtual one
+#
+############################################################################################
+class StartupPhases:
 
-		#----------------------------------------------------------------------------------
-		# Work out the average acceleration and rotation rate
-		#----------------------------------------------------------------------------------
-		integration_period = time_now - integration_start
-		integration_start = time_now
+	def __init__(self, start):
+		self.clock = time.time
+		self.start = start
+		self.last = start
+		self.phases = []
 
-		#----------------------------------------------------------------------------------
-		# Sort out units and the double accounting in integration.
-		#----------------------------------------------------------------------------------
-		qgx_integrated *= SCALE_GYRO / 2
-		qgy_integrated *= SCALE_GYRO / 2
-		qgz_integrated *= SCALE_GYRO / 2
-
-		qax_integrated *= SCALE_ACCEL / 2
-		qay_integrated *= SCALE_ACCEL / 2
-		qaz_integrated *= SCALE_ACCEL / 2
-
-		#----------------------------------------------------------------------------------
-		# Convert the integrated gyroscope reading back to an averaged gyroscope reading
-		#----------------------------------------------------------------------------------
-		qgx = qgx_integrated / integration_period
-		qgy = qgy_integrated / integration_period
-		qgz = qgz_integrated / integration_period
-
-		#----------------------------------------------------------------------------------
-		# Convert the integrate accelerometer reading back to an averaged accelerometer reading
-		#----------------------------------------------------------------------------------
-		qax = qax_integrated / integration_period
-		qay = qay_integrated / integration_period
-		qaz = qaz_integrated / integration_period
 
-		#===================================================================================
-		# Angles: Get angles in radians
-		#===================================================================================
-		e_pitch, e_roll, e_tilt = GetEulerAngles(qax, qay, qaz)
+	def mark(self, name):
+		now = self.clock()
+		self.phases.append((name, now - self.last))
+		self.last = now
 
-		i_pitch += qgy_integrated
-		i_roll += qgx_integrated
-		i_yaw += qgz_integrated
 
-		#-----------------------------------------------------------------------------------
-		# Apply complementary filter to ensure long-term accuracy of pitch / roll angles
-		# 1/tau is the handover frequency that the integrated gyro high pass filter is taken over
-		# by the accelerometer Euler low-pass filter providing fast reaction to change from the
-		# gyro yet with low noise accurate Euler angles from the acclerometer.
-		#
-		# The combination of tau plus the time increment provides a fraction to mix
-		# the two angles sources.
-		#-----------------------------------------------------------------------------------
-		tau_fraction = tau / (tau + integration_period)
+	def summary(self):
+		return 'startup %.3fs: %s' % (self.last - self.start, ', '.join('%s %.3fs' % phase for phase in self.phases))
 
-		c_pitch = tau_fraction * (prev_c_pitch + qgy_integrated) + (1 - tau_fraction) * e_pitch
-		prev_c_pitch = c_pitch
+############################################################################################
+#
+# Main: nothing above here touches the hardware or the command line, so the module can be
+# imported by tools; flying is started by calling this
+#
+############################################################################################
+def main(argv):
+	global esc_list
+	global shoot_video
+	global video
+	global recorder
+	global capture
+	global trace_recorder
+	global mpu6050
+	global keep_looping
+	global loop_count
+
+	startup = StartupPhases(IMPORT_START)
+	startup.mark('import')
+
+	#-------------------------------------------------------------------------------------------
+	# Create file and console logger handlers
+	#-------------------------------------------------------------------------------------------
+	file_handler = logging.FileHandler("/dev/shm/qclogs", 'w')
+	file_handler.setLevel(logging.WARNING)
+
+	console_handler = logging.StreamHandler()
+	console_handler.setLevel(logging.CRITICAL)
+
+	#-------------------------------------------------------------------------------------------
+	# Create a formatter and add it to both handlers
+	#-------------------------------------------------------------------------------------------
+	console_formatter = logging.Formatter('%(message)s')
+	console_handler.setFormatter(console_formatter)
+
+	file_formatter = logging.Formatter('[%(levelname)s] (%(threadName)-10s) %(funcName)s %(lineno)d, %(message)s')
+	file_handler.setFormatter(file_formatter)
+
+	#-------------------------------------------------------------------------------------------
+	# Add both handlers to the logger
+	#-------------------------------------------------------------------------------------------
+	logger.addHandler(console_handler)
+	logger.addHandler(file_handler)
+
+	#-------------------------------------------------------------------------------------------
+	# Check the command line for calibration or flight parameters
+	#-------------------------------------------------------------------------------------------
+	calibrate_sensors, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, test_case, tau, dlpf, jitter, motion_frequency, rtf_period, diagnostics, fifo, backend, capture_file, replay_file, attitude, kalman, frame_name, acquire, rt_cpu, trace_file, deadline_policy, coefficients_file, calibration_file, i2c, gpio = CheckCLI(argv)
+	logger.warning("calibrate_sensors = %s, fly = %s, hover_target = %d, shoot_video = %s, vvp_gain = %f, vvi_gain = %f, vvd_gain= %f, hvp_gain = %f, hvi_gain = %f, hvd_gain = %f, prp_gain = %f, pri_gain = %f, prd_gain = %f, rrp_gain = %f, rri_gain = %f, rrd_gain = %f, test_case = %d, tau = %f, dlpf = %d, jitter = %d, motion_frequency = %f, rtf_period = %f, diagnostics = %s, fifo = %s, backend = %s, capture_file = %s, replay_file = %s, attitude = %s, kalman = %s, frame = %s, acquire = %s, rt_cpu = %s, trace_file = %s, deadline_policy = %s, coefficients_file = %s, calibration_file = %s, i2c = %s, gpio = %s", calibrate_sensors, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, test_case, tau, dlpf, jitter, motion_frequency, rtf_period, diagnostics, fifo, backend, capture_file, replay_file, attitude, kalman, frame_name, acquire, rt_cpu, trace_file, deadline_policy, coefficients_file, calibration_file, i2c, gpio)
+
+	#-------------------------------------------------------------------------------------------
+	# Select the hardware backend.  Only the real hardware needs the code locking into RAM; a
+	# simulator on a desktop box usually lacks the privileges to do so.
+	#-------------------------------------------------------------------------------------------
+	SetBackend(backend, replay_file, i2c, gpio)
+	try:
+		frame = LoadFrame(frame_name)
+	except ValueError as err:
+		logger.critical('%s', err)
+		sys.exit(2)
+	if backend == 'pi':
+		mlockall()
+	startup.mark('backend')
+
+	#-------------------------------------------------------------------------------------------
+	# In RT mode, keep everything off the flight loop's CPU: threads and processes started from
+	# here on inherit this affinity, and the flight loop moves itself across at take-off.  With
+	# a single CPU there's nowhere else to go.
+	#-------------------------------------------------------------------------------------------
+	if rt_cpu is not None:
+		housekeeping_cpus = [cpu for cpu in range(0, CPUCount()) if cpu != rt_cpu]
+		if len(housekeeping_cpus) != 0:
+			SetAffinity(housekeeping_cpus)
+
+	#-------------------------------------------------------------------------------------------
+	# The flight recorder is only started later for diagnostics, the sensor capture once the
+	# MPU6050 is up
+	#-------------------------------------------------------------------------------------------
+	recorder = None
+	capture = None
+	trace_recorder = None
+	mpu6050 = None
+
+	#-------------------------------------------------------------------------------------------
+	# Initialize the motion processing period and jitter
+	#-------------------------------------------------------------------------------------------
+	motion_period = 1 / motion_frequency
+	if jitter != 0:
+		motion_period *= (1 + random.uniform(-jitter, +jitter) / 100)
+
+
+	#-------------------------------------------------------------------------------------------
+	# Enable RPIO for beeper, MPU 6050 interrupts and PWM
+	#-------------------------------------------------------------------------------------------
+	RpioSetup(gpio == 'rpio')
+
+
+	#-------------------------------------------------------------------------------------------
+	# Prime the ESCs with the default 0 spin rotors to shut them up.
+	#-------------------------------------------------------------------------------------------
+	esc_list = []
+	for name, pin, angle, rotation in frame:
+		esc = ESC(pin, name)
+		esc_list.append(esc)
+
+	mixer = Mixer(frame)
+	motor_output = MotorOutput(esc_list)
+	startup.mark('rpio')
+
+	#-------------------------------------------------------------------------------------------
+	# Initialize the gyroscope / accelerometer I2C object
+	#-------------------------------------------------------------------------------------------
+	coefficients = None
+	if coefficients_file is not None:
+		coefficients = LoadCoefficients(coefficients_file)
+	mpu6050 = MPU6050(0x68, dlpf, fifo, coefficients)
+	if gpio == 'chardev':
+		mpu6050.data_ready = gpiochip.RequestLine(RPIO_DATA_READY_INTERRUPT)
+	startup.mark('mpu6050')
+
+	#-------------------------------------------------------------------------------------------
+	# Capture every raw sensor reading from here on, calibration included, for replay
+	#-------------------------------------------------------------------------------------------
+	if capture_file is not None:
+		capture = qcrecorder.FlightRecorder(qcrecorder.SENSOR_FIELDS, capture_file, "/dev/shm/qccapture")
+		capture.start()
+		mpu6050.capture = capture
+
+	#-------------------------------------------------------------------------------------------
+	# Countdown: 5 beeps prior to gyro calibration
+	#-------------------------------------------------------------------------------------------
+	CountdownBeep(5)
+
+	#-------------------------------------------------------------------------------------------
+	# Calibrate the sensors to build a trend line for sensor offsets against temperature
+	#-------------------------------------------------------------------------------------------
+	if calibrate_sensors:
+		mpu6050.calibrateGravity("./qcoffsets.csv")
+		sys.exit(0)
+
+	#-------------------------------------------------------------------------------------------
+	# From here on, optionally hand the sensor reads to their own process so they keep pace with
+	# the MPU6050 however long the motion processing takes
+	#-------------------------------------------------------------------------------------------
+	if acquire:
+		mpu6050.startAcquisition()
+
+	#-------------------------------------------------------------------------------------------
+	# On a warm restart, check the saved calibration against a short read: the read is taken
+	# whether or not there's one saved, so a capture always starts the same way for replay.
+	#-------------------------------------------------------------------------------------------
+	calibration = None
+	calibration_problem = None
+	if calibration_file is not None:
+		if os.path.isfile(calibration_file):
+			try:
+				calibration = LoadCalibration(calibration_file)
+			except (IOError, ValueError) as err:
+				logger.critical('Ignoring calibration file %s: %s', calibration_file, err)
+
+		temp_raw, gx_offset, gy_offset, gz_offset, gravity_x, gravity_y, gravity_z = mpu6050.measureCalibration(CALIBRATION_SAMPLES)
+		calibration_problem = CheckCalibration(calibration, time_now, temp_raw, gx_offset, gy_offset, gz_offset, gravity_x, gravity_y, gravity_z)
+		if calibration_problem is None:
+			logger.critical('Reusing calibration from %s', calibration_file)
+		else:
+			logger.critical('Calibrating in full, saved calibration unusable: %s', calibration_problem)
 
-		c_roll = tau_fraction * (prev_c_roll + qgx_integrated) + (1 - tau_fraction) * e_roll
-		prev_c_roll = c_roll
+	if calibration_file is not None and calibration_problem is None:
+		mpu6050.gx_offset = calibration['gx_offset']
+		mpu6050.gy_offset = calibration['gy_offset']
+		mpu6050.gz_offset = calibration['gz_offset']
+		qfrgv_x = calibration['qfrgv_x']
+		qfrgv_y = calibration['qfrgv_y']
+		qfrgv_z = calibration['qfrgv_z']
 
-		#-----------------------------------------------------------------------------------
-		# Choose the best measure of the angles
-		#-----------------------------------------------------------------------------------
-		pa = c_pitch
-		ra = c_roll
-		ta = e_tilt
-		ya = i_yaw
-
-		#----------------------------------------------------------------------------------
-		# Reset the averaged values for the next time round
-		#----------------------------------------------------------------------------------
+	else:
+		#---------------------------------------------------------------------------------------
+		# Calibrate gyros - this is a one-off
+		#---------------------------------------------------------------------------------------
+		mpu6050.calibrateGyros()
+
+		#---------------------------------------------------------------------------------------
+		# Countdown: 4 beeps prior calculating take-off platform tilt
+		#---------------------------------------------------------------------------------------
+		CountdownBeep(4)
+
+		#---------------------------------------------------------------------------------------
+		# Measure average gravity distribution across the quadframe
+		#---------------------------------------------------------------------------------------
 		qax_integrated = 0.0
 		qay_integrated = 0.0
 		qaz_integrated = 0.0
 
-		qgx_integrated = 0.0
-		qgy_integrated = 0.0
-		qgz_integrated = 0.0
+		prev_qax, prev_qay, prev_qaz, prev_qgx, prev_qgy, prev_qgz = mpu6050.readSensors()
+		prev_time_now = time_now
+		integration_start = time_now
 
-		#-----------------------------------------------------------------------------------
-		# Get the curent flight plan targets
-		#-----------------------------------------------------------------------------------
-		if not ready_to_fly:
-			if hover_speed >= hover_target:
-				hover_speed = hover_target
-				ready_to_fly = True	
+		loop_count = 0
+		while loop_count != 1000:
+			qax, qay, qaz, qgx, qgy, qgz = mpu6050.readSensors()
 
-				#-------------------------------------------------------------------
-				# Register the flight plan with the authorities
-				#-------------------------------------------------------------------
-				fp = FlightPlan(time_now)
+			loop_count += 1
+			delta_time = time_now - prev_time_now
+			prev_time_now = time_now
 
-			else:
-				hover_speed += int(hover_target * motion_period / rtf_period)
+			qax_integrated += (qax + prev_qax) * delta_time
+			qay_integrated += (qay + prev_qay) * delta_time
+			qaz_integrated += (qaz + prev_qaz) * delta_time
 
-		else:
-			evx_target, evy_target, evz_target = fp.getTargets(time_now)
+			prev_qax = qax
+			prev_qay = qay
+			prev_qaz = qaz
 
-		#-----------------------------------------------------------------------------------
-		# Update the time for the next processing loop
-		#-----------------------------------------------------------------------------------
-		motion_period = 1 / motion_frequency
-		if jitter != 0:
-			motion_period *= (1 + random.uniform(-jitter, +jitter) / 100)
+		#---------------------------------------------------------------------------------------
+		# Work out the average acceleration due to gravity
+		# Save off the quad-frame raw gravity vector
+		#---------------------------------------------------------------------------------------
+		integration_period = time_now - integration_start
+		qfrgv_x = qax_integrated * SCALE_ACCEL / (2 * integration_period)
+		qfrgv_y = qay_integrated * SCALE_ACCEL / (2 * integration_period)
+		qfrgv_z = qaz_integrated * SCALE_ACCEL / (2 * integration_period)
+
+		#---------------------------------------------------------------------------------------
+		# Keep it for the next restart, stamped with when and how warm it was measured
+		#---------------------------------------------------------------------------------------
+		if calibration_file is not None:
+			try:
+				SaveCalibration(calibration_file, {'time': time_now, 'temp': mpu6050.compensation_temp,
+				                                   'gx_offset': mpu6050.gx_offset, 'gy_offset': mpu6050.gy_offset, 'gz_offset': mpu6050.gz_offset,
+				                                   'qfrgv_x': qfrgv_x, 'qfrgv_y': qfrgv_y, 'qfrgv_z': qfrgv_z})
+			except (IOError, OSError) as err:
+				logger.critical('Could not save calibration file %s: %s', calibration_file, err)
+
+	#-------------------------------------------------------------------------------------------
+	# Get the take-off platform slope
+	#-------------------------------------------------------------------------------------------
+	qfrgv_pitch, qfrgv_roll, qfrgv_tilt = GetEulerAngles(qfrgv_x, qfrgv_y, qfrgv_z)
+
+	#-------------------------------------------------------------------------------------------
+	# Now measure gravity in earth axes according to the sensors
+	#-------------------------------------------------------------------------------------------
+	efrgv_x, efrgv_y, efrgv_z = Q2EFrame(qfrgv_x, qfrgv_y, qfrgv_z, qfrgv_pitch, qfrgv_roll, 0.0, qfrgv_tilt)
+	startup.mark('calibration')
+
+	#-------------------------------------------------------------------------------------------
+	# Initialize complementary filter angles
+	#-------------------------------------------------------------------------------------------
+	prev_c_pitch = qfrgv_pitch
+	prev_c_roll = qfrgv_roll
+	i_pitch = qfrgv_pitch
+	i_roll = qfrgv_roll
+	i_yaw = 0.0
+
+	#-------------------------------------------------------------------------------------------
+	# ...or the quaternion estimator, from the same starting point
+	#-------------------------------------------------------------------------------------------
+	ahrs = None
+	if attitude == 'quaternion':
+		ahrs = QuaternionAHRS(qfrgv_pitch, qfrgv_roll, 1 / tau)
+
+	#-------------------------------------------------------------------------------------------
+	# The frame rotation is recomputed in place each motion tick
+	#-------------------------------------------------------------------------------------------
+	rotation = Rotation()
+
+	#-------------------------------------------------------------------------------------------
+	# Cleanup integration variables
+	#-------------------------------------------------------------------------------------------
+	qax_integrated = 0.0
+	qay_integrated = 0.0
+	qaz_integrated = 0.0
+
+	qgx_integrated = 0.0
+	qgy_integrated = 0.0
+	qgz_integrated = 0.0
+
+	#-------------------------------------------------------------------------------------------
+	# Countdown: 3 beeps prior to setting up the interrupt handler
+	#-------------------------------------------------------------------------------------------
+	CountdownBeep(3)
+
+	#-------------------------------------------------------------------------------------------
+	# Set the signal handler here so the core processing loop can be stopped (or not started) by
+	# Ctrl-C.
+	#---------------------------------------------------------------------------
+	loop_count = 0
+	signal.signal(signal.SIGINT, SignalHandler)
 
-		#-----------------------------------------------------------------------------------
-		# Convert earth-frame velocity targets to quadcopter frame.  This isn't a rotation
-		# matrix conversion, simply accounting for the angle from horizontal / vertical.
-		#-----------------------------------------------------------------------------------
-		qvx_target, qvy_target, qvz_target = E2QFrame(evx_target, evy_target, evz_target, pa, ra, ya, ta)
+	#-------------------------------------------------------------------------------------------
+	# Countdown: 2 beeps prior to starting the video
+	#-------------------------------------------------------------------------------------------
+	CountdownBeep(2)
 
-		#-----------------------------------------------------------------------------------
-		# Redistribute gravity around the new orientation of the quad
-		#-----------------------------------------------------------------------------------
-		qfrgv_x, qfrgv_y, qfrgv_z = E2QFrame(efrgv_x, efrgv_y, efrgv_z, pa, ra, ya, ta)
+	#-------------------------------------------------------------------------------------------
+	# Start up the video camera if required - this runs from take-off through to shutdown automatically.
+	# Run it in its own process group so that Ctrl-C for QC doesn't get through and stop the video
+	#-------------------------------------------------------------------------------------------
+	def Daemonize():
+		os.setpgrp()
 
-		#-----------------------------------------------------------------------------------
-		# Delete reorientated gravity from raw accelerometer readings and sum to make net velocity
-		#-----------------------------------------------------------------------------------
-		qvx_input += (qax - qfrgv_x) * integration_period * GRAV_ACCEL
-		qvy_input += (qay - qfrgv_y) * integration_period * GRAV_ACCEL
-		qvz_input += (qaz - qfrgv_z) * integration_period * GRAV_ACCEL
+	if shoot_video:
+		now = datetime.now()
+		now_string = now.strftime("%y%m%d-%H:%M:%S")
+		video = subprocess.Popen(["raspivid", "-rot", "180", "-w", "1280", "-h", "720", "-o", "/home/pi/Videos/qcvid_" + now_string + ".h264", "-n", "-t", "0", "-fps", "30", "-b", "5000000"], preexec_fn =  Daemonize)
 
-		#===========================================================================
-		# Motion PIDs: Run the horizontal speed PIDs each rotation axis to determine
-		# targets for absolute angle PIDs and the verical speed PID to control height.
-		#===========================================================================
-		[p_out, i_out, d_out] = qvx_pid.Compute(qvx_input, qvx_target, time_now)
-		qvx_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		qvx_out = p_out + i_out + d_out
+	#-------------------------------------------------------------------------------------------
+	# Countdown: 1 beep to get those blades spinning
+	#-------------------------------------------------------------------------------------------
+	CountdownBeep(1)
 
-		[p_out, i_out, d_out] = qvy_pid.Compute(qvy_input, qvy_target, time_now)
-		qvy_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		qvy_out =  p_out + i_out + d_out
+	#------------------------------------------------------------------------------------------
+	# Set up the bits of state setup before takeoff
+	#-------------------------------------------------------------------------------------------
+	keep_looping = True
 
-		[p_out, i_out, d_out] = qvz_pid.Compute(qvz_input, qvz_target, time_now)
-		qvz_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		qvz_out = p_out + i_out + d_out
+	evx_target = 0.0
+	evy_target = 0.0
+	evz_target = 0.0
 
-		#---------------------------------------------------------------------------
-		# Convert the horizontal velocity PID output i.e. the horizontal acceleration
-		# target in q's into the pitch and roll angle PID targets in radians
-		#---------------------------------------------------------------------------
-		pr_target = -qvx_out
-		rr_target = -qvy_out
+	qvx_input = 0.0
+	qvy_input = 0.0
+	qvz_input = 0.0
 
-		#---------------------------------------------------------------------------
-		# Convert the vertical velocity PID output direct to PWM pulse width.
-		#---------------------------------------------------------------------------
-		vert_out = hover_speed + int(round(qvz_out))
+	velocity_kalman = None
+	if kalman:
+		velocity_kalman = VelocityKalman()
 
-		#===========================================================================
-		# Attitude PIDs: Run the rotation rate PIDs each rotation axis to determine
-		# overall PWM output.
-		#===========================================================================
-		[p_out, i_out, d_out] = ya_pid.Compute(ya, ya_target, time_now)
-		ya_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		yr_target = p_out + i_out + d_out
+	pr_target = 0.0
+	rr_target = 0.0
+	yr_target = 0.0
 
-		[p_out, i_out, d_out] = pr_pid.Compute(qgy, pr_target, time_now)
-		pr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		pr_out = p_out + i_out + d_out
-		[p_out, i_out, d_out] = rr_pid.Compute(qgx, rr_target, time_now)
-		rr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		rr_out = p_out + i_out + d_out
-		[p_out, i_out, d_out] = yr_pid.Compute(qgz, yr_target, time_now)
-		yr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-		yr_out = p_out + i_out + d_out
+	ya_target = 0.0
 
-		#---------------------------------------------------------------------------
-		# Convert the rotation rate PID outputs direct to PWM pulse width
-		#---------------------------------------------------------------------------
-		pr_out = int(round(pr_out / 2))
-		rr_out = int(round(rr_out / 2))
-		yr_out = int(round(yr_out / 2))
+	hover_speed = 0
+	ready_to_fly = False
 
-		#===========================================================================
-		# PID output distribution: Walk through the ESCs, and apply the PID outputs
-		# i.e. the updates PWM pulse widths according to where the ESC is sited on the
-		# frame
-		#===========================================================================
+	#-------------------------------------------------------------------------------------------
+	# START TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn the right way
+	#-------------------------------------------------------------------------------------------
+	if test_case == 1:
 		for esc in esc_list:
-			#-------------------------------------------------------------------
-			# Update all blades' power in accordance with the z error
-			#-------------------------------------------------------------------
-			delta_spin = vert_out
+			for count in range(0, hover_target, 10):
+				#-------------------------------------------------------------------
+				# Spin up to user determined (-h) hover speeds ~200
+				#-------------------------------------------------------------------
+				esc.update(count)
+				time.sleep(0.01)
+			time.sleep(2.0)
+			esc.update(0)
+		CleanShutdown()
+	#-------------------------------------------------------------------------------------------
+	# END TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn the right way
+	#-------------------------------------------------------------------------------------------
+
+	#===========================================================================================
+	# Tuning: Set up the PID gains - some are hard coded mathematical approximations, some come
+	# from the CLI parameters to allow for tuning
+	#===========================================================================================
+	# A PID is a simple algorithm which takes a desired state of a system (the "target", perhaps from a remote control)
+	# and the current state (the "input" or "feedback", perhaps from a sensor), subtracts them to determine the "error" in
+	# the system, and applies some simple math(s) to come up with a corrective "output". It does this repeatedly with the aim
+	# that the "error" reduces and is maintained at near zero due to the "feedback".
+	#
+	# This mechanism allows complex systems to be broken down and corrected even when a complete mathematical model of the
+	# system is too complicated or external factors mean the system cannot be modelled directly.
+	#
+	# In a quadcopter, the external targets (those a user control for flight) are horizontal and vertical speed plus tilt.
+	#
+	# - Horizontal speed error is corrected by providing the as the horizontal acceleration target
+	# - The horizontal acceleration target is converted to a required rotation rate
+	# - Rotation rate error is corrected proportionally by providing the corrective output to the motors' ESCs
+	#
+	# - Horizontal speed feedback is provided by integrated accelerometer (or GPS in future)
+	# - Angular speed feedback comes directly from the gyros
+	#
+	# That's 2 PIDs each for horizontal X & Y axes movement - 4 in total so far.
+	#
+	# - Vertical speed error is corrected proportionally by providing the corrective output to the motors' ESCs (cf. angular speed above)
+	#
+	# - Vertical speed feedback comes from the Z-axis accelerometer integrated over time, and compensated for any tilt (cos(theta)cos(phi))
+	#
+	# That's 1 PID for vertical Z axis speed control.
+	#
+	# - Yaw speed error is corrected proportionally by providing the corrective output to the motors' ESCs
+	#
+	# - Yaw speed feedback comes directly from the Z-axis gyro
+	#
+	# That's 2 PID for Z axis yaw control.
+	#
+	# So 7 PIDs in total
+	#===========================================================================================
+
+	#-------------------------------------------------------------------------------------------
+	# The earth X axis speed controls forward / backward speed
+	#-------------------------------------------------------------------------------------------
+	PID_QVX_P_GAIN = hvp_gain
+	PID_QVX_I_GAIN = hvi_gain
+	PID_QVX_D_GAIN = hvd_gain	
+
+	#-------------------------------------------------------------------------------------------
+	# The earth Y axis speed controls left / right speed
+	#-------------------------------------------------------------------------------------------
+	PID_QVY_P_GAIN = hvp_gain
+	PID_QVY_I_GAIN = hvi_gain
+	PID_QVY_D_GAIN = hvd_gain	
+
+	#-------------------------------------------------------------------------------------------
+	# The earth Z axis speed controls rise / fall speed
+	#-------------------------------------------------------------------------------------------
+	PID_QVZ_P_GAIN = vvp_gain
+	PID_QVZ_I_GAIN = vvi_gain
+	PID_QVZ_D_GAIN = vvd_gain
+
+	#-------------------------------------------------------------------------------------------
+	# The YAW ANGLE PID maintains a stable rotation angle about the Z-axis
+	#-------------------------------------------------------------------------------------------
+	PID_YA_P_GAIN = 6.0
+	PID_YA_I_GAIN = 3.0
+	PID_YA_D_GAIN = 1.0
+
+	#-------------------------------------------------------------------------------------------
+	# The PITCH RATE PID controls stable rotation rate around the Y-axis
+	#-------------------------------------------------------------------------------------------
+	PID_PR_P_GAIN = prp_gain
+	PID_PR_I_GAIN = pri_gain
+	PID_PR_D_GAIN = prd_gain
+
+	#-------------------------------------------------------------------------------------------
+	# The ROLL RATE PID controls stable rotation rate around the X-axis
+	#-------------------------------------------------------------------------------------------
+	PID_RR_P_GAIN = rrp_gain
+	PID_RR_I_GAIN = rri_gain
+	PID_RR_D_GAIN = rrd_gain
+
+	#-------------------------------------------------------------------------------------------
+	# The YAW RATE PID controls stable rotation speed around the Z-axis
+	#-------------------------------------------------------------------------------------------
+	PID_YR_P_GAIN = rrp_gain / 2.0
+	PID_YR_I_GAIN = rri_gain / 2.0
+	PID_YR_D_GAIN = rrd_gain / 2.0
+
+	logger.critical('Thunderbirds are go!')
+
+	#-------------------------------------------------------------------------------------------
+	# Start the flight recorder for diagnostics - export it to CSV with qcrecorder.py afterwards
+	#-------------------------------------------------------------------------------------------
+	if diagnostics:
+		now = datetime.now()
+		now_string = now.strftime("%y%m%d-%H:%M:%S")
+		recorder = qcrecorder.FlightRecorder(qcrecorder.DIAGNOSTICS_FIELDS, "qcdiags" + now_string + ".qcr")
+		recorder.start()
+
+	#==========================================================================================
+	# Initialize critical timing immediately before starting the PIDs.  This is done by reading
+	# the sensors, and that also gives us a starting position to integrated from.
+	#==========================================================================================
+	prev_qax, prev_qay, prev_qaz, prev_qgx, prev_qgy, prev_qgz = mpu6050.readSensors()
+
+	#-------------------------------------------------------------------------------------------
+	# Start the yaw absolute angle PID
+	#-------------------------------------------------------------------------------------------
+	ya_pid = PID(PID_YA_P_GAIN, PID_YA_I_GAIN, PID_YA_D_GAIN, time_now)
+
+	#-------------------------------------------------------------------------------------------
+	# Start the pitch, roll and yaw rate PIDs
+	#-------------------------------------------------------------------------------------------
+	pr_pid = PID(PID_PR_P_GAIN, PID_PR_I_GAIN, PID_PR_D_GAIN, time_now)
+	rr_pid = PID(PID_RR_P_GAIN, PID_RR_I_GAIN, PID_RR_D_GAIN, time_now)
+	yr_pid = PID(PID_YR_P_GAIN, PID_YR_I_GAIN, PID_YR_D_GAIN, time_now)
+
+	#-------------------------------------------------------------------------------------------
+	# Start the X, Y (horizontal) and Z (vertical) velocity PIDs
+	#-------------------------------------------------------------------------------------------
+	qvx_pid = PID(PID_QVX_P_GAIN, PID_QVX_I_GAIN, PID_QVX_D_GAIN, time_now)
+	qvy_pid = PID(PID_QVY_P_GAIN, PID_QVY_I_GAIN, PID_QVY_D_GAIN, time_now)
+	qvz_pid = PID(PID_QVZ_P_GAIN, PID_QVZ_I_GAIN, PID_QVZ_D_GAIN, time_now)
+
+	start_time = time_now
+	elapsed_time = 0.0
+	motion_deadline = MotionDeadline(deadline_policy, time_now)
+	integration_start = time_now
+
+	#-------------------------------------------------------------------------------------------
+	# Sample-to-sample and tick-to-tick interval histograms, to see the scheduling jitter
+	#-------------------------------------------------------------------------------------------
+	sample_intervals = IntervalHistogram("sample intervals", 0.00001, 1000)
+	tick_intervals = IntervalHistogram("tick intervals", 0.0001, 1000)
+
+	#-------------------------------------------------------------------------------------------
+	# Optionally, per-stage latency from data ready edge to ESC pulse, recorded as a trace
+	#-------------------------------------------------------------------------------------------
+	tracer = None
+	if trace_file is not None:
+		trace_recorder = qcrecorder.FlightRecorder(qcrecorder.TRACE_FIELDS, trace_file, "/dev/shm/qctrace")
+		trace_recorder.start()
+		tracer = StageTracer(trace_recorder)
+	mpu6050.tracer = tracer
+
+	#-------------------------------------------------------------------------------------------
+	# RT mode: the flight loop takes its own CPU at real-time priority.  The sensor acquisition
+	# process, if there is one, runs at real-time priority too, but on the housekeeping CPUs.
+	#-------------------------------------------------------------------------------------------
+	if rt_cpu is not None:
+		SetAffinity([rt_cpu])
+		SetScheduler(RT_PRIORITY)
+		if mpu6050.acquisition is not None:
+			SetScheduler(RT_PRIORITY, mpu6050.acquisition.process.pid)
+
+	startup.mark('take-off')
+	logger.critical(startup.summary())
+
+	while keep_looping:
+		#===================================================================================
+		# Sensors: Read the sensor values; note that this also sets the time_now to be as
+		# accurate a time stamp for the sensor data as possible.
+		#===================================================================================
+		qax, qay, qaz, qgx, qgy, qgz = mpu6050.readSensors()
 
-			#-------------------------------------------------------------------
-			# For a left downwards roll, the x gyro goes negative, so the PID error is positive,
-			# meaning PID output is positive, meaning this needs to be added to the left blades
-			# and subtracted from the right.
-			#-------------------------------------------------------------------
-			if esc.motor_location & MOTOR_LOCATION_RIGHT:
-				delta_spin -= rr_out
-			else:
-				delta_spin += rr_out
+		#-----------------------------------------------------------------------------------
+		# Now we have the sensor snapshot, tidy up the rest of the variable so that processing
+		# takes zero time.
+		#-----------------------------------------------------------------------------------
+		delta_time = time_now - start_time - elapsed_time
+		elapsed_time = time_now - start_time
+		loop_count += 1
+		sample_intervals.add(delta_time)
 
-			#-------------------------------------------------------------------
-			# For a forward downwards pitch, the y gyro goes positive, but is negated
-			# in mpu6050.readSensors so it is consistent with the accelerometer +
-			# Euler angle calculations.  The PID error is postive as a result,
-			# meaning PID output is positive, meaning this needs to be added to the
-			# front blades and subtracted from the back.
-			#-------------------------------------------------------------------
-			if esc.motor_location & MOTOR_LOCATION_BACK:
-				delta_spin -= pr_out
-			else:
-				delta_spin += pr_out
+		#===================================================================================
+		# Integration: Sensor data is integrated over time, and later averaged to produce
+		# smoother yet still accurate acceleration and rotation since the last PID updates.
+		#===================================================================================
+		qgx_integrated += (prev_qgx + qgx) * delta_time
+		qgy_integrated += (prev_qgy + qgy) * delta_time
+		qgz_integrated += (prev_qgz + qgz) * delta_time
 
-			#-------------------------------------------------------------------
-			# For CW yaw, the z gyro goes negative, so the PID error is postitive,
-			# meaning PID output is positive, meaning this need to be added to the
-			# ACW (FL and BR) blades and subtracted from the CW (FR & BL) blades.
-			#-------------------------------------------------------------------
-			if esc.motor_rotation == MOTOR_ROTATION_CW:
-				delta_spin += yr_out
-			else:
-				delta_spin -= yr_out
+		prev_qgx = qgx
+		prev_qgy = qgy
+		prev_qgz = qgz
 
-			#-------------------------------------------------------------------
-			# Apply the blended outputs to the esc PWM signal
-			#-------------------------------------------------------------------
-			esc.update(delta_spin)
+		qax_integrated += (prev_qax + qax) * delta_time
+		qay_integrated += (prev_qay + qay) * delta_time
+		qaz_integrated += (prev_qaz + qaz) * delta_time
+
+		prev_qax = qax
+		prev_qay = qay
+		prev_qaz = qaz
+		if tracer is not None:
+			tracer.probe(TRACE_INTEGRATE)
 
 		#-----------------------------------------------------------------------------------
-		# Diagnostic log - every motion loop
+		# The quaternion estimator tracks attitude on every sample
 		#-----------------------------------------------------------------------------------
-		if diagnostics:
-			logger.warning('%f, %f, %d, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %s, %f, %s, %d, %f, %f, %s, %f, %s, %d, %f, %f, %s, %d, %f, %s, %d, %d, %d, %d, %d', elapsed_time, integration_period, loop_count, qgx, qgy, qgz, efrgv_x, efrgv_y, efrgv_z, qax, qay, qaz, qfrgv_x, qfrgv_y, qfrgv_z, qvx_input, qvy_input, qvz_input, math.degrees(i_pitch), math.degrees(i_roll), math.degrees(e_pitch), math.degrees(e_roll), math.degrees(c_pitch), math.degrees(c_roll), math.degrees(i_yaw), math.degrees(e_tilt), evx_target, qvx_target, qvx_diags, math.degrees(pr_target), pr_diags, pr_out, evy_target, qvy_target, qvy_diags, math.degrees(rr_target), rr_diags, rr_out, evz_target, qvz_target, qvz_diags, qvz_out, yr_target, yr_diags, yr_out, esc_list[0].current_pulse_width, esc_list[1].current_pulse_width, esc_list[2].current_pulse_width, esc_list[3].current_pulse_width)
+		if ahrs is not None:
+			ahrs.update(qgx, qgy, qgz, qax, qay, qaz, delta_time)
 
+		#===================================================================================
+		# Motion Processing:  Use the recorded data to produce motion data and feed in the motion PIDs
+		#===================================================================================
+		if motion_deadline.due(time_now, motion_period):
+			motion_deadline.advance(time_now, motion_period)
+
+			#----------------------------------------------------------------------------------
+			# Work out the average acceleration and rotation rate
+			#----------------------------------------------------------------------------------
+			integration_period = time_now - integration_start
+			integration_start = time_now
+			tick_intervals.add(integration_period)
+
+			#----------------------------------------------------------------------------------
+			# Sort out units and the double accounting in integration.
+			#----------------------------------------------------------------------------------
+			qgx_integrated *= SCALE_GYRO / 2
+			qgy_integrated *= SCALE_GYRO / 2
+			qgz_integrated *= SCALE_GYRO / 2
+
+			qax_integrated *= SCALE_ACCEL / 2
+			qay_integrated *= SCALE_ACCEL / 2
+			qaz_integrated *= SCALE_ACCEL / 2
+
+			#----------------------------------------------------------------------------------
+			# Convert the integrated gyroscope reading back to an averaged gyroscope reading
+			#----------------------------------------------------------------------------------
+			qgx = qgx_integrated / integration_period
+			qgy = qgy_integrated / integration_period
+			qgz = qgz_integrated / integration_period
+
+			#----------------------------------------------------------------------------------
+			# Convert the integrate accelerometer reading back to an averaged accelerometer reading
+			#----------------------------------------------------------------------------------
+			qax = qax_integrated / integration_period
+			qay = qay_integrated / integration_period
+			qaz = qaz_integrated / integration_period
+
+			#===================================================================================
+			# Angles: Get angles in radians
+			#===================================================================================
+			e_pitch, e_roll, e_tilt = GetEulerAngles(qax, qay, qaz)
+
+			i_pitch += qgy_integrated
+			i_roll += qgx_integrated
+			i_yaw += qgz_integrated
+
+			#-----------------------------------------------------------------------------------
+			# Apply complementary filter to ensure long-term accuracy of pitch / roll angles
+			# 1/tau is the handover frequency that the integrated gyro high pass filter is taken over
+			# by the accelerometer Euler low-pass filter providing fast reaction to change from the
+			# gyro yet with low noise accurate Euler angles from the acclerometer.
+			#
+			# The combination of tau plus the time increment provides a fraction to mix
+			# the two angles sources.
+			#-----------------------------------------------------------------------------------
+			tau_fraction = tau / (tau + integration_period)
+
+			c_pitch = tau_fraction * (prev_c_pitch + qgy_integrated) + (1 - tau_fraction) * e_pitch
+			prev_c_pitch = c_pitch
+
+			c_roll = tau_fraction * (prev_c_roll + qgx_integrated) + (1 - tau_fraction) * e_roll
+			prev_c_roll = c_roll
+
+			#-----------------------------------------------------------------------------------
+			# Choose the best measure of the angles
+			#-----------------------------------------------------------------------------------
+			if ahrs is not None:
+				pa, ra, ya = ahrs.getAngles()
+				rotation.setMatrix(ahrs.getRotationMatrix())
+			else:
+				pa = c_pitch
+				ra = c_roll
+				ya = i_yaw
+				rotation.setAngles(pa, ra, ya)
+			ta = e_tilt
+			if tracer is not None:
+				tracer.probe(TRACE_ESTIMATE)
+
+			#----------------------------------------------------------------------------------
+			# Reset the averaged values for the next time round
+			#----------------------------------------------------------------------------------
+			qax_integrated = 0.0
+			qay_integrated = 0.0
+			qaz_integrated = 0.0
+
+			qgx_integrated = 0.0
+			qgy_integrated = 0.0
+			qgz_integrated = 0.0
+
+			#-----------------------------------------------------------------------------------
+			# Get the curent flight plan targets
+			#-----------------------------------------------------------------------------------
+			if not ready_to_fly:
+				if hover_speed >= hover_target:
+					hover_speed = hover_target
+					ready_to_fly = True	
+
+					#-------------------------------------------------------------------
+					# Register the flight plan with the authorities
+					#-------------------------------------------------------------------
+					fp = FlightPlan(time_now)
 
-#-------------------------------------------------------------------------------------------
-# Dump the loops per second
-#-------------------------------------------------------------------------------------------
-logger.critical("loop speed %f loops per second", loop_count / elapsed_time)
+				else:
+					hover_speed += int(hover_target * motion_period / rtf_period)
 
-#-------------------------------------------------------------------------------------------
-# Dump the variety of sensor misses
-#-------------------------------------------------------------------------------------------
-mpu6050_misses, i2c_misses = mpu6050.getMisses()
-logger.critical("mpu6050 %d misses, i2c %d misses", mpu6050_misses, i2c_misses)
+			else:
+				evx_target, evy_target, evz_target = fp.getTargets(time_now)
+
+			#-----------------------------------------------------------------------------------
+			# Update the time for the next processing loop
+			#-----------------------------------------------------------------------------------
+			motion_period = 1 / motion_frequency
+			if jitter != 0:
+				motion_period *= (1 + random.uniform(-jitter, +jitter) / 100)
+
+			#-----------------------------------------------------------------------------------
+			# Convert earth-frame velocity targets to quadcopter frame.  This isn't a rotation
+			# matrix conversion, simply accounting for the angle from horizontal / vertical.
+			#-----------------------------------------------------------------------------------
+			qvx_target, qvy_target, qvz_target = rotation.e2q(evx_target, evy_target, evz_target)
+
+			#-----------------------------------------------------------------------------------
+			# Redistribute gravity around the new orientation of the quad
+			#-----------------------------------------------------------------------------------
+			qfrgv_x, qfrgv_y, qfrgv_z = rotation.e2q(efrgv_x, efrgv_y, efrgv_z)
+
+			#-----------------------------------------------------------------------------------
+			# Delete reorientated gravity from raw accelerometer readings and sum to make net velocity
+			#-----------------------------------------------------------------------------------
+			if velocity_kalman is not None:
+				qvx_input, qvy_input, qvz_input = velocity_kalman.update(qax - qfrgv_x, qay - qfrgv_y, qaz - qfrgv_z, integration_period, not ready_to_fly)
+			else:
+				qvx_input += (qax - qfrgv_x) * integration_period * GRAV_ACCEL
+				qvy_input += (qay - qfrgv_y) * integration_period * GRAV_ACCEL
+				qvz_input += (qaz - qfrgv_z) * integration_period * GRAV_ACCEL
+
+			#===========================================================================
+			# Motion PIDs: Run the horizontal speed PIDs each rotation axis to determine
+			# targets for absolute angle PIDs and the verical speed PID to control height.
+			#===========================================================================
+			[qvx_p, qvx_i, qvx_d] = qvx_pid.Compute(qvx_input, qvx_target, time_now)
+			qvx_out = qvx_p + qvx_i + qvx_d
+
+			[qvy_p, qvy_i, qvy_d] = qvy_pid.Compute(qvy_input, qvy_target, time_now)
+			qvy_out =  qvy_p + qvy_i + qvy_d
+
+			[qvz_p, qvz_i, qvz_d] = qvz_pid.Compute(qvz_input, qvz_target, time_now)
+			qvz_out = qvz_p + qvz_i + qvz_d
+
+			#---------------------------------------------------------------------------
+			# Convert the horizontal velocity PID output i.e. the horizontal acceleration
+			# target in q's into the pitch and roll angle PID targets in radians
+			#---------------------------------------------------------------------------
+			pr_target = -qvx_out
+			rr_target = -qvy_out
+
+			#---------------------------------------------------------------------------
+			# Convert the vertical velocity PID output direct to PWM pulse width.
+			#---------------------------------------------------------------------------
+			vert_out = hover_speed + int(round(qvz_out))
+
+			#===========================================================================
+			# Attitude PIDs: Run the rotation rate PIDs each rotation axis to determine
+			# overall PWM output.
+			#===========================================================================
+			[ya_p, ya_i, ya_d] = ya_pid.Compute(ya, ya_target, time_now)
+			yr_target = ya_p + ya_i + ya_d
+
+			[pr_p, pr_i, pr_d] = pr_pid.Compute(qgy, pr_target, time_now)
+			pr_out = pr_p + pr_i + pr_d
+			[rr_p, rr_i, rr_d] = rr_pid.Compute(qgx, rr_target, time_now)
+			rr_out = rr_p + rr_i + rr_d
+			[yr_p, yr_i, yr_d] = yr_pid.Compute(qgz, yr_target, time_now)
+			yr_out = yr_p + yr_i + yr_d
+
+			#---------------------------------------------------------------------------
+			# Convert the rotation rate PID outputs direct to PWM pulse width
+			#---------------------------------------------------------------------------
+			pr_out = int(round(pr_out / 2))
+			rr_out = int(round(rr_out / 2))
+			yr_out = int(round(yr_out / 2))
+			if tracer is not None:
+				tracer.probe(TRACE_PIDS)
+
+			#===========================================================================
+			# PID output distribution: Walk through the ESCs, and apply the PID outputs
+			# i.e. the updates PWM pulse widths according to where the ESC is sited on the
+			# frame
+			#===========================================================================
+			motor_output.update(mixer.mix(vert_out, pr_out, rr_out, yr_out))
+			if tracer is not None:
+				tracer.probe(TRACE_PWM)
+
+			#-----------------------------------------------------------------------------------
+			# Diagnostic log - every motion loop
+			#-----------------------------------------------------------------------------------
+			if diagnostics:
+				recorder.record(elapsed_time, integration_period, loop_count, qgx, qgy, qgz, efrgv_x, efrgv_y, efrgv_z, qax, qay, qaz, qfrgv_x, qfrgv_y, qfrgv_z, qvx_input, qvy_input, qvz_input, i_pitch, i_roll, e_pitch, e_roll, c_pitch, c_roll, i_yaw, e_tilt, evx_target, qvx_target, qvx_p, qvx_i, qvx_d, pr_target, pr_p, pr_i, pr_d, pr_out, evy_target, qvy_target, qvy_p, qvy_i, qvy_d, rr_target, rr_p, rr_i, rr_d, rr_out, evz_target, qvz_target, qvz_p, qvz_i, qvz_d, qvz_out, yr_target, yr_p, yr_i, yr_d, yr_out, esc_list[0].current_pulse_width, esc_list[1].current_pulse_width, esc_list[2].current_pulse_width, esc_list[3].current_pulse_width)
+
+		if tracer is not None:
+			tracer.commit()
+
+
+	#-------------------------------------------------------------------------------------------
+	# Dump the loops per second
+	#-------------------------------------------------------------------------------------------
+	logger.critical("loop speed %f loops per second", loop_count / elapsed_time)
+	for histogram in (sample_intervals, tick_intervals):
+		logger.critical("%s", histogram.summary())
+		logger.warning("%s histogram: %s", histogram.name, histogram.bins())
+
+	#-------------------------------------------------------------------------------------------
+	# Dump where the time goes between the data ready edge and the ESC pulse, from the trace
+	# once it's all on disk
+	#-------------------------------------------------------------------------------------------
+	if trace_recorder is not None:
+		trace_recorder.stop()
+		if trace_recorder.getOverruns() > 0:
+			logger.critical("latency trace %d overruns", trace_recorder.getOverruns())
+		trace_recorder = None
+
+		for histogram in StageHistograms(qcrecorder.ReadRecords(trace_file, qcrecorder.TRACE_FIELDS)):
+			logger.critical("%s", histogram.summary())
+			logger.warning("%s histogram: %s", histogram.name, histogram.bins())
+
+	#-------------------------------------------------------------------------------------------
+	# Dump the variety of sensor misses
+	#-------------------------------------------------------------------------------------------
+	mpu6050.stopAcquisition()
+	if mpu6050.acquisition is not None:
+		logger.critical("acquisition %d samples, %d dropped, %d resyncs", *mpu6050.acquisition.getCounts())
+	mpu6050_misses, i2c_misses = mpu6050.getMisses()
+	logger.critical("mpu6050 %d misses, i2c %d misses", mpu6050_misses, i2c_misses)
+	for error, count in sorted(mpu6050.i2c.getErrors().items()):
+		logger.critical("i2c errno %d, %s: %d", error, os.strerror(error), count)
+	logger.critical("motion %d late ticks, %d missed ticks (%s)", *(motion_deadline.getCounts() + (deadline_policy,)))
+	compensation_repeats, compensation_hits, compensation_misses = mpu6050.getCompensationCounts()
+	compensation_reads = compensation_repeats + compensation_hits + compensation_misses
+	logger.critical("temperature compensation %.2f%% hit rate: %d same temperature, %d cached, %d computed", 100 * (compensation_reads - compensation_misses) / max(compensation_reads, 1), compensation_repeats, compensation_hits, compensation_misses)
+	if fifo:
+		logger.critical("fifo %d overflows", mpu6050.getFIFOOverflows())
+	if mpu6050.data_ready is not None:
+		logger.critical("data ready %d edges, %d missed", *mpu6050.data_ready.getCounts())
+	logger.critical("mixer %d desaturations", mixer.getDesaturations())
+	logger.critical("pwm %d updates, %d no-ops", *motor_output.getUpdates())
+
+	#-------------------------------------------------------------------------------------------
+	# Time for telly bye byes
+	#-------------------------------------------------------------------------------------------
+	CleanShutdown()
 
-#-------------------------------------------------------------------------------------------
-# Time for telly bye byes
-#-------------------------------------------------------------------------------------------
-CleanShutdown()
+
+if __name__ == '__main__':
+	#-------------------------------------------------------------------------------------------
+	# An I2CError getting this far means the sensor has stopped answering, and any other I/O
+	# failure - the acquisition process stopping after one, a missing file - is as fatal:
+	# shut down in order rather than leave the ESCs running on the last pulse widths
+	#-------------------------------------------------------------------------------------------
+	try:
+		main(sys.argv[1:])
+	except I2CError as err:
+		logger.critical('Sensor failure: %s', err)
+		CleanShutdown()
+	except IOError as err:
+		logger.critical('I/O failure: %s', err)
+		CleanShutdown()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Sensor acquisition process for the Raspberry Pi Python Quadcopter Flight Controller: a    ##
+## child process waits for each data ready edge, reads and time stamps the raw sensors and   ##
+## writes them into a single-producer / single-consumer ring in /dev/shm, so a slow motion   ##
+## tick in the control process no longer costs missed samples.                              ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import errno
+import fcntl
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+
+import qcrecorder
+
+############################################################################################
+#
+# The ring header is a set of 32-bit words, each written by one side only, so every update is
+# a single aligned store that the other side sees whole:
+#
+# - the write and dropped counts belong to the acquisition process
+# - the read count and the stop request belong to the control process
+#
+# The records are the qcrecorder sensor layout, led by the sample's sequence number, with a
+# second copy of the sequence number after it.  That's a seqlock: a record is written in one
+# copy, which gives no order between its fields, and then the trailing sequence number in a
+# store of its own, so a reader that finds both copies matching the sequence it expects has
+# the whole of the payload between them.  The trailing copy is padded to a 32-bit boundary, so
+# it too is one aligned store.
+#
+############################################################################################
+ACQUIRE_MAGIC = b'QCA1'
+HEADER_STRUCT = struct.Struct('<4sII')
+COUNT_STRUCT = struct.Struct('<I')
+
+WRITE_COUNT = HEADER_STRUCT.size
+DROPPED_COUNT = WRITE_COUNT + COUNT_STRUCT.size
+READ_COUNT = DROPPED_COUNT + COUNT_STRUCT.size
+STOP_REQUEST = READ_COUNT + COUNT_STRUCT.size
+RING_START = STOP_REQUEST + COUNT_STRUCT.size
+
+#-------------------------------------------------------------------------------------------
+# The counts are free running and wrap at 32 bits, so differences are taken modulo that, and
+# the capacity must be a power of 2 for the ring to wrap with them
+#-------------------------------------------------------------------------------------------
+COUNT_MASK = 0xFFFFFFFF
+
+############################################################################################
+#
+# The acquisition process and the control process's end of the ring.  read_sample is called
+# in the acquisition process and returns (time stamp, (ax, ay, az, temp, gx, gy, gz)); stats,
+# if given, is called there once it stops and its result handed back by stop().
+#
+############################################################################################
+class Acquisition:
+
+	def __init__(self, read_sample, stats=None, ring_name="/dev/shm/qcacquire", capacity=256):
+		self.read_sample = read_sample
+		self.stats = stats
+		self.ring_name = ring_name
+		self.capacity = capacity
+		self.record_struct = qcrecorder.RecordStruct(qcrecorder.SENSOR_FIELDS)
+		self.trailer_offset = (self.record_struct.size + 3) & ~3
+		self.record_size = self.trailer_offset + COUNT_STRUCT.size
+
+		#-----------------------------------------------------------------------------------
+		# Preallocate the ring in shared memory, all counts zero
+		#-----------------------------------------------------------------------------------
+		ring_size = RING_START + capacity * self.record_size
+		ring_fd = os.open(ring_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(ring_fd, ring_size)
+			self.ring = mmap.mmap(ring_fd, ring_size)
+		finally:
+			os.close(ring_fd)
+		HEADER_STRUCT.pack_into(self.ring, 0, ACQUIRE_MAGIC, self.record_size, capacity)
+
+		#-----------------------------------------------------------------------------------
+		# A pipe doorbell, one byte per sample, lets the control process sleep in read()
+		# rather than spin when it has caught up.  The stats come back over a second pipe.
+		#-----------------------------------------------------------------------------------
+		self.doorbell_read, self.doorbell_write = os.pipe()
+		fcntl.fcntl(self.doorbell_write, fcntl.F_SETFL, fcntl.fcntl(self.doorbell_write, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.stats_pipe, self.child_stats_pipe = multiprocessing.Pipe(False)
+
+		self.read_count = 0
+		self.dropped = 0
+		self.resyncs = 0
+		self.samples = 0
+		self.stopped = False
+		self.final_stats = None
+
+		self.process = multiprocessing.Process(target=self.acquire, args=(self.child_stats_pipe,), name='qcacquire')
+		self.process.daemon = True
+
+
+	def start(self):
+		self.process.start()
+
+		#-----------------------------------------------------------------------------------
+		# Only the acquisition process writes the doorbell, so EOF means it has gone
+		#-----------------------------------------------------------------------------------
+		os.close(self.doorbell_write)
+		self.child_stats_pipe.close()
+
+	############################################################################################
+	#
+	# The acquisition process: Ctrl-C is for the control process, which asks this one to stop
+	# through the ring header.  A full ring drops the new sample rather than touching records
+	# the control process may be reading.
+	#
+	############################################################################################
+	def acquire(self, stats_pipe):
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		os.close(self.doorbell_read)
+
+		write_count = 0
+		dropped = 0
+		try:
+			while COUNT_STRUCT.unpack_from(self.ring, STOP_REQUEST)[0] == 0:
+				sample_time, sensors = self.read_sample()
+
+				read_count = COUNT_STRUCT.unpack_from(self.ring, READ_COUNT)[0]
+				if (write_count - read_count) & COUNT_MASK >= self.capacity:
+					dropped += 1
+					COUNT_STRUCT.pack_into(self.ring, DROPPED_COUNT, dropped & COUNT_MASK)
+					continue
+
+				sequence = (write_count + 1) & COUNT_MASK
+				record_offset = RING_START + (write_count % self.capacity) * self.record_size
+				self.record_struct.pack_into(self.ring, record_offset, sequence, sample_time, *sensors)
+				COUNT_STRUCT.pack_into(self.ring, record_offset + self.trailer_offset, sequence)
+				write_count = sequence
+				COUNT_STRUCT.pack_into(self.ring, WRITE_COUNT, write_count)
+
+				try:
+					os.write(self.doorbell_write, b'.')
+				except OSError as err:
+					if err.errno != errno.EAGAIN:
+						raise
+		finally:
+			stats_pipe.send(self.stats() if self.stats is not None else None)
+			stats_pipe.close()
+
+	############################################################################################
+	#
+	# The control process's read: the next sample in order, waiting for it if need be.  If the
+	# ring filled while the control process wasn't reading - during the pre-flight countdown
+	# for example - the backlog is stale, so like a FIFO overflow it's discarded and counted.
+	#
+	############################################################################################
+	def read(self):
+		dropped = COUNT_STRUCT.unpack_from(self.ring, DROPPED_COUNT)[0]
+		if dropped != self.dropped:
+			self.dropped = dropped
+			self.read_count = COUNT_STRUCT.unpack_from(self.ring, WRITE_COUNT)[0]
+			COUNT_STRUCT.pack_into(self.ring, READ_COUNT, self.read_count)
+			self.resyncs += 1
+
+		while True:
+			write_count = COUNT_STRUCT.unpack_from(self.ring, WRITE_COUNT)[0]
+			if write_count != self.read_count:
+				#---------------------------------------------------------------------------
+				# The write count may be seen before the record it counts, so the record
+				# is only taken once its trailing sequence number, written last, and then
+				# its leading one both confirm it's the one the count promised
+				#---------------------------------------------------------------------------
+				record_offset = RING_START + (self.read_count % self.capacity) * self.record_size
+				sequence = (self.read_count + 1) & COUNT_MASK
+				if COUNT_STRUCT.unpack_from(self.ring, record_offset + self.trailer_offset)[0] == sequence:
+					record = self.record_struct.unpack_from(self.ring, record_offset)
+					if record[0] == sequence:
+						self.read_count = sequence
+						COUNT_STRUCT.pack_into(self.ring, READ_COUNT, sequence)
+						return record[1], record[2:]
+				continue
+
+			#-----------------------------------------------------------------------------------
+			# Python 2 doesn't retry a read interrupted by Ctrl-C itself
+			#-----------------------------------------------------------------------------------
+			try:
+				doorbells = os.read(self.doorbell_read, self.capacity)
+			except OSError as err:
+				if err.errno != errno.EINTR:
+					raise
+				continue
+
+			if len(doorbells) == 0:
+				raise IOError(errno.EPIPE, "sensor acquisition process has stopped")
+
+
+	def stop(self):
+		#-----------------------------------------------------------------------------------
+		# Ask the acquisition process to finish its current sample and exit; it may be
+		# blocked waiting for a data ready edge that never comes, hence the time limit.
+		#-----------------------------------------------------------------------------------
+		if self.stopped:
+			return self.final_stats
+		self.stopped = True
+
+		COUNT_STRUCT.pack_into(self.ring, STOP_REQUEST, 1)
+		self.process.join(1.0)
+		if self.process.is_alive():
+			self.process.terminate()
+			self.process.join()
+
+		if self.stats_pipe.poll():
+			self.final_stats = self.stats_pipe.recv()
+
+		self.samples = COUNT_STRUCT.unpack_from(self.ring, WRITE_COUNT)[0]
+		self.dropped = COUNT_STRUCT.unpack_from(self.ring, DROPPED_COUNT)[0]
+		os.close(self.doorbell_read)
+		self.ring.close()
+		os.unlink(self.ring_name)
+		return self.final_stats
+
+
+	def getCounts(self):
+		return self.samples, self.dropped, self.resyncs
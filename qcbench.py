@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Microbenchmarks for the Raspberry Pi Python Quadcopter Flight Controller hot paths.       ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+from __future__ import print_function
+import atexit
+import copy
+import datetime
+import gc
+import getopt
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from array import array
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+import qc
+import qcrecorder
+
+############################################################################################
+#
+# Stand-ins so each kernel is timed on its own rather than with the I2C bus, the data ready
+# interrupt wait or the PWM DMA driver.
+#
+############################################################################################
+class FastClock:
+	"The time module without the sleeps, to skip the MPU6050 boot delays"
+
+	def time(self):
+		return time.time()
+
+	def sleep(self, seconds):
+		pass
+
+
+class FixedBus:
+	"An SMBus that always returns the same sensor frame"
+
+	def __init__(self, block):
+		self.block = block
+
+	def read_i2c_block_data(self, address, reg, length):
+		return self.block[:length]
+
+
+class NullGPIO:
+	def edge_detect_wait(self, pin):
+		pass
+
+
+class NullPWM:
+	def add_channel_pulse(self, dma_channel, gpio, start, width):
+		pass
+
+############################################################################################
+#
+# Sensor frame decode: the original per-byte sign fix versus one precompiled struct unpack.
+# Both start from what smbus.read_i2c_block_data() hands back - a list of 14 unsigned bytes.
+#
+############################################################################################
+SENSOR_STRUCT = struct.Struct('>7h')
+SENSOR_BLOCK = list(bytearray(struct.pack('>7h', -1234, 5678, 16384, -3400, 32767, -32768, 7)))
+
+def DecodeLoop(block, result_array):
+	sensor_data = list(block)
+	for index in range(0, 14, 2):
+		if (sensor_data[index] > 127):
+			sensor_data[index] -= 256
+		result_array[int(index / 2)] = (sensor_data[index] << 8) + sensor_data[index + 1]
+	return result_array
+
+def DecodeStruct(block, sensor_data):
+	sensor_data[0:14] = block
+	return SENSOR_STRUCT.unpack_from(sensor_data)
+
+def BenchDecode(iterations):
+	result_array = array('h', [0, 0, 0, 0, 0, 0, 0])
+	sensor_data = bytearray(14)
+	assert tuple(DecodeLoop(SENSOR_BLOCK, result_array)) == DecodeStruct(SENSOR_BLOCK, sensor_data)
+
+	before = min(timeit.repeat(lambda: DecodeLoop(SENSOR_BLOCK, result_array), number=iterations, repeat=5))
+	after = min(timeit.repeat(lambda: DecodeStruct(SENSOR_BLOCK, sensor_data), number=iterations, repeat=5))
+
+	print("decode before: %.0f ns/op" % (before * 1e9 / iterations))
+	print("decode after:  %.0f ns/op" % (after * 1e9 / iterations))
+	print("speedup:       %.1fx" % (before / after))
+
+############################################################################################
+#
+# Frame transforms: a motion tick's two E2QFrame calls against one Rotation applied twice, and
+# offline, a loop of E2QFrame calls against one batch of NumPy Rotations
+#
+############################################################################################
+BATCH_SIZE = 1000
+
+def BenchRotation(iterations):
+	def TickFunctions():
+		qc.E2QFrame(0.0, 0.0, 0.3, 0.05, -0.04, 0.3, 0.06)
+		qc.E2QFrame(0.01, -0.02, 1.0, 0.05, -0.04, 0.3, 0.06)
+
+	rotation = qc.Rotation()
+	def TickRotation():
+		rotation.setAngles(0.05, -0.04, 0.3)
+		rotation.e2q(0.0, 0.0, 0.3)
+		rotation.e2q(0.01, -0.02, 1.0)
+
+	before = min(timeit.repeat(TickFunctions, number=iterations, repeat=5))
+	after = min(timeit.repeat(TickRotation, number=iterations, repeat=5))
+	print("tick E2QFrame x2:         %.0f ns/op" % (before * 1e9 / iterations))
+	print("tick Rotation + e2q x2:   %.0f ns/op" % (after * 1e9 / iterations))
+	print("speedup:                  %.1fx" % (before / after))
+
+	import qcoffline
+	if qcoffline.numpy is None:
+		print("batch: needs NumPy")
+		return
+
+	angles = qcoffline.numpy.linspace(-0.5, 0.5, BATCH_SIZE)
+	angle_list = angles.tolist()
+	def BatchFunctions():
+		for angle in angle_list:
+			qc.E2QFrame(0.01, -0.02, 1.0, angle, -angle, angle, 0.0)
+
+	def BatchRotations():
+		qcoffline.Rotations(angles, -angles, angles).e2q(0.01, -0.02, 1.0)
+
+	batch_iterations = max(1, iterations // BATCH_SIZE)
+	before = min(timeit.repeat(BatchFunctions, number=batch_iterations, repeat=5))
+	after = min(timeit.repeat(BatchRotations, number=batch_iterations, repeat=5))
+	print("batch %d E2QFrame:      %.0f ns/attitude" % (BATCH_SIZE, before * 1e9 / (batch_iterations * BATCH_SIZE)))
+	print("batch %d Rotations:     %.0f ns/attitude" % (BATCH_SIZE, after * 1e9 / (batch_iterations * BATCH_SIZE)))
+	print("speedup:                  %.1fx" % (before / after))
+
+############################################################################################
+#
+# Time one kernel: best of 5 runs in ns/op, plus the peak bytes allocated during a single
+# call and the blocks still allocated after it (tracemalloc, so Python 3 only).
+#
+############################################################################################
+def Measure(kernel, iterations):
+	ns_per_op = min(timeit.repeat(kernel, number=iterations, repeat=5)) * 1e9 / iterations
+
+	alloc_bytes = None
+	alloc_blocks = None
+	if tracemalloc is not None:
+		gc.disable()
+		tracemalloc.start()
+		kernel()
+		baseline_bytes = tracemalloc.get_traced_memory()[0]
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+		kernel()
+		alloc_bytes = tracemalloc.get_traced_memory()[1] - baseline_bytes
+
+		baseline_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+		for count in range(0, 100):
+			kernel()
+		alloc_blocks = (sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename')) - baseline_blocks) / 100
+		tracemalloc.stop()
+		gc.enable()
+
+	return {'ns_per_op': ns_per_op, 'alloc_bytes': alloc_bytes, 'alloc_blocks': alloc_blocks}
+
+############################################################################################
+#
+# The control loop kernels against synthetic data
+#
+############################################################################################
+def Kernels():
+	#-----------------------------------------------------------------------------------
+	# Bring up a real MPU6050 and ESCs on the simulator, then swap in the stand-ins
+	#-----------------------------------------------------------------------------------
+	qc.logger.addHandler(logging.NullHandler())
+	qc.SetBackend('sim')
+	qc.time = FastClock()
+	mpu6050 = qc.MPU6050(0x68, 5)
+	qc.time = time
+	mpu6050.i2c.bus = FixedBus(SENSOR_BLOCK)
+	qc.RPIO = NullGPIO()
+	qc.PWM = NullPWM()
+
+	esc_list = []
+	for name, pin, angle, rotation in qc.FRAMES['quadx']:
+		esc_list.append(qc.ESC(pin, name))
+	mixer = qc.Mixer(qc.FRAMES['quadx'])
+	motor_output = qc.MotorOutput(esc_list)
+
+	#-----------------------------------------------------------------------------------
+	# Alternating spins, so every motor output call has channels to write
+	#-----------------------------------------------------------------------------------
+	spin_batches = itertools.cycle([[550, 560, 540, 550], [551, 559, 541, 549]])
+
+	#-----------------------------------------------------------------------------------
+	# readSensors with the raw read replaced, so only temperature compensation is timed
+	#-----------------------------------------------------------------------------------
+	compensation = copy.copy(mpu6050)
+	raw_sensors = mpu6050.readSensorsRaw()
+	compensation.readSensorsRaw = lambda: raw_sensors
+
+	#-----------------------------------------------------------------------------------
+	# ...and with the temperature flipping every read, so the cache lookup is timed too
+	#-----------------------------------------------------------------------------------
+	compensation_flip = copy.copy(mpu6050)
+	flip_sensors = itertools.cycle([raw_sensors, raw_sensors[:3] + (raw_sensors[3] + 1,) + raw_sensors[4:]])
+	compensation_flip.readSensorsRaw = lambda: next(flip_sensors)
+
+	pid = qc.PID(110.0, 1.0, 0.1, 0.0)
+	pid_time = [0.0]
+	def PIDCompute():
+		pid_time[0] += 0.027
+		return pid.Compute(0.01, 0.02, pid_time[0])
+
+	ahrs = qc.QuaternionAHRS(0.02, -0.01, 2.0)
+	rotation = qc.Rotation(0.05, -0.04, 0.3)
+
+	#-----------------------------------------------------------------------------------
+	# The open-loop velocity integral the Kalman filter replaces, for comparison
+	#-----------------------------------------------------------------------------------
+	velocity = [0.0, 0.0, 0.0]
+	def VelocityIntegral(qax, qay, qaz, integration_period):
+		velocity[0] += qax * integration_period * qc.GRAV_ACCEL
+		velocity[1] += qay * integration_period * qc.GRAV_ACCEL
+		velocity[2] += qaz * integration_period * qc.GRAV_ACCEL
+		return velocity[0], velocity[1], velocity[2]
+
+	velocity_kalman = qc.VelocityKalman()
+	sample_intervals = qc.IntervalHistogram("sample intervals", 0.00001, 1000)
+	#-----------------------------------------------------------------------------------
+	# The tracer as --trace runs it, so an iteration includes recording its stamps; the
+	# recorder's ring and file go in a scratch directory cleared away at exit
+	#-----------------------------------------------------------------------------------
+	trace_directory = tempfile.mkdtemp(prefix='qcbench')
+	trace_recorder = qcrecorder.FlightRecorder(qcrecorder.TRACE_FIELDS, os.path.join(trace_directory, 'trace.qcr'), os.path.join(trace_directory, 'ring'))
+	def TraceCleanup():
+		trace_recorder.stop()
+		shutil.rmtree(trace_directory)
+	atexit.register(TraceCleanup)
+	tracer = qc.StageTracer(trace_recorder)
+	def TraceIteration():
+		for stage in range(0, tracer.stage_count):
+			tracer.probe(stage)
+		tracer.commit()
+
+	return [
+		('baseline', lambda: None),
+		('readSensorsRaw', mpu6050.readSensorsRaw),
+		('readSensors_compensation', compensation.readSensors),
+		('readSensors_compensation_flip', compensation_flip.readSensors),
+		('PID.Compute', PIDCompute),
+		('QuaternionAHRS.update', lambda: ahrs.update(3.0, -5.0, 1.0, 320.0, -160.0, 16200.0, 0.001)),
+		('QuaternionAHRS.getAngles', ahrs.getAngles),
+		('GetEulerAngles', lambda: qc.GetEulerAngles(0.02, -0.01, 0.99)),
+		('E2QFrame', lambda: qc.E2QFrame(0.1, -0.2, 0.3, 0.05, -0.04, 0.3, 0.06)),
+		('Q2EFrame', lambda: qc.Q2EFrame(0.1, -0.2, 0.3, 0.05, -0.04, 0.3, 0.06)),
+		('Rotation.setAngles', lambda: rotation.setAngles(0.05, -0.04, 0.3)),
+		('Rotation.e2q', lambda: rotation.e2q(0.1, -0.2, 0.3)),
+		('velocity_integral', lambda: VelocityIntegral(0.001, -0.002, 0.003, 0.027)),
+		('VelocityKalman.update', lambda: velocity_kalman.update(0.001, -0.002, 0.003, 0.027)),
+		('IntervalHistogram.add', lambda: sample_intervals.add(0.00102)),
+		('StageTracer.probe', lambda: tracer.probe(qc.TRACE_EDGE)),
+		('StageTracer_iteration', TraceIteration),
+		('Mixer.mix', lambda: mixer.mix(550, 12, -7, 3)),
+		('ESC.update', lambda: esc_list[0].update(550)),
+		('MotorOutput.update', lambda: motor_output.update(next(spin_batches))),
+		('MotorOutput.update_unchanged', lambda: motor_output.update([550, 560, 540, 550])),
+	]
+
+############################################################################################
+#
+# Results are saved as JSON with the git commit so runs can be compared across commits
+#
+############################################################################################
+def GitCommit():
+	try:
+		with open(os.devnull, 'w') as devnull:
+			return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def RunSuite(iterations):
+	results = {}
+	for name, kernel in Kernels():
+		results[name] = Measure(kernel, iterations)
+
+	return {'commit': GitCommit(),
+		'time': datetime.datetime.now().isoformat(),
+		'python': platform.python_version(),
+		'machine': platform.machine(),
+		'iterations': iterations,
+		'results': results}
+
+
+def Report(run, previous=None):
+	print("%-26s %10s %12s %12s %10s" % ('kernel', 'ns/op', 'alloc bytes', 'alloc blocks', 'change'))
+	for name in sorted(run['results']):
+		result = run['results'][name]
+		change = ''
+		if previous is not None and name in previous['results']:
+			change = '%+.1f%%' % (100 * (result['ns_per_op'] / previous['results'][name]['ns_per_op'] - 1))
+		alloc_bytes = '-' if result['alloc_bytes'] is None else '%d' % result['alloc_bytes']
+		alloc_blocks = '-' if result['alloc_blocks'] is None else '%.2f' % result['alloc_blocks']
+		print("%-26s %10.0f %12s %12s %10s" % (name, result['ns_per_op'], alloc_bytes, alloc_blocks, change))
+
+############################################################################################
+#
+# Main
+#
+############################################################################################
+def Usage():
+	print('qcbench.py [-n iterations] [-o results.json] [-c previous.json] [--decode] [--rotation]')
+	print('  -n set the number of calls per timing run')
+	print('  -o save the results as JSON')
+	print('  -c compare against previously saved JSON results')
+	print('  --decode compare the original and struct sensor frame decoders')
+	print('  --rotation compare E2QFrame with the cached Rotation, per tick and batched')
+
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'n:o:c:', ['decode', 'rotation'])
+	except getopt.GetoptError:
+		Usage()
+		sys.exit(2)
+
+	iterations = 100000
+	output_file = None
+	compare_file = None
+	decode = False
+	rotation = False
+	for opt, arg in opts:
+		if opt == '-n':
+			iterations = int(arg)
+		elif opt == '-o':
+			output_file = arg
+		elif opt == '-c':
+			compare_file = arg
+		elif opt == '--decode':
+			decode = True
+		elif opt == '--rotation':
+			rotation = True
+
+	if decode:
+		BenchDecode(iterations)
+		sys.exit(0)
+
+	if rotation:
+		BenchRotation(iterations)
+		sys.exit(0)
+
+	previous = None
+	if compare_file is not None:
+		with open(compare_file) as previous_file:
+			previous = json.load(previous_file)
+
+	run = RunSuite(iterations)
+	Report(run, previous)
+
+	if output_file is not None:
+		with open(output_file, 'w') as results_file:
+			json.dump(run, results_file, indent=2, sort_keys=True)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Temperature compensation fitting for the Raspberry Pi Python Quadcopter Flight Controller: ##
+## stream the gravity rows qc.py -c appends to qcoffsets.csv, fit each accelerometer axis's   ##
+## offset and gain trend lines against raw temperature, and write them to the coefficients  ##
+## file MPU6050 loads at startup.                                                            ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+from __future__ import print_function
+import getopt
+import sys
+
+import qc
+
+############################################################################################
+#
+# A least squares straight line fit, updated a point at a time with running means so the sums
+# stay well conditioned over thousands of rows of large raw temperatures
+#
+############################################################################################
+class LineFit:
+
+	def __init__(self):
+		self.count = 0
+		self.mean_x = 0.0
+		self.mean_y = 0.0
+		self.sxx = 0.0
+		self.sxy = 0.0
+
+
+	def add(self, x, y):
+		self.count += 1
+		dx = x - self.mean_x
+		self.mean_x += dx / self.count
+		self.mean_y += (y - self.mean_y) / self.count
+		self.sxx += dx * (x - self.mean_x)
+		self.sxy += dx * (y - self.mean_y)
+
+
+	def line(self):
+		#-----------------------------------------------------------------------------------
+		# Rows all at one temperature give no slope, just the level
+		#-----------------------------------------------------------------------------------
+		if self.sxx == 0.0:
+			return 0.0, self.mean_y
+		m = self.sxy / self.sxx
+		return m, self.mean_y - m * self.mean_x
+
+
+	def at(self, x):
+		m, c = self.line()
+		return m * x + c
+
+############################################################################################
+#
+# Each row is the average raw gravity vector from one calibration, so each axis was pointing
+# up (reading about +1g), down (about -1g) or level (about 0g), or was tilted and says nothing
+# useful.  readSensors() computes (raw + offset) * gain, so per axis:
+#
+# - up and down rows:  offset = -(up + down) / 2, gain = 2g / (up - down)
+# - level rows only:   offset = -level, gain 1
+# - one of up / down:  offset = +/-1g - reading, gain 1
+#
+# The gain isn't linear in temperature, so its line joins the values at either end of the
+# temperature range calibrated over.
+#
+############################################################################################
+ORIENTATIONS = ['up', 'down', 'level']
+AXES = ['ax', 'ay', 'az']
+
+def Orientation(reading, one_g):
+	if reading > one_g / 2:
+		return 'up'
+	if reading < -one_g / 2:
+		return 'down'
+	if abs(reading) < one_g / 4:
+		return 'level'
+	return None
+
+
+def FitOffsets(file_name):
+	one_g = 1 / qc.SCALE_ACCEL
+	fits = dict(((axis, orientation), LineFit()) for axis in AXES for orientation in ORIENTATIONS)
+	temp_min = None
+	temp_max = None
+	rows = 0
+
+	with open(file_name) as offsets_file:
+		for line in offsets_file:
+			fields = line.split(',')
+			if len(fields) != 5:
+				continue
+			try:
+				temp_raw = float(fields[0])
+				gravity = [float(field) for field in fields[2:]]
+			except ValueError:
+				continue
+
+			rows += 1
+			if temp_min is None or temp_raw < temp_min:
+				temp_min = temp_raw
+			if temp_max is None or temp_raw > temp_max:
+				temp_max = temp_raw
+
+			for axis, reading in zip(AXES, gravity):
+				orientation = Orientation(reading, one_g)
+				if orientation is not None:
+					fits[(axis, orientation)].add(temp_raw, reading)
+
+	if rows == 0:
+		raise ValueError("%s has no calibration rows" % file_name)
+
+	coefficients = {}
+	counts = {}
+	for axis in AXES:
+		up = fits[(axis, 'up')]
+		down = fits[(axis, 'down')]
+		level = fits[(axis, 'level')]
+		counts[axis] = (up.count, down.count, level.count)
+
+		if up.count != 0 and down.count != 0:
+			up_m, up_c = up.line()
+			down_m, down_c = down.line()
+			offset = (-(up_m + down_m) / 2, -(up_c + down_c) / 2)
+
+			gain_min = 2 * one_g / (up.at(temp_min) - down.at(temp_min))
+			gain_max = 2 * one_g / (up.at(temp_max) - down.at(temp_max))
+			if temp_max == temp_min:
+				gain = (0.0, gain_min)
+			else:
+				gain_m = (gain_max - gain_min) / (temp_max - temp_min)
+				gain = (gain_m, gain_min - gain_m * temp_min)
+
+		elif level.count != 0:
+			level_m, level_c = level.line()
+			offset = (-level_m, -level_c)
+			gain = (0.0, 1.0)
+
+		elif up.count != 0 or down.count != 0:
+			sign, fit = (1, up) if up.count != 0 else (-1, down)
+			fit_m, fit_c = fit.line()
+			offset = (-fit_m, sign * one_g - fit_c)
+			gain = (0.0, 1.0)
+
+		else:
+			raise ValueError("%s has no rows with the %s axis up, down or level" % (file_name, axis))
+
+		coefficients[axis + '_offset'] = offset
+		coefficients[axis + '_gain'] = gain
+
+	return coefficients, counts, rows, temp_min, temp_max
+
+
+def WriteCoefficients(coefficients, counts, rows, temp_min, temp_max, source, coefficients_file):
+	coefficients_file.write('# Fitted by qcfit.py from %d rows of %s, raw temperature %d to %d\n' % (rows, source, temp_min, temp_max))
+	for axis in AXES:
+		coefficients_file.write('# %s rows: %d up, %d down, %d level\n' % ((axis,) + counts[axis]))
+	for name in qc.COEFFICIENT_NAMES:
+		coefficients_file.write('%s, %.12g, %.12g\n' % ((name,) + coefficients[name]))
+
+############################################################################################
+#
+# Main
+#
+############################################################################################
+def Usage():
+	print('qcfit.py [-o coefficients.csv] [qcoffsets.csv]')
+	print('  -o write the coefficients here rather than %s' % qc.COEFFICIENTS_FILE)
+
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'o:')
+	except getopt.GetoptError:
+		Usage()
+		sys.exit(2)
+
+	if len(args) > 1:
+		Usage()
+		sys.exit(2)
+
+	output_file = qc.COEFFICIENTS_FILE
+	for opt, arg in opts:
+		if opt == '-o':
+			output_file = arg
+	offsets_file = args[0] if len(args) == 1 else './qcoffsets.csv'
+
+	try:
+		coefficients, counts, rows, temp_min, temp_max = FitOffsets(offsets_file)
+	except (IOError, ValueError) as err:
+		print(err)
+		sys.exit(1)
+
+	with open(output_file, 'w') as coefficients_file:
+		WriteCoefficients(coefficients, counts, rows, temp_min, temp_max, offsets_file, coefficients_file)
+
+	for name in qc.COEFFICIENT_NAMES:
+		print("%-10s m = %.12g, c = %.12g" % ((name,) + coefficients[name]))
+	print("%d rows fitted into %s" % (rows, output_file))
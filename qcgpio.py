@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Data ready edges for the Raspberry Pi Python Quadcopter Flight Controller from the GPIO   ##
+## character device: the kernel queues each rising edge on /dev/gpiochipN with a timestamp   ##
+## taken in its interrupt handler, so a sample is stamped with when it was ready rather than ##
+## when python got round to reading it.  The line is a plain fd, waited on through an epoll  ##
+## loop that other fds can join.                                                             ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import errno
+import fcntl
+import os
+import select
+import struct
+
+############################################################################################
+#
+# From linux/gpio.h, the v2 uAPI: GPIO_V2_GET_LINE_IOCTL fills in the fd of a line request,
+# and each read of that fd returns whole gpio_v2_line_event structs.
+#
+# struct gpio_v2_line_request {
+#	__u32 offsets[64]; char consumer[32];
+#	struct gpio_v2_line_config { __u64 flags; __u32 num_attrs; __u32 padding[5];
+#	                             struct gpio_v2_line_config_attribute attrs[10]; } config;
+#	__u32 num_lines; __u32 event_buffer_size; __u32 padding[5]; __s32 fd; };
+#
+# struct gpio_v2_line_event {
+#	__u64 timestamp_ns; __u32 id; __u32 offset; __u32 seqno; __u32 line_seqno;
+#	__u32 padding[6]; };
+#
+############################################################################################
+GPIO_V2_GET_LINE_IOCTL = 0xC250B407
+
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_EVENT_CLOCK_REALTIME = 1 << 11
+
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+
+LINE_REQUEST_STRUCT = struct.Struct('=64I32sQI20x240xII20xi')
+LINE_EVENT_STRUCT = struct.Struct('=QIIII24x')
+
+#-------------------------------------------------------------------------------------------
+# The realtime event clock puts the timestamps in time.time()'s time base.  Events are read
+# as many at a time as the kernel buffers by default for one line.
+#-------------------------------------------------------------------------------------------
+GPIOCHIP = '/dev/gpiochip0'
+CONSUMER = b'qc data ready'
+EVENT_BATCH = 16
+
+############################################################################################
+#
+# An epoll loop dispatching readable fds to their handlers.  poll() returns after handling
+# whatever was ready, or on timeout, so the caller decides what it's waiting for.
+#
+############################################################################################
+class EventLoop:
+
+	def __init__(self):
+		self.epoll = select.epoll()
+		self.handlers = {}
+
+
+	def register(self, fd, handler):
+		self.epoll.register(fd, select.EPOLLIN)
+		self.handlers[fd] = handler
+
+
+	def unregister(self, fd):
+		self.epoll.unregister(fd)
+		del self.handlers[fd]
+
+
+	def poll(self, timeout=-1):
+		#-----------------------------------------------------------------------------------
+		# Python 2 doesn't retry a poll interrupted by a signal; the caller simply polls
+		# again, or sees the KeyboardInterrupt
+		#-----------------------------------------------------------------------------------
+		try:
+			events = self.epoll.poll(timeout)
+		except IOError as err:
+			if err.errno != errno.EINTR:
+				raise
+			return
+
+		for fd, event in events:
+			self.handlers[fd](fd)
+
+
+	def close(self):
+		self.epoll.close()
+
+############################################################################################
+#
+# A line delivering rising edge events on fd.  wait() returns the timestamp of the newest
+# edge not yet waited for, blocking in the loop until there is one.  Any older edges it
+# replaces were samples missed, as are gaps in the kernel's per-line sequence numbers when
+# its buffer overflowed.
+#
+############################################################################################
+class EdgeEventLine:
+
+	def __init__(self, fd, loop=None):
+		self.fd = fd
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.loop = EventLoop() if loop is None else loop
+		self.loop.register(fd, self.readEvents)
+
+		self.timestamp = None
+		self.line_seqno = None
+		self.edges = 0
+		self.missed = 0
+
+
+	def fileno(self):
+		return self.fd
+
+
+	def readEvents(self, fd):
+		#-----------------------------------------------------------------------------------
+		# Read until the queue is empty, so the edge wait() returns is the newest one, for
+		# the sample now in the data registers, however many built up during a stall
+		#-----------------------------------------------------------------------------------
+		batch_size = LINE_EVENT_STRUCT.size * EVENT_BATCH
+		while True:
+			try:
+				data = os.read(fd, batch_size)
+			except OSError as err:
+				if err.errno != errno.EAGAIN:
+					raise
+				return
+
+			for offset in range(0, len(data) - LINE_EVENT_STRUCT.size + 1, LINE_EVENT_STRUCT.size):
+				timestamp_ns, event_id, line, seqno, line_seqno = LINE_EVENT_STRUCT.unpack_from(data, offset)
+				if event_id != GPIO_V2_LINE_EVENT_RISING_EDGE:
+					continue
+
+				self.edges += 1
+				if self.timestamp is not None:
+					self.missed += 1
+				if self.line_seqno is not None and line_seqno - self.line_seqno > 1:
+					self.missed += line_seqno - self.line_seqno - 1
+				self.line_seqno = line_seqno
+				self.timestamp = timestamp_ns / 1000000000
+
+			if len(data) < batch_size:
+				return
+
+
+	def wait(self):
+		while self.timestamp is None:
+			self.loop.poll()
+		timestamp = self.timestamp
+		self.timestamp = None
+		return timestamp
+
+
+	def getCounts(self):
+		return self.edges, self.missed
+
+
+	def close(self):
+		if self.fd is not None:
+			self.loop.unregister(self.fd)
+			os.close(self.fd)
+			self.fd = None
+
+############################################################################################
+#
+# Request a GPIO line as a rising edge input on the chip and return it as an EdgeEventLine.
+# The chip fd is only needed for the request; the line stays claimed until its fd is closed.
+#
+############################################################################################
+def RequestLine(offset, chip=GPIOCHIP, loop=None):
+	request = bytearray(LINE_REQUEST_STRUCT.size)
+	flags = GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_RISING | GPIO_V2_LINE_FLAG_EVENT_CLOCK_REALTIME
+	LINE_REQUEST_STRUCT.pack_into(request, 0, *([offset] + [0] * 63 + [CONSUMER, flags, 0, 1, 0, 0]))
+
+	chip_fd = os.open(chip, os.O_RDWR)
+	try:
+		fcntl.ioctl(chip_fd, GPIO_V2_GET_LINE_IOCTL, request, True)
+	finally:
+		os.close(chip_fd)
+
+	return EdgeEventLine(LINE_REQUEST_STRUCT.unpack_from(request)[-1], loop)
+
+############################################################################################
+#
+# A stand-in line on a pipe: trigger() writes the event the kernel would for an edge at the
+# given time, so the same event parsing and epoll waiting runs without hardware.
+#
+############################################################################################
+class FakeEdgeEventLine(EdgeEventLine):
+
+	def __init__(self, offset=0, loop=None):
+		read_fd, self.write_fd = os.pipe()
+		EdgeEventLine.__init__(self, read_fd, loop)
+		self.offset = offset
+		self.seqno = 0
+
+
+	def trigger(self, timestamp):
+		self.seqno += 1
+		os.write(self.write_fd, LINE_EVENT_STRUCT.pack(int(round(timestamp * 1000000000)), GPIO_V2_LINE_EVENT_RISING_EDGE, self.offset, self.seqno, self.seqno))
+
+
+	def close(self):
+		EdgeEventLine.close(self)
+		if self.write_fd is not None:
+			os.close(self.write_fd)
+			self.write_fd = None
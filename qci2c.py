@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Direct I2C for the Raspberry Pi Python Quadcopter Flight Controller: a python-smbus style ##
+## bus on /dev/i2c-N that reads a register block with a single I2C_RDWR ioctl - register     ##
+## address write, repeated start, N byte read - straight into the caller's bytearray, so     ##
+## there's no list built per read and no 32 byte SMBus block limit on FIFO drains.           ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import ctypes
+import errno
+import fcntl
+import os
+
+############################################################################################
+#
+# From linux/i2c-dev.h and linux/i2c.h: the ioctl takes a pointer to an i2c_rdwr_ioctl_data,
+# which points to an array of i2c_msg, each of which points to its data
+#
+############################################################################################
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+class i2c_msg(ctypes.Structure):
+	_fields_ = [('addr', ctypes.c_uint16),
+	            ('flags', ctypes.c_uint16),
+	            ('len', ctypes.c_uint16),
+	            ('buf', ctypes.c_void_p)]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+	_fields_ = [('msgs', ctypes.c_void_p),
+	            ('nmsgs', ctypes.c_uint32)]
+
+#-------------------------------------------------------------------------------------------
+# The largest block the list-based calls handle, the whole MPU6050 FIFO; readinto() is only
+# limited by the caller's buffer and the 16 bit message length
+#-------------------------------------------------------------------------------------------
+BLOCK_MAX = 1024
+MESSAGE_MAX = 0xFFFF
+
+############################################################################################
+#
+# The bus.  The messages, the register byte and the data buffers are all allocated once here;
+# a transfer only fills in lengths and addresses.  ioctl defaults to the real one on the open
+# device, or is the Loopback's for tests.
+#
+############################################################################################
+class I2CRdwrBus:
+
+	def __init__(self, bus_number=1, ioctl=None):
+		if ioctl is None:
+			self.fd = os.open('/dev/i2c-%d' % bus_number, os.O_RDWR)
+			self.ioctl = fcntl.ioctl
+		else:
+			self.fd = None
+			self.ioctl = ioctl
+		self.block_size = BLOCK_MAX
+
+		#-----------------------------------------------------------------------------------
+		# The register address and any data written after it, and the buffer for the
+		# list-based reads
+		#-----------------------------------------------------------------------------------
+		self.write_data = bytearray(1 + BLOCK_MAX)
+		self.write_view = (ctypes.c_uint8 * len(self.write_data)).from_buffer(self.write_data)
+		self.read_data = bytearray(BLOCK_MAX)
+
+		self.msgs = (i2c_msg * 2)()
+		self.write_msg = self.msgs[0]
+		self.read_msg = self.msgs[1]
+		self.write_msg.buf = ctypes.addressof(self.write_view)
+		self.read_msg.flags = I2C_M_RD
+		self.rdwr = i2c_rdwr_ioctl_data(ctypes.addressof(self.msgs), 2)
+		self.rdwr_address = ctypes.addressof(self.rdwr)
+
+		#-----------------------------------------------------------------------------------
+		# Read buffers seen so far, by id: the buffer itself, its ctypes view, which stops it
+		# being resized while the view exists, and its address
+		#-----------------------------------------------------------------------------------
+		self.views = {}
+
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+
+	def bufferAddress(self, buffer):
+		view = self.views.get(id(buffer))
+		if view is None or view[0] is not buffer:
+			ctypes_view = (ctypes.c_uint8 * len(buffer)).from_buffer(buffer)
+			view = (buffer, ctypes_view, ctypes.addressof(ctypes_view))
+			self.views[id(buffer)] = view
+		return view[2]
+
+
+	def readinto(self, address, reg, buffer, offset, length):
+		#-----------------------------------------------------------------------------------
+		# Write the register address, then read length bytes from it into buffer[offset:]
+		# under one repeated start transaction
+		#-----------------------------------------------------------------------------------
+		if offset < 0 or length < 1 or length > MESSAGE_MAX or offset + length > len(buffer):
+			raise ValueError("cannot read %d bytes into offset %d of a %d byte buffer" % (length, offset, len(buffer)))
+
+		self.write_data[0] = reg
+		self.write_msg.addr = address
+		self.write_msg.len = 1
+		self.read_msg.addr = address
+		self.read_msg.len = length
+		self.read_msg.buf = self.bufferAddress(buffer) + offset
+		self.rdwr.nmsgs = 2
+		self.ioctl(self.fd, I2C_RDWR, self.rdwr_address)
+
+
+	def write(self, address, length):
+		self.write_msg.addr = address
+		self.write_msg.len = length
+		self.rdwr.nmsgs = 1
+		self.ioctl(self.fd, I2C_RDWR, self.rdwr_address)
+
+	############################################################################################
+	#
+	# The python-smbus calls the I2C class makes, so this is a drop-in for smbus.SMBus
+	#
+	############################################################################################
+	def write_byte_data(self, address, reg, value):
+		self.write_data[0] = reg
+		self.write_data[1] = value & 0xFF
+		self.write(address, 2)
+
+
+	def write_i2c_block_data(self, address, reg, data):
+		if len(data) > BLOCK_MAX:
+			raise ValueError("cannot write %d bytes, %d at most" % (len(data), BLOCK_MAX))
+		self.write_data[0] = reg
+		self.write_data[1:1 + len(data)] = bytearray(data)
+		self.write(address, 1 + len(data))
+
+
+	def read_byte_data(self, address, reg):
+		self.readinto(address, reg, self.read_data, 0, 1)
+		return self.read_data[0]
+
+
+	def read_i2c_block_data(self, address, reg, length=32):
+		if length > BLOCK_MAX:
+			raise ValueError("cannot read %d bytes, %d at most" % (length, BLOCK_MAX))
+		self.readinto(address, reg, self.read_data, 0, length)
+		return list(self.read_data[:length])
+
+
+def SMBus(bus_number):
+	return I2CRdwrBus(bus_number)
+
+############################################################################################
+#
+# A loopback stand-in for the kernel's I2C_RDWR, serving each transaction from register-level
+# devices by address - anything with read(reg, length) and write(reg, value), such as the
+# qcsim MPU6050 - so the same message building and buffer handling runs without hardware.
+# Like the real one, a message to an address with no device fails with ENXIO.
+#
+############################################################################################
+class Loopback:
+
+	def __init__(self, devices):
+		self.devices = devices
+		self.transactions = 0
+
+
+	def SMBus(self, bus_number):
+		return I2CRdwrBus(bus_number, self.ioctl)
+
+
+	def ioctl(self, fd, request, arg):
+		if request != I2C_RDWR:
+			raise IOError(errno.ENOTTY, "Inappropriate ioctl for device")
+
+		rdwr = i2c_rdwr_ioctl_data.from_address(arg)
+		msgs = (i2c_msg * rdwr.nmsgs).from_address(rdwr.msgs)
+		self.transactions += 1
+
+		#-----------------------------------------------------------------------------------
+		# A write sets the register address, and any more bytes are written from there on;
+		# a read carries on from the last address written
+		#-----------------------------------------------------------------------------------
+		reg = 0
+		for msg in msgs:
+			device = self.devices.get(msg.addr)
+			if device is None:
+				raise IOError(errno.ENXIO, "No such device or address")
+
+			data = (ctypes.c_uint8 * msg.len).from_address(msg.buf)
+			if msg.flags & I2C_M_RD:
+				data[:] = device.read(reg, msg.len)
+			else:
+				reg = data[0]
+				for offset in range(1, msg.len):
+					device.write(reg + offset - 1, data[offset])
+		return 0
@@ -0,0 +1,807 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Offline re-evaluation of a captured flight for the Raspberry Pi Python Quadcopter Flight  ##
+## Controller: the motion processing of qc.py - integration, complementary filter, Euler     ##
+## angles, gravity removal and the 7 PIDs - run as NumPy column operations over a whole      ##
+## --capture recording, so --tau, -m and gain variants can be compared in well under a       ##
+## second.                                                                                   ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+from __future__ import print_function
+import getopt
+import logging
+import math
+import os
+import sys
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+import qc
+import qcrecorder
+import qcsim
+
+############################################################################################
+#
+# How closely the vectorized path must match a diagnostics recording from the scalar path
+# (a replay of the same capture with -d).  The integrals are summed in a different order, so
+# floating point columns match to within a relative 1e-6; an output rounded to a whole pulse
+# width can land either side of .5, so integer columns match to within 1us.
+#
+############################################################################################
+FLOAT_RTOL = 1e-6
+FLOAT_ATOL = 1e-9
+INTEGER_ATOL = 1
+
+NUMPY_CODES = {'d': '<f8', 'i': '<i4', 'h': '<i2', 'I': '<u4'}
+
+#-------------------------------------------------------------------------------------------
+# Samples qc.py uses ahead of the motion loop: gyro calibration, the primer and 1000 samples
+# for gravity, then the sample the PIDs are started on
+#-------------------------------------------------------------------------------------------
+GYRO_CALIBRATION_SAMPLES = 100
+GRAVITY_SAMPLES = 1000
+MOTION_START = GYRO_CALIBRATION_SAMPLES + 1 + GRAVITY_SAMPLES
+
+#-------------------------------------------------------------------------------------------
+# ESC pulse width limits in microseconds, as ESC.update()
+#-------------------------------------------------------------------------------------------
+MIN_PULSE_WIDTH = 1000
+MAX_PULSE_WIDTH = 2000
+
+#-------------------------------------------------------------------------------------------
+# The complementary filter is solved in blocks short enough that the running product of the
+# filter fractions never underflows
+#-------------------------------------------------------------------------------------------
+RECURRENCE_BLOCK = 32
+
+############################################################################################
+#
+# Load a flight recording into a NumPy structured array in sequence order, one named column
+# per field
+#
+############################################################################################
+def RecordDtype(fields):
+	return numpy.dtype([('sequence', '<u4')] + [(column, NUMPY_CODES[code]) for column, code, csv_format, degrees in fields])
+
+
+def RecordingArray(file_name, fields):
+	record_struct = qcrecorder.RecordStruct(fields)
+
+	with open(file_name, 'rb') as record_file:
+		data = record_file.read()
+
+	magic, record_size, capacity = qcrecorder.HEADER_STRUCT.unpack_from(data)
+	if magic != qcrecorder.RECORDER_MAGIC or record_size != record_struct.size:
+		raise ValueError("%s is not a flight recording with this layout" % file_name)
+
+	count = (len(data) - qcrecorder.HEADER_STRUCT.size) // record_size
+	records = numpy.frombuffer(data, RecordDtype(fields), count, qcrecorder.HEADER_STRUCT.size)
+	records = records[records['sequence'] != 0]
+	return records[numpy.argsort(records['sequence'], kind='mergesort')]
+
+############################################################################################
+#
+# Vectorized versions of the qc.py building blocks.  Each does the same arithmetic in the same
+# order as its scalar original, so elementwise results are identical.
+#
+############################################################################################
+def Compensate(capture, coefficients_file=None):
+	#-----------------------------------------------------------------------------------
+	# MPU6050.readSensors() without the gyro offsets, which come from calibration, and
+	# with the same temperature coefficients qc.py would load
+	#-----------------------------------------------------------------------------------
+	if coefficients_file is not None:
+		coefficients = qc.LoadCoefficients(coefficients_file)
+	else:
+		coefficients = dict((name, (getattr(qc.MPU6050, name + '_m'), getattr(qc.MPU6050, name + '_c'))) for name in qc.COEFFICIENT_NAMES)
+
+	temp = capture['temp'].astype(numpy.float64)
+
+	ax_offset = temp * coefficients['ax_offset'][0] + coefficients['ax_offset'][1]
+	ay_offset = temp * coefficients['ay_offset'][0] + coefficients['ay_offset'][1]
+	az_offset = temp * coefficients['az_offset'][0] + coefficients['az_offset'][1]
+	ax_gain = temp * coefficients['ax_gain'][0] + coefficients['ax_gain'][1]
+	ay_gain = temp * coefficients['ay_gain'][0] + coefficients['ay_gain'][1]
+	az_gain = temp * coefficients['az_gain'][0] + coefficients['az_gain'][1]
+
+	qax = (capture['ax'] + ax_offset) * ax_gain
+	qay = (capture['ay'] + ay_offset) * ay_gain
+	qaz = (capture['az'] + az_offset) * az_gain
+
+	return qax, qay, qaz
+
+
+def GetEulerAngles(ax, ay, az):
+	pitch = numpy.arctan2(ax, numpy.sqrt(ay * ay + az * az))
+	roll = numpy.arctan2(ay, numpy.sqrt(ax * ax + az * az))
+	tilt = numpy.arctan2(numpy.sqrt(ax * ax + ay * ay), az)
+	return pitch, roll, tilt
+
+
+#-------------------------------------------------------------------------------------------
+# qc.Rotation for N attitudes at once: each matrix element is an array, so e2q() and q2e()
+# transform one vector per attitude, or the same vector for every attitude
+#-------------------------------------------------------------------------------------------
+class Rotations(qc.Rotation):
+
+	def setAngles(self, pa, ra, ya):
+		c_pa = numpy.cos(pa)
+		s_pa = -numpy.sin(pa)
+		c_ra = numpy.cos(ra)
+		s_ra = numpy.sin(ra)
+		c_ya = numpy.cos(ya)
+		s_ya = numpy.sin(ya)
+
+		self.m00 = c_pa * c_ya
+		self.m01 = c_pa * s_ya
+		self.m02 = -s_pa
+		self.m10 = s_ra * s_pa * c_ya - c_ra * s_ya
+		self.m11 = s_ra * s_pa * s_ya + c_ra * c_ya
+		self.m12 = s_ra * c_pa
+		self.m20 = c_ra * s_pa * c_ya + s_ra * s_ya
+		self.m21 = c_ra * s_pa * s_ya - s_ra * c_ya
+		self.m22 = c_pa * c_ra
+
+
+	def getMatrix(self):
+		#-----------------------------------------------------------------------------------
+		# An N x 3 x 3 array of the matrices
+		#-----------------------------------------------------------------------------------
+		return numpy.stack([numpy.stack(numpy.broadcast_arrays(*row), -1) for row in qc.Rotation.getMatrix(self)], -2)
+
+
+def RunningSum(start, increments):
+	#-----------------------------------------------------------------------------------
+	# start + increments[0] + increments[1] ... accumulated left to right like +=
+	#-----------------------------------------------------------------------------------
+	return numpy.cumsum(numpy.concatenate(([start], increments)))[1:]
+
+
+def LinearRecurrence(a, b, x0):
+	#-----------------------------------------------------------------------------------
+	# x[k] = a[k] * x[k - 1] + b[k].  Within a block x[k] = P[k] * (x0 + sum(b[j] / P[j]))
+	# where P is the running product of a; the block's last x seeds the next block.
+	#-----------------------------------------------------------------------------------
+	x = numpy.empty(len(a))
+	if numpy.any(a == 0.0):
+		for k in range(0, len(a)):
+			x0 = a[k] * x0 + b[k]
+			x[k] = x0
+		return x
+
+	for start in range(0, len(a), RECURRENCE_BLOCK):
+		end = start + RECURRENCE_BLOCK
+		product = numpy.cumprod(a[start:end])
+		x[start:end] = product * (x0 + numpy.cumsum(b[start:end] / product))
+		x0 = x[start:end][-1]
+	return x
+
+
+def Round(values):
+	#-----------------------------------------------------------------------------------
+	# int(round()) as the interpreter running qc.py does it: Python 3 rounds halves to even,
+	# Python 2 away from zero
+	#-----------------------------------------------------------------------------------
+	if sys.version_info[0] >= 3:
+		return numpy.rint(values).astype(numpy.int64)
+	return numpy.where(values >= 0, numpy.floor(values + 0.5), numpy.ceil(values - 0.5)).astype(numpy.int64)
+
+
+def ComputePID(p_gain, i_gain, d_gain, input, target, times, start_time):
+	#-----------------------------------------------------------------------------------
+	# PID.Compute() for every motion tick at once
+	#-----------------------------------------------------------------------------------
+	error = target - input
+	last_error = numpy.concatenate(([0.0], error[:-1]))
+	dt = numpy.diff(numpy.concatenate(([start_time], times)))
+
+	increments = (error + last_error) * dt
+	i_error = numpy.cumsum(increments)
+
+	#-----------------------------------------------------------------------------------
+	# Once the integral first hits its limits, the clamping makes each tick depend on the
+	# last, so carry on a tick at a time from there
+	#-----------------------------------------------------------------------------------
+	if i_gain != 0.0:
+		i_err_min = -250.0 / i_gain
+		i_err_max = +250.0 / i_gain
+		clamped = numpy.flatnonzero((i_error > i_err_max) | (i_error < i_err_min))
+		if len(clamped) != 0:
+			first = clamped[0]
+			i_sum = i_error[first - 1] if first > 0 else 0.0
+			for k, increment in enumerate(increments[first:].tolist(), first):
+				i_sum += increment
+				if i_sum > i_err_max:
+					i_sum = i_err_max
+				elif i_sum < i_err_min:
+					i_sum = i_err_min
+				i_error[k] = i_sum
+
+	d_error = (error - last_error) / dt
+
+	return p_gain * error, i_gain * i_error, d_gain * d_error
+
+
+def Mix(mixer, vert_out, pr_out, rr_out, yr_out):
+	#-----------------------------------------------------------------------------------
+	# qc.Mixer.mix() plus ESC.update(), giving each motor's pulse width per tick
+	#-----------------------------------------------------------------------------------
+	spins = numpy.array([vert_out + pitch * pr_out + roll * rr_out + yaw * yr_out for pitch, roll, yaw in mixer.matrix])
+	high = spins.max(0)
+	low = spins.min(0)
+	spread = high - low
+
+	scaled = spread > mixer.max_spin
+	if numpy.any(scaled):
+		scale = mixer.max_spin / numpy.where(scaled, spread, mixer.max_spin)
+		spins = numpy.where(scaled, vert_out + (spins - vert_out) * scale, spins)
+		high = numpy.where(scaled, vert_out + (high - vert_out) * scale, high)
+		low = numpy.where(scaled, vert_out + (low - vert_out) * scale, low)
+
+	spins = numpy.where(high > mixer.max_spin, spins - (high - mixer.max_spin), numpy.where(low < 0, spins - low, spins))
+	return [numpy.clip(numpy.trunc(MIN_PULSE_WIDTH + spin), MIN_PULSE_WIDTH, MAX_PULSE_WIDTH).astype(numpy.int64) for spin in spins]
+
+############################################################################################
+#
+# Pick the motion ticks out of the sample times.  qc.py runs a tick on the first sample at least
+# a motion period after the last tick was due, and at most one tick per sample, so a late tick
+# doesn't move the ones after it.
+#
+############################################################################################
+def MotionTicks(times, motion_period, policy='catchup'):
+	if policy != 'catchup':
+		return ScheduledTicks(times, motion_period, policy)
+
+	#-----------------------------------------------------------------------------------
+	# The catchup deadline accumulated tick by tick exactly as the += in qc.py
+	#-----------------------------------------------------------------------------------
+	tick_count = int((times[-1] - times[0]) / motion_period) + 2
+	last_motion_update = numpy.cumsum(numpy.concatenate(([times[0]], numpy.repeat(motion_period, tick_count - 1))))
+
+	#-----------------------------------------------------------------------------------
+	# The earliest sample for each tick: searchsorted gets within one sample, the exact
+	# comparison qc.py makes settles it
+	#-----------------------------------------------------------------------------------
+	due = numpy.searchsorted(times, last_motion_update + motion_period).clip(1, len(times) - 1)
+	early = times[due - 1] - last_motion_update >= motion_period
+	due[early] -= 1
+	late = times[due] - last_motion_update < motion_period
+	due[late] += 1
+
+	#-----------------------------------------------------------------------------------
+	# ...but never on or before the sample the previous tick ran on
+	#-----------------------------------------------------------------------------------
+	tick_number = numpy.arange(1, len(due) + 1)
+	ticks = numpy.maximum.accumulate(due - tick_number) + tick_number
+	return ticks[ticks < len(times)]
+
+
+def ScheduledTicks(times, motion_period, policy):
+	#-----------------------------------------------------------------------------------
+	# Under skip and coalesce each deadline depends on when the last tick ran, so walk
+	# the ticks with qc.MotionDeadline itself, searching for each in turn
+	#-----------------------------------------------------------------------------------
+	deadline = qc.MotionDeadline(policy, float(times[0]))
+	ticks = []
+	index = 0
+	while True:
+		index = max(index + 1, int(numpy.searchsorted(times, deadline.last_update + motion_period)) - 1)
+		while index < len(times) and not deadline.due(float(times[index]), motion_period):
+			index += 1
+		if index == len(times):
+			return numpy.array(ticks, dtype=numpy.int64)
+
+		deadline.advance(float(times[index]), motion_period)
+		ticks.append(index)
+
+############################################################################################
+#
+# Re-run qc.py's motion processing over a capture, returning the diagnostics columns as arrays
+# keyed by their qcrecorder.DIAGNOSTICS_FIELDS names, plus the flight plan step per tick.
+# Jitter is random so isn't modelled, and --dlpf is applied by the MPU6050 itself, so its
+# variants need captures of their own.  The quaternion estimator and the velocity Kalman filter
+# aren't vectorized, so flights using them are rejected.
+#
+############################################################################################
+def Evaluate(capture, params):
+	if params['attitude'] != 'complementary' or params['kalman']:
+		raise ValueError("only the complementary filter and the velocity integral are vectorized")
+
+	times = capture['time']
+	qax, qay, qaz = Compensate(capture, params['coefficients'])
+
+	#-----------------------------------------------------------------------------------
+	# With --calibration, qc.py first checks its saved calibration against a short read
+	# and, if it passes, skips straight to the motion loop.  The same check here makes the
+	# same call, given the calibration file as it was for the flight.
+	#-----------------------------------------------------------------------------------
+	calibration = None
+	calibration_start = 0
+	calibration_problem = 'not saved'
+	if params['calibration'] is not None:
+		calibration_start = qc.CALIBRATION_SAMPLES
+		if len(capture) <= calibration_start:
+			raise ValueError("a flight capture needs more than %d samples, this has %d" % (calibration_start, len(capture)))
+
+		if os.path.isfile(params['calibration']):
+			try:
+				calibration = qc.LoadCalibration(params['calibration'])
+			except (IOError, ValueError):
+				pass
+
+		check = slice(0, calibration_start)
+		calibration_problem = qc.CheckCalibration(calibration, float(times[calibration_start - 1]), int(capture['temp'][calibration_start - 1]),
+			float(capture['gx'][check].sum()) / calibration_start, float(capture['gy'][check].sum()) / calibration_start, float(capture['gz'][check].sum()) / calibration_start,
+			float(qax[check].sum()) * qc.SCALE_ACCEL / calibration_start, float(qay[check].sum()) * qc.SCALE_ACCEL / calibration_start, float(qaz[check].sum()) * qc.SCALE_ACCEL / calibration_start)
+
+	if calibration_problem is None:
+		motion_start = calibration_start
+		gx_offset = calibration['gx_offset']
+		gy_offset = calibration['gy_offset']
+		gz_offset = calibration['gz_offset']
+	else:
+		motion_start = calibration_start + MOTION_START
+
+	if len(capture) <= motion_start:
+		raise ValueError("a flight capture needs more than %d samples, this has %d" % (motion_start, len(capture)))
+
+	#-----------------------------------------------------------------------------------
+	# Gyro calibration, then the gyros minus their offsets as readSensors()
+	#-----------------------------------------------------------------------------------
+	if calibration_problem is not None:
+		gyro = slice(calibration_start, calibration_start + GYRO_CALIBRATION_SAMPLES)
+		gx_offset = float(capture['gx'][gyro].sum()) / GYRO_CALIBRATION_SAMPLES
+		gy_offset = float(capture['gy'][gyro].sum()) / GYRO_CALIBRATION_SAMPLES
+		gz_offset = float(capture['gz'][gyro].sum()) / GYRO_CALIBRATION_SAMPLES
+
+	qgx = capture['gx'] - gx_offset
+	qgy = -(capture['gy'] - gy_offset)
+	qgz = capture['gz'] - gz_offset
+
+	#-----------------------------------------------------------------------------------
+	# The take-off gravity vector and platform slope
+	#-----------------------------------------------------------------------------------
+	if calibration_problem is None:
+		qfrgv_x = calibration['qfrgv_x']
+		qfrgv_y = calibration['qfrgv_y']
+		qfrgv_z = calibration['qfrgv_z']
+	else:
+		gravity = slice(gyro.stop, motion_start)
+		delta_time = numpy.diff(times[gravity])
+		integration_period = times[motion_start - 1] - times[gyro.stop]
+
+		qfrgv_x = numpy.cumsum((qax[gravity][1:] + qax[gravity][:-1]) * delta_time)[-1] * qc.SCALE_ACCEL / (2 * integration_period)
+		qfrgv_y = numpy.cumsum((qay[gravity][1:] + qay[gravity][:-1]) * delta_time)[-1] * qc.SCALE_ACCEL / (2 * integration_period)
+		qfrgv_z = numpy.cumsum((qaz[gravity][1:] + qaz[gravity][:-1]) * delta_time)[-1] * qc.SCALE_ACCEL / (2 * integration_period)
+
+	qfrgv_pitch, qfrgv_roll, qfrgv_tilt = qc.GetEulerAngles(qfrgv_x, qfrgv_y, qfrgv_z)
+	efrgv_x, efrgv_y, efrgv_z = qc.Q2EFrame(qfrgv_x, qfrgv_y, qfrgv_z, qfrgv_pitch, qfrgv_roll, 0.0, qfrgv_tilt)
+
+	#-----------------------------------------------------------------------------------
+	# The motion loop from the sample the PIDs start on: the trapezium integrals run across
+	# every sample, and each tick takes the difference since the last
+	#-----------------------------------------------------------------------------------
+	motion = slice(motion_start, None)
+	times = times[motion]
+	elapsed_time = times - times[0]
+	delta_time = numpy.diff(elapsed_time)
+
+	motion_period = 1 / params['motion_frequency']
+	ticks = MotionTicks(times, motion_period, params['deadline'])
+	previous_ticks = numpy.concatenate(([0], ticks[:-1]))
+
+	tick_times = times[ticks]
+	integration_period = tick_times - times[previous_ticks]
+
+	def TickIntegrals(values, scale):
+		values = values[motion]
+		integrated = numpy.concatenate(([0.0], numpy.cumsum((values[:-1] + values[1:]) * delta_time)))
+		return (integrated[ticks] - integrated[previous_ticks]) * (scale / 2)
+
+	qgx_integrated = TickIntegrals(qgx, qc.SCALE_GYRO)
+	qgy_integrated = TickIntegrals(qgy, qc.SCALE_GYRO)
+	qgz_integrated = TickIntegrals(qgz, qc.SCALE_GYRO)
+
+	tick_qgx = qgx_integrated / integration_period
+	tick_qgy = qgy_integrated / integration_period
+	tick_qgz = qgz_integrated / integration_period
+
+	tick_qax = TickIntegrals(qax, qc.SCALE_ACCEL) / integration_period
+	tick_qay = TickIntegrals(qay, qc.SCALE_ACCEL) / integration_period
+	tick_qaz = TickIntegrals(qaz, qc.SCALE_ACCEL) / integration_period
+
+	#-----------------------------------------------------------------------------------
+	# Angles and the complementary filter
+	#-----------------------------------------------------------------------------------
+	e_pitch, e_roll, e_tilt = GetEulerAngles(tick_qax, tick_qay, tick_qaz)
+
+	i_pitch = RunningSum(qfrgv_pitch, qgy_integrated)
+	i_roll = RunningSum(qfrgv_roll, qgx_integrated)
+	i_yaw = RunningSum(0.0, qgz_integrated)
+
+	tau = params['tau']
+	tau_fraction = tau / (tau + integration_period)
+	c_pitch = LinearRecurrence(tau_fraction, tau_fraction * qgy_integrated + (1 - tau_fraction) * e_pitch, qfrgv_pitch)
+	c_roll = LinearRecurrence(tau_fraction, tau_fraction * qgx_integrated + (1 - tau_fraction) * e_roll, qfrgv_roll)
+
+	pa = c_pitch
+	ra = c_roll
+	ya = i_yaw
+
+	#-----------------------------------------------------------------------------------
+	# Spin up to hover speed, then the flight plan, which stops the loop once complete
+	#-----------------------------------------------------------------------------------
+	hover_target = params['hover_target']
+	hover_step = int(hover_target * motion_period / params['rtf_period'])
+	tick_number = numpy.arange(0, len(ticks))
+	if hover_target <= 0:
+		ready_tick = 0
+	elif hover_step <= 0:
+		ready_tick = len(ticks)
+	else:
+		ready_tick = -(-hover_target // hover_step)
+	hover_speed = numpy.where(tick_number < ready_tick, (tick_number + 1) * hover_step, hover_target)
+
+	fp_total_time = RunningSum(0.0, qc.FlightPlan.fp_time)
+	fp_index = numpy.zeros(len(ticks), dtype=numpy.int64)
+	if ready_tick < len(ticks) - 1:
+		flying = slice(ready_tick + 1, None)
+		fp_index[flying] = numpy.searchsorted(fp_total_time, tick_times[flying] - tick_times[ready_tick], side='right')
+
+		finished = numpy.flatnonzero(fp_index == qc.FlightPlan._FP_STEPS)
+		if len(finished) != 0:
+			last = finished[0] + 1
+			ticks, tick_number, fp_index = ticks[:last], tick_number[:last], fp_index[:last]
+			fp_index[-1] = qc.FlightPlan._FP_STEPS - 1
+
+	flying = tick_number > ready_tick
+	evx_target = numpy.where(flying, numpy.take(qc.FlightPlan.fp_evx_target, fp_index), 0.0)
+	evy_target = numpy.where(flying, numpy.take(qc.FlightPlan.fp_evy_target, fp_index), 0.0)
+	evz_target = numpy.where(flying, numpy.take(qc.FlightPlan.fp_evz_target, fp_index), 0.0)
+
+	#-----------------------------------------------------------------------------------
+	# Cut every per tick column down to the ticks actually flown
+	#-----------------------------------------------------------------------------------
+	last = len(ticks)
+	(tick_times, integration_period, hover_speed, qgx_integrated, qgy_integrated, qgz_integrated, tick_qgx, tick_qgy, tick_qgz, tick_qax, tick_qay, tick_qaz,
+		e_pitch, e_roll, e_tilt, i_pitch, i_roll, i_yaw, c_pitch, c_roll, pa, ra, ya) = [column[:last] for column in
+		(tick_times, integration_period, hover_speed, qgx_integrated, qgy_integrated, qgz_integrated, tick_qgx, tick_qgy, tick_qgz, tick_qax, tick_qay, tick_qaz,
+		e_pitch, e_roll, e_tilt, i_pitch, i_roll, i_yaw, c_pitch, c_roll, pa, ra, ya)]
+
+	#-----------------------------------------------------------------------------------
+	# Targets into the quad frame, gravity removed, and the net velocity integrated
+	#-----------------------------------------------------------------------------------
+	rotations = Rotations(pa, ra, ya)
+	qvx_target, qvy_target, qvz_target = rotations.e2q(evx_target, evy_target, evz_target)
+	tick_qfrgv_x, tick_qfrgv_y, tick_qfrgv_z = rotations.e2q(efrgv_x, efrgv_y, efrgv_z)
+
+	qvx_input = RunningSum(0.0, (tick_qax - tick_qfrgv_x) * integration_period * qc.GRAV_ACCEL)
+	qvy_input = RunningSum(0.0, (tick_qay - tick_qfrgv_y) * integration_period * qc.GRAV_ACCEL)
+	qvz_input = RunningSum(0.0, (tick_qaz - tick_qfrgv_z) * integration_period * qc.GRAV_ACCEL)
+
+	#-----------------------------------------------------------------------------------
+	# The 7 PIDs, with the same gains qc.py derives from the command line
+	#-----------------------------------------------------------------------------------
+	start_time = times[0]
+
+	qvx_p, qvx_i, qvx_d = ComputePID(params['hvp_gain'], params['hvi_gain'], params['hvd_gain'], qvx_input, qvx_target, tick_times, start_time)
+	qvy_p, qvy_i, qvy_d = ComputePID(params['hvp_gain'], params['hvi_gain'], params['hvd_gain'], qvy_input, qvy_target, tick_times, start_time)
+	qvz_p, qvz_i, qvz_d = ComputePID(params['vvp_gain'], params['vvi_gain'], params['vvd_gain'], qvz_input, qvz_target, tick_times, start_time)
+	qvz_out = qvz_p + qvz_i + qvz_d
+
+	pr_target = -(qvx_p + qvx_i + qvx_d)
+	rr_target = -(qvy_p + qvy_i + qvy_d)
+	vert_out = hover_speed + Round(qvz_out)
+
+	ya_p, ya_i, ya_d = ComputePID(6.0, 3.0, 1.0, ya, numpy.zeros(last), tick_times, start_time)
+	yr_target = ya_p + ya_i + ya_d
+
+	pr_p, pr_i, pr_d = ComputePID(params['prp_gain'], params['pri_gain'], params['prd_gain'], tick_qgy, pr_target, tick_times, start_time)
+	rr_p, rr_i, rr_d = ComputePID(params['rrp_gain'], params['rri_gain'], params['rrd_gain'], tick_qgx, rr_target, tick_times, start_time)
+	yr_p, yr_i, yr_d = ComputePID(params['rrp_gain'] / 2.0, params['rri_gain'] / 2.0, params['rrd_gain'] / 2.0, tick_qgz, yr_target, tick_times, start_time)
+
+	pr_out = Round((pr_p + pr_i + pr_d) / 2)
+	rr_out = Round((rr_p + rr_i + rr_d) / 2)
+	yr_out = Round((yr_p + yr_i + yr_d) / 2)
+
+	fl_spin, fr_spin, bl_spin, br_spin = Mix(qc.Mixer(qc.LoadFrame(params['frame'])), vert_out, pr_out, rr_out, yr_out)[:4]
+
+	def Constant(value):
+		return numpy.repeat(value, last)
+
+	columns = [tick_times - start_time, integration_period, ticks, tick_qgx, tick_qgy, tick_qgz, Constant(efrgv_x), Constant(efrgv_y), Constant(efrgv_z),
+		tick_qax, tick_qay, tick_qaz, tick_qfrgv_x, tick_qfrgv_y, tick_qfrgv_z, qvx_input, qvy_input, qvz_input, i_pitch, i_roll, e_pitch, e_roll, c_pitch,
+		c_roll, i_yaw, e_tilt, evx_target, qvx_target, qvx_p, qvx_i, qvx_d, pr_target, pr_p, pr_i, pr_d, pr_out, evy_target, qvy_target, qvy_p, qvy_i,
+		qvy_d, rr_target, rr_p, rr_i, rr_d, rr_out, evz_target, qvz_target, qvz_p, qvz_i, qvz_d, qvz_out, yr_target, yr_p, yr_i, yr_d, yr_out, fl_spin,
+		fr_spin, bl_spin, br_spin]
+
+	results = dict((field[0], column) for field, column in zip(qcrecorder.DIAGNOSTICS_FIELDS, columns))
+	results['fp_index'] = fp_index
+	results['ready_tick'] = ready_tick
+	results['hover_speed'] = hover_speed
+	return results
+
+############################################################################################
+#
+# Compare the results against a diagnostics recording of the scalar path, tick by tick
+#
+############################################################################################
+def Compare(results, diagnostics):
+	ticks = min(len(results['loop']), len(diagnostics))
+	report = []
+	for column, code, csv_format, degrees in qcrecorder.DIAGNOSTICS_FIELDS:
+		expected = diagnostics[column][:ticks].astype(numpy.float64)
+		error = numpy.abs(results[column][:ticks] - expected)
+		if column == 'loop':
+			allowed = numpy.zeros(ticks)
+		elif code == 'i':
+			allowed = numpy.repeat(float(INTEGER_ATOL), ticks)
+		else:
+			allowed = FLOAT_ATOL + FLOAT_RTOL * numpy.abs(expected)
+		max_error = error.max() if ticks != 0 else 0.0
+		report.append((column, max_error, int(numpy.count_nonzero(error > allowed))))
+	return ticks, report
+
+############################################################################################
+#
+# Fly the evaluated flight's controller around a qcsim.Airframe, tick by tick.  The capture
+# the flight was evaluated on is of a quad that didn't move, so what Evaluate() made of it -
+# gyro noise, velocity integration drift, angle and yaw estimate errors - is the sensing error
+# alone; here each tick's PIDs see the airframe's motion with those errors added, and drive
+# the airframe through the mixer and ESC limits until the next tick.  Errors that only motion
+# would cause, such as the angle estimate lagging a turn, aren't in the capture so aren't
+# modelled.  Returns the earth frame velocities flown, the targets, and every motor's pulse
+# width per tick.
+#
+############################################################################################
+def Fly(results, params, substep=0.001):
+	if params['hover_target'] <= 0:
+		raise ValueError("a flight needs a hover target to fly")
+
+	mixer = qc.Mixer(qc.LoadFrame(params['frame']))
+	airframe = qcsim.Airframe(mixer.matrix, params['hover_target'])
+	rotation = qc.Rotation()
+
+	qvx_pid = qc.PID(params['hvp_gain'], params['hvi_gain'], params['hvd_gain'], 0.0)
+	qvy_pid = qc.PID(params['hvp_gain'], params['hvi_gain'], params['hvd_gain'], 0.0)
+	qvz_pid = qc.PID(params['vvp_gain'], params['vvi_gain'], params['vvd_gain'], 0.0)
+	pr_pid = qc.PID(params['prp_gain'], params['pri_gain'], params['prd_gain'], 0.0)
+	rr_pid = qc.PID(params['rrp_gain'], params['rri_gain'], params['rrd_gain'], 0.0)
+	ya_pid = qc.PID(6.0, 3.0, 1.0, 0.0)
+	yr_pid = qc.PID(params['rrp_gain'] / 2.0, params['rri_gain'] / 2.0, params['rrd_gain'] / 2.0, 0.0)
+
+	times = results['time'].tolist()
+	columns = dict((column, results[column].tolist()) for column in ('hover_speed', 'qgx', 'qgy', 'qgz', 'qvx_input', 'qvy_input', 'qvz_input',
+		'c pitch', 'c roll', 'i yaw', 'evx_target', 'evy_yarget', 'evz_target'))
+
+	#-----------------------------------------------------------------------------------
+	# The angle estimate errors are relative to where the estimates started, the slope
+	# of the capture's platform
+	#-----------------------------------------------------------------------------------
+	pitch_offset = columns['c pitch'][0]
+	roll_offset = columns['c roll'][0]
+
+	ticks = len(times)
+	evx = numpy.zeros(ticks)
+	evy = numpy.zeros(ticks)
+	evz = numpy.zeros(ticks)
+	pulse_widths = numpy.zeros((len(mixer.matrix), ticks), dtype=numpy.int64)
+
+	gx_sum = gy_sum = gz_sum = 0.0
+	period = times[0]
+	for tick in range(0, ticks):
+		now = times[tick]
+
+		#---------------------------------------------------------------------------
+		# What the sensors make of the airframe: the gyros averaged over the tick, the
+		# velocities in the quad frame, and the angles the targets are turned by
+		#---------------------------------------------------------------------------
+		qgx = gx_sum / period + columns['qgx'][tick]
+		qgy = gy_sum / period + columns['qgy'][tick]
+		qgz = gz_sum / period + columns['qgz'][tick]
+
+		evx[tick] = airframe.evx
+		evy[tick] = airframe.evy
+		evz[tick] = airframe.evz
+		rotation.setAngles(airframe.pitch, airframe.roll, airframe.yaw)
+		qvx_input, qvy_input, qvz_input = rotation.e2q(airframe.evx, airframe.evy, airframe.evz)
+		qvx_input += columns['qvx_input'][tick]
+		qvy_input += columns['qvy_input'][tick]
+		qvz_input += columns['qvz_input'][tick]
+
+		pa = airframe.pitch + columns['c pitch'][tick] - pitch_offset
+		ra = airframe.roll + columns['c roll'][tick] - roll_offset
+		ya = airframe.yaw + columns['i yaw'][tick]
+		rotation.setAngles(pa, ra, ya)
+		qvx_target, qvy_target, qvz_target = rotation.e2q(columns['evx_target'][tick], columns['evy_yarget'][tick], columns['evz_target'][tick])
+
+		#---------------------------------------------------------------------------
+		# The PIDs and mixer as qc.py's motion loop
+		#---------------------------------------------------------------------------
+		pr_target = -sum(qvx_pid.Compute(qvx_input, qvx_target, now))
+		rr_target = -sum(qvy_pid.Compute(qvy_input, qvy_target, now))
+		vert_out = columns['hover_speed'][tick] + int(round(sum(qvz_pid.Compute(qvz_input, qvz_target, now))))
+
+		yr_target = sum(ya_pid.Compute(ya, 0.0, now))
+
+		pr_out = int(round(sum(pr_pid.Compute(qgy, pr_target, now)) / 2))
+		rr_out = int(round(sum(rr_pid.Compute(qgx, rr_target, now)) / 2))
+		yr_out = int(round(sum(yr_pid.Compute(qgz, yr_target, now)) / 2))
+
+		spin_rates = []
+		for motor, spin in enumerate(mixer.mix(vert_out, pr_out, rr_out, yr_out)):
+			pulse_widths[motor, tick] = min(max(int(MIN_PULSE_WIDTH + spin), MIN_PULSE_WIDTH), MAX_PULSE_WIDTH)
+			spin_rates.append(pulse_widths[motor, tick] - MIN_PULSE_WIDTH)
+
+		#---------------------------------------------------------------------------
+		# Fly to the next tick
+		#---------------------------------------------------------------------------
+		if tick == ticks - 1:
+			break
+
+		period = times[tick + 1] - now
+		steps = max(1, int(math.ceil(period / substep)))
+		gx_sum = gy_sum = gz_sum = 0.0
+		for step in range(0, steps):
+			airframe.step(spin_rates, period / steps)
+			gx_sum += airframe.gx * period / steps
+			gy_sum += airframe.gy * period / steps
+			gz_sum += airframe.gz * period / steps
+
+	return {'ticks': ticks, 'ready_tick': results['ready_tick'], 'fp_index': results['fp_index'],
+		'evx': evx, 'evy': evy, 'evz': evz,
+		'evx_target': results['evx_target'], 'evy_target': results['evy_yarget'], 'evz_target': results['evz_target'],
+		'pulse_widths': pulse_widths}
+
+############################################################################################
+#
+# Figures of merit for comparing variants, all from the flight the gains flew: RMS velocity
+# tracking error, worst overshoot past the target within a flight plan step, and the fraction
+# of ticks with an ESC pinned at a limit
+#
+############################################################################################
+def Metrics(flight):
+	flying = numpy.arange(0, flight['ticks']) > flight['ready_tick']
+	if not numpy.any(flying):
+		return {'ticks': flight['ticks'], 'tracking_rms': 0.0, 'overshoot': 0.0, 'saturation': 0.0}
+
+	errors = [(flight[axis + '_target'] - flight[axis])[flying] for axis in ('evx', 'evy', 'evz')]
+	tracking_rms = math.sqrt(numpy.mean(sum(error * error for error in errors)))
+
+	#-----------------------------------------------------------------------------------
+	# Overshoot is how far the error swings past zero from the sign it had at the start
+	# of each flight plan step
+	#-----------------------------------------------------------------------------------
+	fp_index = flight['fp_index'][flying]
+	steps = numpy.flatnonzero(numpy.diff(numpy.concatenate(([-1], fp_index))))
+	step_sign = numpy.repeat([numpy.sign(error[steps]) for error in errors], numpy.diff(numpy.concatenate((steps, [len(fp_index)]))), axis=1)
+	overshoot = max(0.0, float(numpy.max(-step_sign * numpy.array(errors))))
+
+	pulse_widths = flight['pulse_widths'][:, flying]
+	saturated = numpy.any((pulse_widths <= MIN_PULSE_WIDTH) | (pulse_widths >= MAX_PULSE_WIDTH), axis=0)
+
+	return {'ticks': flight['ticks'],
+		'tracking_rms': tracking_rms,
+		'overshoot': overshoot,
+		'saturation': float(numpy.mean(saturated))}
+
+############################################################################################
+#
+# The flight parameters from the same command line options as qc.py takes.  qc.CheckCLI()
+# logs what's wrong with a bad option and exits; that comes back as a ValueError saying what
+# it logged, so a caller evaluating many option sets can record it and carry on.
+#
+############################################################################################
+class LogRecords(logging.Handler):
+
+	def __init__(self):
+		logging.Handler.__init__(self, logging.CRITICAL)
+		self.messages = []
+
+	def emit(self, record):
+		self.messages.append(record.getMessage())
+
+
+def FlightParameters(argv):
+	if len(qc.logger.handlers) == 0:
+		qc.logger.addHandler(logging.NullHandler())
+
+	log_records = LogRecords()
+	qc.logger.addHandler(log_records)
+	try:
+		options = qc.CheckCLI(['-f'] + argv)
+	except SystemExit:
+		raise ValueError(log_records.messages[0] if len(log_records.messages) != 0 else "invalid options %s" % ' '.join(argv))
+	finally:
+		qc.logger.removeHandler(log_records)
+
+	return {'hover_target': options.hover_target,
+		'vvp_gain': options.vvp_gain, 'vvi_gain': options.vvi_gain, 'vvd_gain': options.vvd_gain,
+		'hvp_gain': options.hvp_gain, 'hvi_gain': options.hvi_gain, 'hvd_gain': options.hvd_gain,
+		'prp_gain': options.prp_gain, 'pri_gain': options.pri_gain, 'prd_gain': options.prd_gain,
+		'rrp_gain': options.rrp_gain, 'rri_gain': options.rri_gain, 'rrd_gain': options.rrd_gain,
+		'tau': options.tau, 'motion_frequency': options.motion_frequency, 'rtf_period': options.rtf_period,
+		'attitude': options.attitude, 'kalman': options.kalman, 'frame': options.frame, 'deadline': options.deadline,
+		'coefficients': options.coefficients_file, 'calibration': options.calibration_file}
+
+
+def ExportCSV(results, csv_file):
+	csv_format = ', '.join(csv_format for column, code, csv_format, degrees in qcrecorder.DIAGNOSTICS_FIELDS) + '\n'
+	csv_file.write(', '.join(column for column, code, csv_format, degrees in qcrecorder.DIAGNOSTICS_FIELDS) + '\n')
+
+	columns = []
+	for field in qcrecorder.DIAGNOSTICS_FIELDS:
+		columns.append(numpy.degrees(results[field[0]]) if field[3] else results[field[0]])
+	for record in zip(*[column.tolist() for column in columns]):
+		csv_file.write(csv_format % record)
+
+############################################################################################
+#
+# Main
+#
+############################################################################################
+def Usage():
+	print('qcoffline.py [-k diagnostics.qcr] [-o output.csv] capture.qcr [qc.py flight options]')
+	print('  -k check the results against a -d recording of qc.py --replay of the same capture')
+	print('  -o write the recomputed diagnostics as CSV')
+	print('  flight options are as qc.py, e.g. --tau 0.5 -m 50 --vvp 300; --dlpf needs its own capture')
+
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'k:o:')
+	except getopt.GetoptError:
+		Usage()
+		sys.exit(2)
+
+	if numpy is None:
+		print('qcoffline.py needs NumPy')
+		sys.exit(1)
+
+	if len(args) == 0:
+		Usage()
+		sys.exit(2)
+
+	check_file = None
+	output_file = None
+	for opt, arg in opts:
+		if opt == '-k':
+			check_file = arg
+		elif opt == '-o':
+			output_file = arg
+
+	params = FlightParameters(args[1:])
+	capture = RecordingArray(args[0], qcrecorder.SENSOR_FIELDS)
+	results = Evaluate(capture, params)
+
+	print("%d samples, %d motion ticks" % (len(capture), len(results['loop'])))
+	try:
+		metrics = Metrics(Fly(results, params))
+		print("flown: tracking rms %f m/s, overshoot %f m/s, saturation %.1f%%" % (metrics['tracking_rms'], metrics['overshoot'], 100 * metrics['saturation']))
+	except ValueError as err:
+		print("not flown: %s" % err)
+
+	if output_file is not None:
+		with open(output_file, 'w') as csv_file:
+			ExportCSV(results, csv_file)
+
+	if check_file is not None:
+		diagnostics = RecordingArray(check_file, qcrecorder.DIAGNOSTICS_FIELDS)
+		ticks, report = Compare(results, diagnostics)
+		failures = 0
+		print("%-12s %14s %8s" % ('column', 'max error', 'outside'))
+		for column, max_error, outside in report:
+			print("%-12s %14g %8d" % (column, max_error, outside))
+			failures += outside
+		print("%d ticks compared, %d values outside tolerance (rtol %g, atol %g, integers %dus)" % (ticks, failures, FLOAT_RTOL, FLOAT_ATOL, INTEGER_ATOL))
+		if failures != 0:
+			sys.exit(1)
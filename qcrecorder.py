@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Flight recorder for the Raspberry Pi Python Quadcopter Flight Controller: fixed layout    ##
+## binary records packed into a preallocated ring buffer in /dev/shm, drained to file by a   ##
+## background thread, and exported back to the diagnostics CSV afterwards.                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+
+############################################################################################
+#
+# The motion processing diagnostics, one record per motion tick: CSV column, struct code, CSV
+# format and whether the value is recorded in radians but exported in degrees.
+#
+############################################################################################
+DIAGNOSTICS_FIELDS = [
+	('time', 'd', '%f', False),
+	('dt', 'd', '%f', False),
+	('loop', 'i', '%d', False),
+	('qgx', 'd', '%f', False),
+	('qgy', 'd', '%f', False),
+	('qgz', 'd', '%f', False),
+	('efrgv_x', 'd', '%f', False),
+	('efrgv_y', 'd', '%f', False),
+	('efrgv_z', 'd', '%f', False),
+	('qax', 'd', '%f', False),
+	('qay', 'd', '%f', False),
+	('qaz', 'd', '%f', False),
+	('qfrgv_x', 'd', '%f', False),
+	('qfrgv_y', 'd', '%f', False),
+	('qfrgv_z', 'd', '%f', False),
+	('qvx_input', 'd', '%f', False),
+	('qvy_input', 'd', '%f', False),
+	('qvz_input', 'd', '%f', False),
+	('i pitch', 'd', '%f', True),
+	('i roll', 'd', '%f', True),
+	('e pitch', 'd', '%f', True),
+	('e roll', 'd', '%f', True),
+	('c pitch', 'd', '%f', True),
+	('c roll', 'd', '%f', True),
+	('i yaw', 'd', '%f', True),
+	('e tilt', 'd', '%f', True),
+	('evx_target', 'd', '%f', False),
+	('qvx_target', 'd', '%f', False),
+	('qxp', 'd', '%f', False),
+	('qxi', 'd', '%f', False),
+	('qxd', 'd', '%f', False),
+	('pr_target', 'd', '%f', True),
+	('prp', 'd', '%f', False),
+	('pri', 'd', '%f', False),
+	('prd', 'd', '%f', False),
+	('pr_out', 'i', '%d', False),
+	('evy_yarget', 'd', '%f', False),
+	('qvy_target', 'd', '%f', False),
+	('qyp', 'd', '%f', False),
+	('qyi', 'd', '%f', False),
+	('qyd', 'd', '%f', False),
+	('rr_target', 'd', '%f', True),
+	('rrp', 'd', '%f', False),
+	('rri', 'd', '%f', False),
+	('rrd', 'd', '%f', False),
+	('rr_out', 'i', '%d', False),
+	('evz_target', 'd', '%f', False),
+	('qvz_target', 'd', '%f', False),
+	('qzp', 'd', '%f', False),
+	('qzi', 'd', '%f', False),
+	('qzd', 'd', '%f', False),
+	('qvz_out', 'd', '%d', False),
+	('yr_target', 'd', '%f', False),
+	('yrp', 'd', '%f', False),
+	('yri', 'd', '%f', False),
+	('yrd', 'd', '%f', False),
+	('yr_out', 'i', '%d', False),
+	('FL spin', 'i', '%d', False),
+	('FR spin', 'i', '%d', False),
+	('BL spin', 'i', '%d', False),
+	('BR spin', 'i', '%d', False),
+]
+
+############################################################################################
+#
+# The raw sensor stream, one record per readSensorsRaw() call: its time stamp and the raw
+# accelerometer, temperature and gyro registers, for replay and offline analysis.
+#
+############################################################################################
+SENSOR_FIELDS = [
+	('time', 'd', '%r', False),
+	('ax', 'h', '%d', False),
+	('ay', 'h', '%d', False),
+	('az', 'h', '%d', False),
+	('temp', 'h', '%d', False),
+	('gx', 'h', '%d', False),
+	('gy', 'h', '%d', False),
+	('gz', 'h', '%d', False),
+]
+
+############################################################################################
+#
+# The latency trace, one record per sensor loop iteration: when each stage finished, or 0 if
+# it didn't run that time round.
+#
+############################################################################################
+TRACE_FIELDS = [
+	('edge', 'd', '%r', False),
+	('i2c', 'd', '%r', False),
+	('decode', 'd', '%r', False),
+	('integrate', 'd', '%r', False),
+	('estimate', 'd', '%r', False),
+	('pids', 'd', '%r', False),
+	('pwm', 'd', '%r', False),
+]
+
+LAYOUTS = [DIAGNOSTICS_FIELDS, SENSOR_FIELDS, TRACE_FIELDS]
+
+#-------------------------------------------------------------------------------------------
+# Both the ring and the drained file start with magic, record size and ring capacity (0 for
+# the drained file).  Every record starts with its sequence number, counting from 1.
+#-------------------------------------------------------------------------------------------
+RECORDER_MAGIC = b'QCR1'
+HEADER_STRUCT = struct.Struct('<4sII')
+
+def RecordStruct(fields):
+	return struct.Struct('<I' + ''.join(code for column, code, csv_format, degrees in fields))
+
+############################################################################################
+#
+# The recorder itself.  record() is the only call made from the motion loop and costs a single
+# struct pack into the mmapped ring; the flusher thread copies whole records out behind it.
+#
+############################################################################################
+class FlightRecorder:
+
+	def __init__(self, fields, file_name, ring_name="/dev/shm/qcrecorder", capacity=4096, flush_period=0.25):
+		self.record_struct = RecordStruct(fields)
+		self.record_size = self.record_struct.size
+		self.capacity = capacity
+		self.flush_period = flush_period
+		self.ring_name = ring_name
+
+		#-----------------------------------------------------------------------------------
+		# Preallocate the ring in shared memory
+		#-----------------------------------------------------------------------------------
+		ring_size = HEADER_STRUCT.size + capacity * self.record_size
+		ring_fd = os.open(ring_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.ftruncate(ring_fd, ring_size)
+			self.ring = mmap.mmap(ring_fd, ring_size)
+		finally:
+			os.close(ring_fd)
+		HEADER_STRUCT.pack_into(self.ring, 0, RECORDER_MAGIC, self.record_size, capacity)
+
+		self.output = open(file_name, 'wb')
+		self.output.write(HEADER_STRUCT.pack(RECORDER_MAGIC, self.record_size, 0))
+
+		self.write_count = 0
+		self.read_count = 0
+		self.overruns = 0
+
+		self.stop_event = threading.Event()
+		self.flusher = threading.Thread(target=self.flushLoop, name='qcrecorder')
+		self.flusher.daemon = True
+
+
+	def start(self):
+		self.flusher.start()
+
+
+	def record(self, *values):
+		#-----------------------------------------------------------------------------------
+		# The count is only moved on once the record is complete, so the flusher never sees
+		# a partial one.
+		#-----------------------------------------------------------------------------------
+		sequence = self.write_count + 1
+		self.record_struct.pack_into(self.ring, HEADER_STRUCT.size + (self.write_count % self.capacity) * self.record_size, sequence, *values)
+		self.write_count = sequence
+
+
+	def flush(self):
+		write_count = self.write_count
+
+		#-----------------------------------------------------------------------------------
+		# If the motion loop has lapped the flusher, the oldest records are gone
+		#-----------------------------------------------------------------------------------
+		if write_count - self.read_count > self.capacity:
+			self.overruns += write_count - self.read_count - self.capacity
+			self.read_count = write_count - self.capacity
+
+		if write_count == self.read_count:
+			return
+
+		start = HEADER_STRUCT.size + (self.read_count % self.capacity) * self.record_size
+		end = HEADER_STRUCT.size + (write_count % self.capacity) * self.record_size
+		if start < end:
+			self.output.write(self.ring[start:end])
+		else:
+			self.output.write(self.ring[start:HEADER_STRUCT.size + self.capacity * self.record_size])
+			self.output.write(self.ring[HEADER_STRUCT.size:end])
+		self.read_count = write_count
+
+
+	def flushLoop(self):
+		while not self.stop_event.wait(self.flush_period):
+			self.flush()
+
+
+	def stop(self):
+		self.stop_event.set()
+		if self.flusher.is_alive():
+			self.flusher.join()
+		self.flush()
+		self.output.close()
+		self.ring.close()
+		os.unlink(self.ring_name)
+
+
+	def getOverruns(self):
+		return self.overruns
+
+############################################################################################
+#
+# Read back a drained file - or a ring left behind in /dev/shm by a crash - in sequence order
+#
+############################################################################################
+def ReadRecords(file_name, fields):
+	record_struct = RecordStruct(fields)
+
+	with open(file_name, 'rb') as record_file:
+		data = record_file.read()
+
+	magic, record_size, capacity = HEADER_STRUCT.unpack_from(data)
+	if magic != RECORDER_MAGIC or record_size != record_struct.size:
+		raise ValueError("%s is not a flight recording with this layout" % file_name)
+
+	records = {}
+	for offset in range(HEADER_STRUCT.size, len(data) - record_size + 1, record_size):
+		record = record_struct.unpack_from(data, offset)
+		if record[0] != 0:
+			records[record[0]] = record[1:]
+
+	for sequence in sorted(records):
+		yield records[sequence]
+
+
+def RecordingFields(file_name):
+	#-----------------------------------------------------------------------------------
+	# The record size identifies which of the known layouts a recording uses
+	#-----------------------------------------------------------------------------------
+	with open(file_name, 'rb') as record_file:
+		magic, record_size, capacity = HEADER_STRUCT.unpack(record_file.read(HEADER_STRUCT.size))
+
+	for fields in LAYOUTS:
+		if magic == RECORDER_MAGIC and RecordStruct(fields).size == record_size:
+			return fields
+	raise ValueError("%s is not a known flight recording" % file_name)
+
+
+def ExportCSV(file_name, csv_file, fields=None):
+	if fields is None:
+		fields = RecordingFields(file_name)
+
+	csv_format = ', '.join(csv_format for column, code, csv_format, degrees in fields) + '\n'
+	degrees_columns = [index for index, field in enumerate(fields) if field[3]]
+
+	csv_file.write(', '.join(column for column, code, csv_format, degrees in fields) + '\n')
+	for record in ReadRecords(file_name, fields):
+		record = list(record)
+		for index in degrees_columns:
+			record[index] = math.degrees(record[index])
+		csv_file.write(csv_format % tuple(record))
+
+############################################################################################
+#
+# Export command: qcrecorder.py recording [output.csv]
+#
+############################################################################################
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if len(args) not in (1, 2):
+		sys.stderr.write('qcrecorder.py recording [output.csv]\n')
+		sys.exit(2)
+
+	if len(args) == 2:
+		with open(args[1], 'w') as csv_file:
+			ExportCSV(args[0], csv_file)
+	else:
+		ExportCSV(args[0], sys.stdout)
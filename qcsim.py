@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Register-level simulator of the MPU6050, GPIO and RPIO DMA PWM used by qc.py, allowing    ##
+## the real flight code to be run and benchmarked on any Linux box.                          ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import errno
+import logging
+import math
+import os
+import random
+import signal
+import struct
+import time
+
+import qcgpio
+import qcrecorder
+
+############################################################################################
+#
+# MPU6050 register addresses and bits the simulator acts upon
+#
+############################################################################################
+MPU6050_RA_SMPLRT_DIV = 0x19
+MPU6050_RA_CONFIG = 0x1A
+MPU6050_RA_FIFO_EN = 0x23
+MPU6050_RA_INT_ENABLE = 0x38
+MPU6050_RA_INT_STATUS = 0x3A
+MPU6050_RA_ACCEL_XOUT_H = 0x3B
+MPU6050_RA_TEMP_OUT_H = 0x41
+MPU6050_RA_GYRO_XOUT_H = 0x43
+MPU6050_RA_USER_CTRL = 0x6A
+MPU6050_RA_PWR_MGMT_1 = 0x6B
+MPU6050_RA_FIFO_COUNTH = 0x72
+MPU6050_RA_FIFO_COUNTL = 0x73
+MPU6050_RA_FIFO_R_W = 0x74
+MPU6050_RA_WHO_AM_I = 0x75
+
+PWR_MGMT_1_DEVICE_RESET = 0x80
+PWR_MGMT_1_SLEEP = 0x40
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+USER_CTRL_SIG_COND_RESET = 0x01
+INT_STATUS_FIFO_OFLOW = 0x10
+INT_STATUS_DATA_RDY = 0x01
+FIFO_EN_TEMP = 0x80
+FIFO_EN_XG = 0x40
+FIFO_EN_YG = 0x20
+FIFO_EN_ZG = 0x10
+FIFO_EN_ACCEL = 0x08
+
+FIFO_SIZE = 1024
+SMBUS_BLOCK_MAX = 32
+
+#-------------------------------------------------------------------------------------------
+# Power on and a device reset take a while on the chip, during which it doesn't acknowledge
+#-------------------------------------------------------------------------------------------
+RESET_DURATION = 0.03
+
+SENSOR_STRUCT = struct.Struct('>7h')
+
+GRAV_ACCEL = 9.80665
+
+############################################################################################
+#
+# A clock that only moves when slept on or set, so simulated time runs as fast as the CPU allows
+#
+############################################################################################
+class VirtualClock:
+
+	def __init__(self, now=0.0):
+		self.now = now
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			self.now += seconds
+
+	def set(self, now):
+		self.now = now
+
+############################################################################################
+#
+# Default sensor source: a level, stationary quad in a slowly warming room, with noise.
+# Returns raw [ax, ay, az, temp, gx, gy, gz] in the +/-2g, +/-250 degrees/s register units.
+#
+############################################################################################
+class StationarySource:
+
+	def __init__(self, seed=0, accel_noise=40.0, gyro_noise=4.0, temperature=25.0, warming=0.5):
+		self.random = random.Random(seed)
+		self.accel_noise = accel_noise
+		self.gyro_noise = gyro_noise
+		self.temperature = temperature
+		self.warming = warming / 60
+
+	def __call__(self, sample_time, sample_count):
+		gauss = self.random.gauss
+		temp = self.temperature + self.warming * sample_count / 1000
+		return [gauss(0.0, self.accel_noise),
+			gauss(0.0, self.accel_noise),
+			16384 + gauss(0.0, self.accel_noise),
+			(temp - 36.53) * 340,
+			gauss(0.0, self.gyro_noise),
+			gauss(0.0, self.gyro_noise),
+			gauss(0.0, self.gyro_noise)]
+
+############################################################################################
+#
+# The MPU6050 register map.  Samples are produced lazily from the clock at the configured
+# sample rate; each one updates the data registers, sets DATA_RDY and is pushed to the FIFO
+# if enabled.
+#
+############################################################################################
+class SimMPU6050:
+
+	def __init__(self, clock, source=None):
+		self.clock = clock
+		self.source = source if source is not None else StationarySource()
+		self.regs = bytearray(128)
+		self.fifo = bytearray()
+		self.sample_count = 0
+		self.sample_time = None
+		self.reset()
+
+
+	def reset(self):
+		self.regs[:] = bytearray(128)
+		self.regs[MPU6050_RA_PWR_MGMT_1] = PWR_MGMT_1_SLEEP
+		self.regs[MPU6050_RA_WHO_AM_I] = 0x68
+		del self.fifo[:]
+		self.next_sample_time = self.clock.time()
+		self.reset_until = self.clock.time() + RESET_DURATION
+
+
+	def resetting(self):
+		if self.clock.time() < self.reset_until:
+			raise IOError(errno.EREMOTEIO, "Remote I/O error")
+
+
+	def samplePeriod(self):
+		#-----------------------------------------------------------------------------------
+		# Gyro output rate is 8kHz with the DLPF disabled, 1kHz otherwise, then divided down
+		#-----------------------------------------------------------------------------------
+		dlpf_cfg = self.regs[MPU6050_RA_CONFIG] & 0x07
+		gyro_rate = 8000 if dlpf_cfg in (0, 7) else 1000
+		return (1 + self.regs[MPU6050_RA_SMPLRT_DIV]) / gyro_rate
+
+
+	def sampling(self):
+		return not (self.regs[MPU6050_RA_PWR_MGMT_1] & PWR_MGMT_1_SLEEP)
+
+
+	def waitSample(self):
+		#-----------------------------------------------------------------------------------
+		# Block until the next sample is produced, so it's there to read on return
+		#-----------------------------------------------------------------------------------
+		self.update()
+		delay = self.next_sample_time - self.clock.time()
+		if delay > 0:
+			self.clock.sleep(delay)
+		self.update()
+
+
+	def update(self):
+		now = self.clock.time()
+		sample_period = self.samplePeriod()
+
+		if not self.sampling():
+			self.next_sample_time = now + sample_period
+			return
+
+		#-----------------------------------------------------------------------------------
+		# With the FIFO off only the latest sample is visible, so skip straight to it
+		#-----------------------------------------------------------------------------------
+		if not (self.regs[MPU6050_RA_USER_CTRL] & USER_CTRL_FIFO_EN) and now - self.next_sample_time > sample_period:
+			skipped = int((now - self.next_sample_time) / sample_period)
+			self.next_sample_time += skipped * sample_period
+			self.sample_count += skipped
+
+		while self.next_sample_time <= now:
+			self.sample(self.next_sample_time)
+			self.next_sample_time += sample_period
+
+
+	def sample(self, sample_time):
+		sensors = [max(-32768, min(32767, int(round(value)))) for value in self.source(sample_time, self.sample_count)]
+		self.sample_count += 1
+		self.sample_time = sample_time
+		SENSOR_STRUCT.pack_into(self.regs, MPU6050_RA_ACCEL_XOUT_H, *sensors)
+		self.regs[MPU6050_RA_INT_STATUS] |= INT_STATUS_DATA_RDY
+
+		if not (self.regs[MPU6050_RA_USER_CTRL] & USER_CTRL_FIFO_EN):
+			return
+
+		#-----------------------------------------------------------------------------------
+		# FIFO frames are written in register order: accel, temp, gyro X, Y, Z
+		#-----------------------------------------------------------------------------------
+		fifo_en = self.regs[MPU6050_RA_FIFO_EN]
+		frame = bytearray()
+		if fifo_en & FIFO_EN_ACCEL:
+			frame += self.regs[MPU6050_RA_ACCEL_XOUT_H:MPU6050_RA_ACCEL_XOUT_H + 6]
+		if fifo_en & FIFO_EN_TEMP:
+			frame += self.regs[MPU6050_RA_TEMP_OUT_H:MPU6050_RA_TEMP_OUT_H + 2]
+		for axis, fifo_en_bit in enumerate((FIFO_EN_XG, FIFO_EN_YG, FIFO_EN_ZG)):
+			if fifo_en & fifo_en_bit:
+				frame += self.regs[MPU6050_RA_GYRO_XOUT_H + 2 * axis:MPU6050_RA_GYRO_XOUT_H + 2 * axis + 2]
+
+		#-----------------------------------------------------------------------------------
+		# A full FIFO overwrites its oldest data
+		#-----------------------------------------------------------------------------------
+		self.fifo += frame
+		if len(self.fifo) > FIFO_SIZE:
+			del self.fifo[:len(self.fifo) - FIFO_SIZE]
+			self.regs[MPU6050_RA_INT_STATUS] |= INT_STATUS_FIFO_OFLOW
+
+
+	def write(self, reg, value):
+		self.resetting()
+		self.update()
+
+		if reg == MPU6050_RA_PWR_MGMT_1 and value & PWR_MGMT_1_DEVICE_RESET:
+			self.reset()
+			return
+
+		if reg == MPU6050_RA_USER_CTRL:
+			if value & USER_CTRL_FIFO_RESET:
+				del self.fifo[:]
+			value &= ~(USER_CTRL_FIFO_RESET | USER_CTRL_SIG_COND_RESET)
+
+		if reg == MPU6050_RA_FIFO_R_W:
+			self.fifo.append(value)
+			return
+
+		if reg in (MPU6050_RA_WHO_AM_I, MPU6050_RA_INT_STATUS, MPU6050_RA_FIFO_COUNTH, MPU6050_RA_FIFO_COUNTL) or MPU6050_RA_ACCEL_XOUT_H <= reg < MPU6050_RA_GYRO_XOUT_H + 6:
+			return
+
+		self.regs[reg] = value
+
+
+	def read(self, reg, length):
+		self.resetting()
+		self.update()
+
+		#-----------------------------------------------------------------------------------
+		# FIFO_R_W doesn't auto-increment; every byte read pops the FIFO.  Reading an empty
+		# FIFO returns the last byte again on the chip - 0 will do here.
+		#-----------------------------------------------------------------------------------
+		if reg == MPU6050_RA_FIFO_R_W:
+			data = list(self.fifo[:length])
+			del self.fifo[:length]
+			return data + [0] * (length - len(data))
+
+		data = []
+		for offset in range(0, length):
+			data.append(self.readReg((reg + offset) & 0x7F))
+		return data
+
+
+	def readReg(self, reg):
+		if reg == MPU6050_RA_FIFO_COUNTH:
+			return len(self.fifo) >> 8
+		if reg == MPU6050_RA_FIFO_COUNTL:
+			return len(self.fifo) & 0xFF
+		if reg == MPU6050_RA_FIFO_R_W:
+			return self.read(reg, 1)[0]
+
+		value = self.regs[reg]
+		if reg == MPU6050_RA_INT_STATUS:
+			self.regs[reg] = 0
+		return value
+
+############################################################################################
+#
+# The I2C bus, presenting the python-smbus API for whatever devices are attached
+#
+############################################################################################
+class SimSMBus:
+
+	def __init__(self):
+		self.devices = {}
+
+
+	def attach(self, address, device):
+		self.devices[address] = device
+
+
+	def device(self, address):
+		if address not in self.devices:
+			raise IOError(errno.EREMOTEIO, "Remote I/O error")
+		return self.devices[address]
+
+
+	def write_byte_data(self, address, reg, value):
+		self.device(address).write(reg, value & 0xFF)
+
+
+	def write_i2c_block_data(self, address, reg, data):
+		device = self.device(address)
+		for offset, value in enumerate(data):
+			device.write(reg if reg == MPU6050_RA_FIFO_R_W else reg + offset, value & 0xFF)
+
+
+	def read_byte_data(self, address, reg):
+		return self.device(address).read(reg, 1)[0]
+
+
+	def read_i2c_block_data(self, address, reg, length=SMBUS_BLOCK_MAX):
+		return self.device(address).read(reg, min(length, SMBUS_BLOCK_MAX))
+
+############################################################################################
+#
+# GPIO, presenting the RPIO API used by qc.py.  The MPU6050 data ready interrupt is a rising
+# edge at each new sample; outputs are recorded as (time, pin, level).
+#
+############################################################################################
+class SimGPIO:
+	BCM = 11
+	OUT = 0
+	IN = 1
+	LOW = 0
+	HIGH = 1
+	RISING = 31
+	PUD_DOWN = 21
+
+	def __init__(self, clock, mpu6050):
+		self.clock = clock
+		self.mpu6050 = mpu6050
+		self.levels = {}
+		self.edge_pins = {}
+		self.outputs = []
+
+
+	def setmode(self, mode):
+		pass
+
+
+	def setup(self, pin, direction, initial=LOW):
+		if direction == self.OUT:
+			self.levels[pin] = initial
+
+
+	def output(self, pin, level):
+		self.levels[pin] = level
+		self.outputs.append((self.clock.time(), pin, level))
+
+
+	def edge_detect_init(self, pin, edge):
+		self.edge_pins[pin] = edge
+
+
+	def edge_detect_term(self, pin):
+		self.edge_pins.pop(pin, None)
+
+
+	def edge_detect_wait(self, pin):
+		self.mpu6050.waitSample()
+
+
+	def cleanup(self):
+		self.levels = {}
+		self.edge_pins = {}
+
+############################################################################################
+#
+# The data ready line as the GPIO character device would deliver it: waiting produces the
+# next sample, whose edge event is then written down the fake line's pipe stamped with the
+# time the sample was taken, and read back through the epoll loop like a kernel event.
+#
+############################################################################################
+class SimEdgeEventLine(qcgpio.FakeEdgeEventLine):
+
+	def __init__(self, mpu6050, offset):
+		qcgpio.FakeEdgeEventLine.__init__(self, offset)
+		self.mpu6050 = mpu6050
+
+
+	def wait(self):
+		self.mpu6050.waitSample()
+		self.trigger(self.mpu6050.sample_time)
+		return qcgpio.FakeEdgeEventLine.wait(self)
+
+############################################################################################
+#
+# RPIO DMA PWM, recording every add_channel_pulse() as (time, channel, gpio, start, width), plus
+# add_channel_pulses() taking a batch of (gpio, start, width) to apply at once
+#
+############################################################################################
+class SimPWM:
+	LOG_LEVEL_DEBUG = 0
+	LOG_LEVEL_ERRORS = 1
+
+	def __init__(self, clock, pulse_file=None):
+		self.clock = clock
+		self.pulse_file = pulse_file
+		self.pulses = []
+		self.widths = {}
+		self.batches = 0
+
+
+	def set_loglevel(self, level):
+		pass
+
+
+	def setup(self, pulse_incr_us=10, delay_hw=0):
+		self.pulse_incr_us = pulse_incr_us
+
+
+	def init_channel(self, channel, subcycle_time_us=20000):
+		self.subcycle_time_us = subcycle_time_us
+
+
+	def add_channel_pulse(self, dma_channel, gpio, start, width):
+		self.pulses.append((self.clock.time(), dma_channel, gpio, start, width))
+		self.widths[gpio] = width
+
+
+	def add_channel_pulses(self, dma_channel, pulses):
+		#-----------------------------------------------------------------------------------
+		# A batch lands at a single instant, so every pulse in it shares one time stamp
+		#-----------------------------------------------------------------------------------
+		pulse_time = self.clock.time()
+		for gpio, start, width in pulses:
+			self.pulses.append((pulse_time, dma_channel, gpio, start, width))
+			self.widths[gpio] = width
+		self.batches += 1
+
+
+	def clear_channel_gpio(self, dma_channel, gpio):
+		self.widths.pop(gpio, None)
+
+
+	def cleanup(self):
+		self.widths = {}
+		if self.pulse_file is not None:
+			with open(self.pulse_file, 'w') as pulse_file:
+				pulse_file.write('time, channel, gpio, start, width\n')
+				for pulse in self.pulses:
+					pulse_file.write('%r, %d, %d, %d, %d\n' % pulse)
+
+############################################################################################
+#
+# The complete simulated Pi: SMBus(1) with the MPU6050 at 0x68, GPIO and PWM sharing a clock.
+# The clock is anything with time() and sleep(), by default the time module itself.
+#
+############################################################################################
+class SimBackend:
+
+	def __init__(self, clock=time, source=None, address=0x68):
+		self.clock = clock
+		self.mpu6050 = SimMPU6050(clock, source)
+		self.bus = SimSMBus()
+		self.bus.attach(address, self.mpu6050)
+		self.gpio = SimGPIO(clock, self.mpu6050)
+		self.pwm = SimPWM(clock)
+
+
+	def SMBus(self, bus_number):
+		return self.bus
+
+
+	def RequestLine(self, offset):
+		return SimEdgeEventLine(self.mpu6050, offset)
+
+
+	def summary(self):
+		return "simulated %d samples" % self.mpu6050.sample_count
+
+############################################################################################
+#
+# Replay of a sensor capture made with qc.py --capture.  Each data ready edge sets the virtual
+# clock to the next captured time stamp and loads that sample into the data registers, so the
+# flight code reads back exactly the time_now and raw sensors it saw in flight.  When the
+# capture runs out, SIGINT stops the flight just as Ctrl-C would.
+#
+############################################################################################
+class ReplayMPU6050(SimMPU6050):
+
+	def __init__(self, clock, records):
+		SimMPU6050.__init__(self, clock)
+		self.records = iter(records)
+		self.sample_time = None
+		self.sensors = None
+		self.finished = False
+
+
+	def update(self):
+		pass
+
+
+	def waitSample(self):
+		try:
+			record = next(self.records)
+			self.sample_time = record[0]
+			self.sensors = record[1:]
+		except StopIteration:
+			if not self.finished:
+				self.finished = True
+				os.kill(os.getpid(), signal.SIGINT)
+			self.sample_time += self.samplePeriod()
+
+		self.clock.set(self.sample_time)
+		self.sample_count += 1
+		SENSOR_STRUCT.pack_into(self.regs, MPU6050_RA_ACCEL_XOUT_H, *self.sensors)
+		self.regs[MPU6050_RA_INT_STATUS] |= INT_STATUS_DATA_RDY
+
+
+class ReplayBackend(SimBackend):
+
+	def __init__(self, capture_file, pulse_file=None, address=0x68):
+		self.capture_file = capture_file
+		self.clock = VirtualClock()
+		self.mpu6050 = ReplayMPU6050(self.clock, qcrecorder.ReadRecords(capture_file, qcrecorder.SENSOR_FIELDS))
+		self.bus = SimSMBus()
+		self.bus.attach(address, self.mpu6050)
+		self.gpio = SimGPIO(self.clock, self.mpu6050)
+		self.pwm = SimPWM(self.clock, pulse_file)
+		self.wall_start = time.time()
+
+
+	def summary(self):
+		wall_time = time.time() - self.wall_start
+		return "replayed %d samples of %s in %.2fs" % (self.mpu6050.sample_count, self.capture_file, wall_time)
+
+############################################################################################
+#
+# A rigid airframe flown by the motor spins, so tuning options can be scored on the motion
+# they cause rather than on the sensors alone.  Each motor's spin follows the spin its ESC is
+# given with a first order lag, and thrust is proportional to spin, the hover spin holding 1g.
+# The frame's mixing matrix stands in for its geometry: each motor turns the body by its
+# pitch, roll and yaw column times its spin, against a little aerodynamic damping.
+#
+# Axes and signs are qc.py's, so the PIDs see the airframe as they would the real one: pitch
+# integrates the negated y gyro and is positive nose up, roll integrates the x gyro and is
+# positive right side down, yaw integrates the z gyro and is positive anticlockwise, and the
+# earth frame is x forward, y left and z up, as qc.Rotation.q2e() turns the thrust.  Until the
+# thrust lifts it, the airframe sits on the ground.
+#
+############################################################################################
+class Airframe:
+
+	def __init__(self, matrix, hover_spin, motor_lag=0.05, tilt_accel=0.06, yaw_accel=0.005, damping=1.0, drag=0.3):
+		self.matrix = matrix
+		self.hover_spin = hover_spin
+		self.motor_lag = motor_lag
+		self.tilt_accel = tilt_accel
+		self.yaw_accel = yaw_accel
+		self.damping = damping
+		self.drag = drag
+
+		self.spins = [0.0] * len(matrix)
+		self.gx = self.gy = self.gz = 0.0
+		self.pitch = self.roll = self.yaw = 0.0
+		self.evx = self.evy = self.evz = 0.0
+		self.height = 0.0
+
+
+	def step(self, spin_rates, dt):
+		#-----------------------------------------------------------------------------------
+		# Motors, then the torques and thrust they give
+		#-----------------------------------------------------------------------------------
+		lag = min(1.0, dt / self.motor_lag)
+		self.spins = [spin + (spin_rate - spin) * lag for spin, spin_rate in zip(self.spins, spin_rates)]
+
+		pitch_torque = sum(pitch * spin for (pitch, roll, yaw), spin in zip(self.matrix, self.spins))
+		roll_torque = sum(roll * spin for (pitch, roll, yaw), spin in zip(self.matrix, self.spins))
+		yaw_torque = sum(yaw * spin for (pitch, roll, yaw), spin in zip(self.matrix, self.spins))
+		thrust = GRAV_ACCEL * sum(self.spins) / (len(self.spins) * self.hover_spin)
+
+		c_pa = math.cos(self.pitch)
+		s_pa = math.sin(self.pitch)
+		c_ra = math.cos(self.roll)
+		s_ra = math.sin(self.roll)
+		c_ya = math.cos(self.yaw)
+		s_ya = math.sin(self.yaw)
+
+		if self.height <= 0.0 and thrust * c_pa * c_ra <= GRAV_ACCEL:
+			self.gx = self.gy = self.gz = 0.0
+			self.evx = self.evy = self.evz = 0.0
+			return
+
+		#-----------------------------------------------------------------------------------
+		# Body rates and angles
+		#-----------------------------------------------------------------------------------
+		self.gy += (self.tilt_accel * pitch_torque - self.damping * self.gy) * dt
+		self.gx += (self.tilt_accel * roll_torque - self.damping * self.gx) * dt
+		self.gz += (self.yaw_accel * yaw_torque - self.damping * self.gz) * dt
+
+		self.pitch += self.gy * dt
+		self.roll += self.gx * dt
+		self.yaw += self.gz * dt
+
+		#-----------------------------------------------------------------------------------
+		# The thrust into the earth frame, less gravity and drag
+		#-----------------------------------------------------------------------------------
+		self.evx += (thrust * (s_ra * s_ya - c_ra * s_pa * c_ya) - self.drag * self.evx) * dt
+		self.evy += (-thrust * (c_ra * s_pa * s_ya + s_ra * c_ya) - self.drag * self.evy) * dt
+		self.evz += (thrust * c_pa * c_ra - GRAV_ACCEL - self.drag * self.evz) * dt
+
+		self.height += self.evz * dt
+		if self.height < 0.0:
+			self.height = 0.0
+			self.evz = 0.0
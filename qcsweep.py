@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## PID gain sweep for the Raspberry Pi Python Quadcopter Flight Controller: evaluate a grid  ##
+## or random sample of qc.py tuning options against recorded or simulated sensor data on     ##
+## every core, fly each around the simulated airframe, and rank them by tracking error,      ##
+## overshoot and motor saturation.  Results are appended to a file as they arrive, so an     ##
+## interrupted sweep carries on where it stopped.                                            ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+from __future__ import print_function
+import getopt
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+
+import qcoffline
+import qcrecorder
+import qcsim
+
+############################################################################################
+#
+# The qc.py options that can be swept, by the name used in -p
+#
+############################################################################################
+PARAMETERS = {
+	'vvp': '--vvp', 'vvi': '--vvi', 'vvd': '--vvd',
+	'hvp': '--hvp', 'hvi': '--hvi', 'hvd': '--hvd',
+	'prp': '--prp', 'pri': '--pri', 'prd': '--prd',
+	'rrp': '--rrp', 'rri': '--rri', 'rrd': '--rrd',
+	'tau': '--tau', 'm': '-m',
+}
+
+#-------------------------------------------------------------------------------------------
+# Lower is better for all three; a point that fails to evaluate ranks last
+#-------------------------------------------------------------------------------------------
+METRICS = ['tracking_rms', 'overshoot', 'saturation']
+
+############################################################################################
+#
+# Sweep points: -p name=low:high[:count] for each parameter, then either every combination of
+# count evenly spaced values, or -n points drawn uniformly from the ranges
+#
+############################################################################################
+def ParseRange(spec):
+	name, values = spec.split('=', 1)
+	if name not in PARAMETERS:
+		raise ValueError("%s is not a sweepable parameter" % name)
+
+	values = values.split(':')
+	low = float(values[0])
+	high = float(values[1]) if len(values) > 1 else low
+	count = int(values[2]) if len(values) > 2 else 1
+	return name, low, high, count
+
+
+def GridPoints(ranges):
+	axes = []
+	for name, low, high, count in ranges:
+		if count == 1:
+			axes.append([(name, low)])
+		else:
+			axes.append([(name, low + (high - low) * index / (count - 1)) for index in range(0, count)])
+	return [dict(combination) for combination in itertools.product(*axes)]
+
+
+def RandomPoints(ranges, count, seed):
+	#-----------------------------------------------------------------------------------
+	# Seeded, so rerunning the same sweep regenerates the same points to resume from
+	#-----------------------------------------------------------------------------------
+	rng = random.Random(seed)
+	return [dict((name, rng.uniform(low, high)) for name, low, high, steps in ranges) for index in range(0, count)]
+
+
+def PointOptions(point):
+	options = []
+	for name in sorted(point):
+		options.append(PARAMETERS[name])
+		if name == 'm':
+			options.append('%d' % int(round(point[name])))
+		else:
+			options.append('%.6g' % point[name])
+	return options
+
+############################################################################################
+#
+# Simulated sensor data: the qcsim stationary source sampled at 1kHz, as a capture array
+#
+############################################################################################
+def SimulatedCapture(seconds, seed):
+	source = qcsim.StationarySource(seed)
+	samples = int(seconds * 1000)
+
+	records = []
+	for sample_count in range(0, samples):
+		sample_time = sample_count * 0.001
+		sensors = [max(-32768, min(32767, int(round(value)))) for value in source(sample_time, sample_count)]
+		records.append(tuple([sample_count + 1, sample_time] + sensors))
+
+	return qcoffline.numpy.array(records, qcoffline.RecordDtype(qcrecorder.SENSOR_FIELDS))
+
+############################################################################################
+#
+# The worker processes each get the sensor data and fixed options once, then evaluate points
+#
+############################################################################################
+worker_capture = None
+worker_options = None
+
+def InitWorker(capture, options):
+	global worker_capture
+	global worker_options
+
+	worker_capture = capture
+	worker_options = options
+
+	#-----------------------------------------------------------------------------------
+	# Ctrl-C is for the parent, which stops the pool itself
+	#-----------------------------------------------------------------------------------
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def EvaluatePoint(point):
+	options = worker_options + PointOptions(point)
+	try:
+		params = qcoffline.FlightParameters(options)
+		metrics = qcoffline.Metrics(qcoffline.Fly(qcoffline.Evaluate(worker_capture, params), params))
+	except (ValueError, ZeroDivisionError, FloatingPointError) as err:
+		metrics = {'error': str(err)}
+	return {'point': point, 'options': options, 'metrics': metrics}
+
+############################################################################################
+#
+# The result file is JSON lines: a header saying what was swept, then one line per point.
+#
+############################################################################################
+def LoadResults(file_name, header):
+	results = []
+	if not os.path.exists(file_name):
+		return results
+
+	with open(file_name) as results_file:
+		lines = [line for line in results_file if line.strip()]
+
+	if len(lines) != 0 and json.loads(lines[0]) != header:
+		raise ValueError("%s holds a sweep of different data or options" % file_name)
+
+	#-----------------------------------------------------------------------------------
+	# A sweep killed mid write leaves a partial last line; that point is simply rerun
+	#-----------------------------------------------------------------------------------
+	for line in lines[1:]:
+		try:
+			results.append(json.loads(line))
+		except ValueError:
+			pass
+	return results
+
+
+def EndsWithNewline(file_name):
+	with open(file_name, 'rb') as results_file:
+		results_file.seek(-1, os.SEEK_END)
+		return results_file.read(1) == b'\n'
+
+
+def RunSweep(capture, header, points, file_name, jobs):
+	results = LoadResults(file_name, header)
+	done = set(tuple(result['options']) for result in results)
+	pending = [point for point in points if tuple(header['options'] + PointOptions(point)) not in done]
+	print("%d points, %d already done, %d to run on %d processes" % (len(points), len(points) - len(pending), len(pending), jobs))
+
+	new_file = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+	with open(file_name, 'a') as results_file:
+		if new_file:
+			results_file.write(json.dumps(header) + '\n')
+		elif not EndsWithNewline(file_name):
+			results_file.write('\n')
+
+		pool = multiprocessing.Pool(jobs, InitWorker, (capture, header['options']))
+		try:
+			for result in pool.imap_unordered(EvaluatePoint, pending, 4):
+				results_file.write(json.dumps(result, sort_keys=True) + '\n')
+				results_file.flush()
+				results.append(result)
+			pool.close()
+		except KeyboardInterrupt:
+			pool.terminate()
+			print("interrupted with %d of %d points done - rerun to continue" % (len(results), len(points)))
+		pool.join()
+
+	return results
+
+############################################################################################
+#
+# Rank each metric separately, then order by the sum of the ranks, best tracking first on a tie
+#
+############################################################################################
+def Rank(results):
+	scored = [result for result in results if 'error' not in result['metrics']]
+	failed = [result for result in results if 'error' in result['metrics']]
+
+	score = dict((id(result), 0) for result in scored)
+	for metric in METRICS:
+		for rank, result in enumerate(sorted(scored, key=lambda result: result['metrics'][metric])):
+			score[id(result)] += rank
+
+	return sorted(scored, key=lambda result: (score[id(result)], result['metrics']['tracking_rms'])) + failed
+
+
+def Report(ranked, top):
+	print("%4s %12s %10s %10s  %s" % ('rank', 'tracking', 'overshoot', 'saturated', 'options'))
+	for rank, result in enumerate(ranked[:top], 1):
+		metrics = result['metrics']
+		if 'error' in metrics:
+			print("%4d %12s %10s %10s  %s (%s)" % (rank, '-', '-', '-', ' '.join(result['options']), metrics['error']))
+		else:
+			print("%4d %12.6f %10.6f %9.1f%%  %s" % (rank, metrics['tracking_rms'], metrics['overshoot'], 100 * metrics['saturation'], ' '.join(result['options'])))
+
+############################################################################################
+#
+# Main
+#
+############################################################################################
+def Usage():
+	print('qcsweep.py -p name=low:high[:count] ... [-n points] [-s seed] [-j jobs] [-o results] [-t top] [-S seconds] [capture.qcr] [qc.py flight options]')
+	print('  -p sweep a parameter (%s) over a range, count values for a grid' % ', '.join(sorted(PARAMETERS)))
+	print('  -n draw this many random points from the ranges instead of a grid')
+	print('  -s seed the random points and simulated sensors')
+	print('  -j number of worker processes, default one per core')
+	print('  -o append results to this file, resuming any points already in it')
+	print('  -t show this many of the best results')
+	print('  -S use this many seconds of simulated sensor data instead of a capture')
+
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 'p:n:s:j:o:t:S:')
+	except getopt.GetoptError:
+		Usage()
+		sys.exit(2)
+
+	if qcoffline.numpy is None:
+		print('qcsweep.py needs NumPy')
+		sys.exit(1)
+
+	ranges = []
+	random_points = 0
+	seed = 0
+	jobs = multiprocessing.cpu_count()
+	file_name = 'qcsweep.json'
+	top = 20
+	sim_seconds = None
+	try:
+		for opt, arg in opts:
+			if opt == '-p':
+				ranges.append(ParseRange(arg))
+			elif opt == '-n':
+				random_points = int(arg)
+			elif opt == '-s':
+				seed = int(arg)
+			elif opt == '-j':
+				jobs = int(arg)
+			elif opt == '-o':
+				file_name = arg
+			elif opt == '-t':
+				top = int(arg)
+			elif opt == '-S':
+				sim_seconds = float(arg)
+	except (ValueError, IndexError) as err:
+		print(err)
+		Usage()
+		sys.exit(2)
+
+	if len(ranges) == 0 or (sim_seconds is None and len(args) == 0):
+		Usage()
+		sys.exit(2)
+
+	#-----------------------------------------------------------------------------------
+	# The sensor data: a capture, or a seeded simulation
+	#-----------------------------------------------------------------------------------
+	if sim_seconds is None:
+		capture = qcoffline.RecordingArray(args[0], qcrecorder.SENSOR_FIELDS)
+		header = {'data': os.path.abspath(args[0]), 'options': args[1:]}
+	else:
+		capture = SimulatedCapture(sim_seconds, seed)
+		header = {'data': 'sim:%g:%d' % (sim_seconds, seed), 'options': args}
+
+	#-----------------------------------------------------------------------------------
+	# Options every point shares are checked once here, rather than failing every point
+	#-----------------------------------------------------------------------------------
+	try:
+		qcoffline.FlightParameters(header['options'])
+	except ValueError as err:
+		print(err)
+		sys.exit(2)
+
+	if random_points != 0:
+		points = RandomPoints(ranges, random_points, seed)
+	else:
+		points = GridPoints(ranges)
+
+	try:
+		results = RunSweep(capture, header, points, file_name, jobs)
+	except ValueError as err:
+		print(err)
+		sys.exit(1)
+
+	Report(Rank(results), top)
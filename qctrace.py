@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Latency trace export for the Raspberry Pi Python Quadcopter Flight Controller: turn a     ##
+## qc.py --trace recording into Chrome trace event JSON, loadable in chrome://tracing or the  ##
+## Perfetto UI, showing each sensor loop iteration and its stages from data ready edge to    ##
+## ESC pulse.                                                                                ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+from __future__ import print_function
+import getopt
+import json
+import sys
+
+import qcrecorder
+
+############################################################################################
+#
+# One complete ("X") event per iteration spanning all its stamped stages, with an event per
+# stage nested inside it.  Times are in microseconds from the first record, and only
+# iterations starting inside the [start, end) window in seconds are written.
+#
+############################################################################################
+def TraceEvents(file_name, start=0.0, end=None):
+	columns = [column for column, code, csv_format, degrees in qcrecorder.TRACE_FIELDS]
+	trace_start = None
+
+	for stamps in qcrecorder.ReadRecords(file_name, qcrecorder.TRACE_FIELDS):
+		stamped = [(column, stamp) for column, stamp in zip(columns, stamps) if stamp != 0.0]
+		if len(stamped) == 0:
+			continue
+
+		if trace_start is None:
+			trace_start = stamped[0][1]
+
+		iteration_start = stamped[0][1] - trace_start
+		if iteration_start < start:
+			continue
+		if end is not None and iteration_start >= end:
+			break
+
+		yield {'name': 'iteration', 'ph': 'X', 'pid': 1, 'tid': 1,
+		       'ts': iteration_start * 1000000, 'dur': (stamped[-1][1] - stamped[0][1]) * 1000000}
+
+		#-----------------------------------------------------------------------------------
+		# A stage only has a duration if the one before it ran in the same iteration
+		#-----------------------------------------------------------------------------------
+		for index in range(1, len(columns)):
+			if stamps[index] != 0.0 and stamps[index - 1] != 0.0:
+				yield {'name': columns[index], 'ph': 'X', 'pid': 1, 'tid': 1,
+				       'ts': (stamps[index - 1] - trace_start) * 1000000, 'dur': (stamps[index] - stamps[index - 1]) * 1000000}
+
+
+def ExportTrace(file_name, json_file, start=0.0, end=None):
+	#-----------------------------------------------------------------------------------
+	# Written an event at a time, so a long flight needn't fit in memory as a list
+	#-----------------------------------------------------------------------------------
+	json_file.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+	separator = ''
+	for event in TraceEvents(file_name, start, end):
+		json_file.write(separator + json.dumps(event, sort_keys=True))
+		separator = ',\n'
+	json_file.write('\n]}\n')
+
+############################################################################################
+#
+# Main
+#
+############################################################################################
+def Usage():
+	print('qctrace.py [-s start] [-e end] trace.qcr [trace.json]')
+	print('  -s skip iterations before this many seconds into the trace')
+	print('  -e stop at this many seconds into the trace')
+
+
+if __name__ == '__main__':
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], 's:e:')
+	except getopt.GetoptError:
+		Usage()
+		sys.exit(2)
+
+	if len(args) not in (1, 2):
+		Usage()
+		sys.exit(2)
+
+	start = 0.0
+	end = None
+	try:
+		for opt, arg in opts:
+			if opt == '-s':
+				start = float(arg)
+			elif opt == '-e':
+				end = float(arg)
+	except ValueError as err:
+		print(err)
+		Usage()
+		sys.exit(2)
+
+	if len(args) == 2:
+		with open(args[1], 'w') as json_file:
+			ExportTrace(args[0], json_file, start, end)
+	else:
+		ExportTrace(args[0], sys.stdout, start, end)
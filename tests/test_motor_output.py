@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Motor output change suppression: only ESCs whose pulse width actually changes are written ##
+## to the DMA table, as one batch where the PWM library takes them, and spins that clip or   ##
+## truncate to the width already applied cost nothing.                                       ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qc
+import qcsim
+
+
+class ChannelPWM:
+
+	def __init__(self):
+		self.pulses = []
+
+	def add_channel_pulse(self, dma_channel, gpio, start, width):
+		self.pulses.append((gpio, width))
+
+
+class MotorOutputTest(unittest.TestCase):
+
+	def setUp(self):
+		self.saved_pwm = qc.PWM
+
+
+	def tearDown(self):
+		qc.PWM = self.saved_pwm
+
+
+	def startMotors(self, pwm):
+		qc.PWM = pwm
+		self.esc_list = [qc.ESC(pin, name) for name, pin, angle, rotation in qc.FRAMES['quadx']]
+		self.pins = [esc.bcm_pin for esc in self.esc_list]
+		return qc.MotorOutput(self.esc_list)
+
+
+	def testBatchedChangesOnly(self):
+		pwm = qcsim.SimPWM(qcsim.VirtualClock())
+		motor_output = self.startMotors(pwm)
+		self.assertTrue(motor_output.batched)
+		del pwm.pulses[:]
+
+		#-----------------------------------------------------------------------------------
+		# From the ESCs' initial 990us, every motor changes; then nothing does
+		#-----------------------------------------------------------------------------------
+		motor_output.update([550, 550, 550, 550])
+		self.assertEqual(pwm.batches, 1)
+		self.assertEqual([pulse[2:] for pulse in pwm.pulses], [(pin, 0, 1550) for pin in self.pins])
+
+		motor_output.update([550, 550, 550, 550])
+		self.assertEqual(pwm.batches, 1)
+		self.assertEqual(len(pwm.pulses), 4)
+
+		motor_output.update([550, 551, 550, 550])
+		self.assertEqual(pwm.batches, 2)
+		self.assertEqual(pwm.pulses[4][2:], (self.pins[1], 0, 1551))
+		self.assertEqual([esc.applied_pulse_width for esc in self.esc_list], [1550, 1551, 1550, 1550])
+
+		self.assertEqual(motor_output.getUpdates(), (5, 7))
+
+
+	def testSameWidthIsNoop(self):
+		#-----------------------------------------------------------------------------------
+		# Spins differing only below a microsecond, or beyond the ESC range, give the same
+		# pulse width and so aren't written again
+		#-----------------------------------------------------------------------------------
+		pwm = qcsim.SimPWM(qcsim.VirtualClock())
+		motor_output = self.startMotors(pwm)
+
+		motor_output.update([550.2, 1000, 0, -20])
+		pulses = len(pwm.pulses)
+		motor_output.update([550.7, 1300, -5, 0.9])
+		self.assertEqual(len(pwm.pulses), pulses)
+		self.assertEqual(pwm.widths, dict(zip(self.pins, [1550, 2000, 1000, 1000])))
+
+
+	def testUnbatchedChangesOnly(self):
+		pwm = ChannelPWM()
+		motor_output = self.startMotors(pwm)
+		self.assertFalse(motor_output.batched)
+
+		motor_output.update([550, 550, 550, 550])
+		del pwm.pulses[:]
+		motor_output.update([560, 550, 540, 550])
+		self.assertEqual(pwm.pulses, [(self.pins[0], 1560), (self.pins[2], 1540)])
+		self.assertEqual(motor_output.getUpdates(), (6, 2))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## MPU6050 FIFO mode against the simulated chip on a virtual clock: batches drained whole    ##
+## and handed out in order with their time stamps a sample period apart, an overflowed FIFO  ##
+## counted, reset and resumed from fresh samples, and failed reads skipped up to the limit.  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import errno
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qc
+import qcsim
+
+
+def CountingSource(sample_time, sample_count):
+	#-----------------------------------------------------------------------------------
+	# A level, still quad whose x accelerometer reads the sample's number instead
+	#-----------------------------------------------------------------------------------
+	return [sample_count % 32768, 0, 16384, 0, 0, 0, 0]
+
+
+class MPU6050FIFOTest(unittest.TestCase):
+
+	def setUp(self):
+		self.saved = (qc.hardware, qc.smbus, qc.RPIO, qc.PWM, qc.time)
+		self.log_handler = logging.NullHandler()
+		qc.logger.addHandler(self.log_handler)
+
+
+	def tearDown(self):
+		qc.hardware, qc.smbus, qc.RPIO, qc.PWM, qc.time = self.saved
+		qc.logger.removeHandler(self.log_handler)
+
+
+	def startMPU6050(self, dlpf=6):
+		self.clock = qcsim.VirtualClock()
+		qc.hardware = qcsim.SimBackend(self.clock, CountingSource)
+		qc.smbus = qc.hardware
+		qc.RPIO = qc.hardware.gpio
+		qc.PWM = qc.hardware.pwm
+		qc.time = self.clock
+		return qc.MPU6050(dlpf=dlpf, fifo=True)
+
+
+	def readSamples(self, mpu6050, count):
+		samples = []
+		for index in range(0, count):
+			sensors = mpu6050.readSensorsRaw()
+			samples.append((sensors[0], qc.time_now))
+		return samples
+
+
+	def assertContiguous(self, samples, sample_period):
+		for (count, time_now), (next_count, next_time) in zip(samples[:-1], samples[1:]):
+			self.assertEqual(next_count, count + 1)
+			self.assertAlmostEqual(next_time - time_now, sample_period, places=9)
+
+
+	def testDrainsBatchInOrder(self):
+		mpu6050 = self.startMPU6050()
+		self.assertEqual(mpu6050.fifo_block_size % 14, 0)
+
+		#-----------------------------------------------------------------------------------
+		# Python stalls for a few samples; they come out of the FIFO in one batch, drained
+		# in several blocks, and the next batch carries straight on from it
+		#-----------------------------------------------------------------------------------
+		self.clock.sleep(0.0055)
+		samples = self.readSamples(mpu6050, 1)
+		self.assertGreater(mpu6050.fifo_frames * 14, mpu6050.fifo_block_size)
+
+		samples += self.readSamples(mpu6050, 20)
+		self.assertContiguous(samples, 0.001)
+		self.assertEqual(mpu6050.fifo_overflows, 0)
+
+
+	def testUnfilteredSamplePeriod(self):
+		mpu6050 = self.startMPU6050(dlpf=0)
+		self.assertAlmostEqual(mpu6050.sample_period, 1 / 8000)
+
+		self.clock.sleep(0.001)
+		self.assertContiguous(self.readSamples(mpu6050, 20), 1 / 8000)
+
+
+	def testOverflowResets(self):
+		mpu6050 = self.startMPU6050()
+		before = self.readSamples(mpu6050, 3)
+
+		#-----------------------------------------------------------------------------------
+		# A stall long enough to fill the FIFO loses frame alignment; everything in it is
+		# dropped, and reading resumes from the first sample after the reset
+		#-----------------------------------------------------------------------------------
+		self.clock.sleep(0.2)
+		after = self.readSamples(mpu6050, 10)
+
+		self.assertEqual(mpu6050.fifo_overflows, 1)
+		self.assertGreater(after[0][0], before[-1][0] + 200)
+		self.assertContiguous(after, 0.001)
+
+
+	def failReads(self, mpu6050, failures):
+		#-----------------------------------------------------------------------------------
+		# Make the next reads fail as an I2C call out of retries does
+		#-----------------------------------------------------------------------------------
+		readListInto = mpu6050.i2c.readListInto
+		self.failures = failures
+		def FailingReadListInto(reg, buffer, offset, length):
+			if self.failures > 0:
+				self.failures -= 1
+				raise qc.I2CError(errno.EREMOTEIO, "Remote I/O error", mpu6050.address, reg, qc.I2C.RETRIES + 1)
+			readListInto(reg, buffer, offset, length)
+		mpu6050.i2c.readListInto = FailingReadListInto
+
+
+	def testFailedSamplesSkipped(self):
+		for fifo in (False, True):
+			mpu6050 = self.startMPU6050()
+			mpu6050.fifo = fifo
+			limit = mpu6050._MPU6050__FAILED_SAMPLES_LIMIT
+			self.failReads(mpu6050, limit)
+			mpu6050.readSensorsRaw()
+			self.assertEqual((mpu6050.misses, mpu6050.failed_samples), (limit, 0))
+
+
+	def testTooManyFailedSamples(self):
+		for fifo in (False, True):
+			mpu6050 = self.startMPU6050()
+			mpu6050.fifo = fifo
+			limit = mpu6050._MPU6050__FAILED_SAMPLES_LIMIT
+			self.failReads(mpu6050, limit + 1)
+			with self.assertRaises(qc.I2CError) as context:
+				mpu6050.readSensorsRaw()
+			self.assertEqual(context.exception.errno, errno.EREMOTEIO)
+			self.assertEqual(mpu6050.misses, limit + 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## GPIO character device edges through the fake line's pipe: events parsed from the kernel  ##
+## struct layout, the newest edge handed out with the ones it replaced counted as missed,    ##
+## sequence number gaps counted too, and lines sharing one epoll loop.                       ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qcgpio
+
+
+class EdgeEventLineTest(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = qcgpio.EventLoop()
+		self.line = qcgpio.FakeEdgeEventLine(17, self.loop)
+
+
+	def tearDown(self):
+		self.line.close()
+		self.loop.close()
+
+
+	def writeEvent(self, timestamp, event_id, line_seqno):
+		os.write(self.line.write_fd, qcgpio.LINE_EVENT_STRUCT.pack(int(round(timestamp * 1000000000)), event_id, 17, line_seqno, line_seqno))
+
+
+	def testEventLayout(self):
+		self.assertEqual(qcgpio.LINE_EVENT_STRUCT.size, 48)
+		self.assertEqual(qcgpio.LINE_REQUEST_STRUCT.size, 592)
+
+
+	def testEachEdge(self):
+		for sample in range(1, 4):
+			self.line.trigger(1000.0 + sample * 0.001)
+			self.assertAlmostEqual(self.line.wait(), 1000.0 + sample * 0.001, places=6)
+		self.assertEqual(self.line.getCounts(), (3, 0))
+
+
+	def testReplacedEdgesMissed(self):
+		for sample in range(1, 4):
+			self.line.trigger(sample * 0.001)
+		self.assertAlmostEqual(self.line.wait(), 0.003)
+		self.assertEqual(self.line.getCounts(), (3, 2))
+
+
+	def testSequenceGapsMissed(self):
+		#-----------------------------------------------------------------------------------
+		# The kernel's buffer overflowed: line_seqno jumps past the events it dropped
+		#-----------------------------------------------------------------------------------
+		self.writeEvent(0.001, qcgpio.GPIO_V2_LINE_EVENT_RISING_EDGE, 1)
+		self.line.wait()
+		self.writeEvent(0.004, qcgpio.GPIO_V2_LINE_EVENT_RISING_EDGE, 4)
+		self.assertAlmostEqual(self.line.wait(), 0.004)
+		self.assertEqual(self.line.getCounts(), (2, 2))
+
+
+	def testFallingEdgesIgnored(self):
+		self.writeEvent(0.001, qcgpio.GPIO_V2_LINE_EVENT_RISING_EDGE, 1)
+		self.writeEvent(0.0015, 2, 2)
+		self.assertAlmostEqual(self.line.wait(), 0.001)
+		self.assertEqual(self.line.getCounts(), (1, 0))
+
+
+	def testMoreThanOneBatch(self):
+		#-----------------------------------------------------------------------------------
+		# More edges than one read takes built up during a stall: wait() still returns the
+		# newest, with all the others missed, and the queue is left empty
+		#-----------------------------------------------------------------------------------
+		edges = 2 * qcgpio.EVENT_BATCH + 4
+		for sample in range(1, edges + 1):
+			self.line.trigger(sample * 0.001)
+
+		self.assertAlmostEqual(self.line.wait(), edges * 0.001)
+		self.assertEqual(self.line.getCounts(), (edges, edges - 1))
+
+		self.line.trigger((edges + 1) * 0.001)
+		self.assertAlmostEqual(self.line.wait(), (edges + 1) * 0.001)
+		self.assertEqual(self.line.getCounts(), (edges + 1, edges - 1))
+
+
+	def testWholeBatch(self):
+		#-----------------------------------------------------------------------------------
+		# Exactly one read's worth: the read after it finds the queue empty
+		#-----------------------------------------------------------------------------------
+		for sample in range(1, qcgpio.EVENT_BATCH + 1):
+			self.line.trigger(sample * 0.001)
+		self.assertAlmostEqual(self.line.wait(), qcgpio.EVENT_BATCH * 0.001)
+		self.assertEqual(self.line.getCounts(), (qcgpio.EVENT_BATCH, qcgpio.EVENT_BATCH - 1))
+
+
+	def testSharedLoop(self):
+		other = qcgpio.FakeEdgeEventLine(27, self.loop)
+		try:
+			other.trigger(0.0005)
+			self.line.trigger(0.001)
+			self.assertAlmostEqual(self.line.wait(), 0.001)
+			self.assertAlmostEqual(other.wait(), 0.0005)
+			self.assertEqual(other.getCounts(), (1, 0))
+		finally:
+			other.close()
+		self.assertEqual(sorted(self.loop.handlers), [self.line.fileno()])
+
+
+	def testClose(self):
+		fd = self.line.fileno()
+		self.line.close()
+		self.assertIsNone(self.line.fd)
+		self.assertNotIn(fd, self.loop.handlers)
+		self.assertRaises(OSError, os.fstat, fd)
+		self.line.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
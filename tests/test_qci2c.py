@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## I2C_RDWR bus through the loopback: the messages each call builds, reads landing in the    ##
+## caller's buffer at its offset, buffer bounds checked before any transfer, and an address  ##
+## with no device failing with ENXIO, as a retried I2CError once through qc.I2C.             ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import errno
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qc
+import qci2c
+
+ADDRESS = 0x68
+
+
+class RegisterDevice:
+
+	def __init__(self):
+		self.regs = bytearray(range(0, 128)) * 2
+		self.reads = []
+		self.writes = []
+
+	def read(self, reg, length):
+		self.reads.append((reg, length))
+		return list(self.regs[reg:reg + length])
+
+	def write(self, reg, value):
+		self.writes.append((reg, value))
+		self.regs[reg] = value
+
+
+class I2CRdwrTest(unittest.TestCase):
+
+	def setUp(self):
+		self.device = RegisterDevice()
+		self.loopback = qci2c.Loopback({ADDRESS: self.device})
+		self.bus = self.loopback.SMBus(1)
+
+		#-----------------------------------------------------------------------------------
+		# Note each transaction's messages as (addr, flags, len) on their way through
+		#-----------------------------------------------------------------------------------
+		self.messages = []
+		ioctl = self.bus.ioctl
+		def RecordingIoctl(fd, request, arg):
+			rdwr = qci2c.i2c_rdwr_ioctl_data.from_address(arg)
+			msgs = (qci2c.i2c_msg * rdwr.nmsgs).from_address(rdwr.msgs)
+			self.messages.append([(msg.addr, msg.flags, msg.len) for msg in msgs])
+			return ioctl(fd, request, arg)
+		self.bus.ioctl = RecordingIoctl
+
+
+	def testReadIntoIsOneRepeatedStart(self):
+		buffer = bytearray(b'\xAA' * 20)
+		self.bus.readinto(ADDRESS, 0x3B, buffer, 4, 14)
+
+		self.assertEqual(self.messages, [[(ADDRESS, 0, 1), (ADDRESS, qci2c.I2C_M_RD, 14)]])
+		self.assertEqual(self.device.reads, [(0x3B, 14)])
+		self.assertEqual(buffer[4:18], self.device.regs[0x3B:0x3B + 14])
+		self.assertEqual(buffer[:4] + buffer[18:], bytearray(b'\xAA' * 6))
+
+
+	def testReadIntoReusesBufferView(self):
+		buffer = bytearray(28)
+		self.bus.readinto(ADDRESS, 0x74, buffer, 0, 14)
+		self.bus.readinto(ADDRESS, 0x74, buffer, 14, 14)
+		self.assertEqual(len(self.bus.views), 1)
+		self.assertEqual(buffer[14:], self.device.regs[0x74:0x74 + 14])
+
+
+	def testSMBusCalls(self):
+		self.bus.write_byte_data(ADDRESS, 0x6B, 0x02)
+		self.bus.write_i2c_block_data(ADDRESS, 0x19, [0, 6, 0, 0])
+		self.assertEqual(self.messages, [[(ADDRESS, 0, 2)], [(ADDRESS, 0, 5)]])
+		self.assertEqual(self.device.writes, [(0x6B, 0x02), (0x19, 0), (0x1A, 6), (0x1B, 0), (0x1C, 0)])
+
+		self.assertEqual(self.bus.read_byte_data(ADDRESS, 0x6B), 0x02)
+		self.assertEqual(self.bus.read_i2c_block_data(ADDRESS, 0x19, 4), [0, 6, 0, 0])
+		self.assertEqual(self.loopback.transactions, 4)
+
+
+	def testBoundsChecked(self):
+		buffer = bytearray(14)
+		for offset, length in ((-1, 2), (0, 0), (0, 15), (10, 5)):
+			self.assertRaises(ValueError, self.bus.readinto, ADDRESS, 0x3B, buffer, offset, length)
+		self.assertRaises(ValueError, self.bus.readinto, ADDRESS, 0x3B, bytearray(qci2c.MESSAGE_MAX + 1), 0, qci2c.MESSAGE_MAX + 1)
+		self.assertRaises(ValueError, self.bus.read_i2c_block_data, ADDRESS, 0x74, qci2c.BLOCK_MAX + 1)
+		self.assertRaises(ValueError, self.bus.write_i2c_block_data, ADDRESS, 0x74, [0] * (qci2c.BLOCK_MAX + 1))
+		self.assertEqual(self.messages, [])
+
+
+	def testNoDevice(self):
+		with self.assertRaises(IOError) as context:
+			self.bus.read_byte_data(ADDRESS + 1, 0x75)
+		self.assertEqual(context.exception.errno, errno.ENXIO)
+
+
+	def testNoDeviceThroughI2C(self):
+		i2c = qc.I2C(ADDRESS + 1, self.bus)
+		self.assertEqual(i2c.block_size, qci2c.BLOCK_MAX)
+
+		with self.assertRaises(qc.I2CError) as context:
+			i2c.readListInto(0x3B, bytearray(14), 0, 14)
+		self.assertEqual(context.exception.errno, errno.ENXIO)
+		self.assertEqual(context.exception.address, ADDRESS + 1)
+		self.assertEqual(i2c.getErrors(), {errno.ENXIO: context.exception.attempts})
+
+
+	def testOtherIoctlRefused(self):
+		with self.assertRaises(IOError) as context:
+			self.loopback.ioctl(None, 0x0703, 0)
+		self.assertEqual(context.exception.errno, errno.ENOTTY)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Sweep scoring: the flight plan flown around the simulated airframe over simulated sensor  ##
+## data, checking the gains being swept change the metrics they're ranked on.                ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qcoffline
+import qcsweep
+
+SIM_SECONDS = 14
+SEED = 0
+
+
+@unittest.skipIf(qcoffline.numpy is None, "needs NumPy")
+class SweepMetricsTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.capture = qcsweep.SimulatedCapture(SIM_SECONDS, SEED)
+
+
+	def flightMetrics(self, options):
+		params = qcoffline.FlightParameters(options)
+		return qcoffline.Metrics(qcoffline.Fly(qcoffline.Evaluate(self.capture, params), params))
+
+
+	def testGainsChangeMetrics(self):
+		for default, options in (([], ['--hvp', '2']), ([], ['--vvp', '50']), ([], ['--prp', '300'])):
+			default_metrics = self.flightMetrics(default)
+			metrics = self.flightMetrics(options)
+			self.assertNotEqual(metrics['tracking_rms'], default_metrics['tracking_rms'], ' '.join(options))
+
+
+	def testFlightTracksPlan(self):
+		#-----------------------------------------------------------------------------------
+		# With the default gains the climb and descent are flown to within a few cm/s
+		#-----------------------------------------------------------------------------------
+		metrics = self.flightMetrics([])
+		self.assertLess(metrics['tracking_rms'], 0.15)
+		self.assertEqual(metrics['saturation'], 0.0)
+
+
+	def testSlackVerticalGainsTrackWorse(self):
+		self.assertGreater(self.flightMetrics(['--vvp', '30', '--vvi', '5'])['tracking_rms'], self.flightMetrics([])['tracking_rms'])
+
+
+	def testBadPointIsRecorded(self):
+		qcsweep.worker_capture = self.capture
+		qcsweep.worker_options = ['--deadline', 'bogus']
+		result = qcsweep.EvaluatePoint({'hvp': 1.0})
+		self.assertIn('deadline', result['metrics']['error'].lower())
+
+
+if __name__ == '__main__':
+	unittest.main()
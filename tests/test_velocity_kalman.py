@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Velocity Kalman filter against the plain accelerometer integral: at rest on the ground    ##
+## while the motors spin up, then a flight whose true vertical velocity either follows the   ##
+## flight plan with a first order lag or is pushed off a zero target by a gust, with the     ##
+## accelerometer reading it with bias and noise.                                             ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+from __future__ import division
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qc
+
+MOTION_PERIOD = 1 / 37
+RESPONSE_TIME = 0.5
+
+#-------------------------------------------------------------------------------------------
+# Per sample noise, averaged over the 1kHz samples in a motion tick; qc.py's motors spin up
+# over a second by default, the filter's only time at rest
+#-------------------------------------------------------------------------------------------
+ACCEL_NOISE = 40 / 16384 / math.sqrt(1000 * MOTION_PERIOD)
+REST_TIME = 1.0
+FLIGHT_PLAN = [(0.0, 1.5), (0.3, 3.0), (0.0, 5.0), (-0.3, 3.0), (0.0, 2.0)]
+HOVER_PLAN = [(0.0, 10.0)]
+
+
+def VelocityErrors(bias, flight_plan=FLIGHT_PLAN, gust=0.0, seed=0):
+	#-----------------------------------------------------------------------------------
+	# RMS error in flight of the Kalman and integral velocity estimates against the true
+	# velocity, and the final true velocity and Kalman estimate.  The gust is a second
+	# long push to that velocity from a second into the flight, which nothing corrects.
+	#-----------------------------------------------------------------------------------
+	rng = random.Random(seed)
+	velocity_kalman = qc.VelocityKalman()
+	velocity = 0.0
+	integral = 0.0
+	kalman = 0.0
+
+	for tick in range(int(REST_TIME / MOTION_PERIOD)):
+		qaz = bias + rng.gauss(0.0, ACCEL_NOISE)
+		integral += qaz * MOTION_PERIOD * qc.GRAV_ACCEL
+		velocity_kalman.update(0.0, 0.0, qaz, MOTION_PERIOD, True)
+
+	kalman_error = 0.0
+	integral_error = 0.0
+	ticks = 0
+	flight_time = 0.0
+	for target, duration in flight_plan:
+		for tick in range(int(duration / MOTION_PERIOD)):
+			if 1.0 <= flight_time < 2.0:
+				accel = gust
+			elif gust != 0.0:
+				accel = 0.0
+			else:
+				accel = (target - velocity) / RESPONSE_TIME
+			velocity += accel * MOTION_PERIOD
+			flight_time += MOTION_PERIOD
+			qaz = accel / qc.GRAV_ACCEL + bias + rng.gauss(0.0, ACCEL_NOISE)
+
+			integral += qaz * MOTION_PERIOD * qc.GRAV_ACCEL
+			kalman = velocity_kalman.update(0.0, 0.0, qaz, MOTION_PERIOD)[2]
+
+			kalman_error += (kalman - velocity) ** 2
+			integral_error += (integral - velocity) ** 2
+			ticks += 1
+
+	return math.sqrt(kalman_error / ticks), math.sqrt(integral_error / ticks), velocity, kalman
+
+
+class VelocityKalmanTest(unittest.TestCase):
+
+	def testBiasedTrackingBeatsIntegral(self):
+		for bias in (0.002, -0.005, 0.01):
+			kalman_error, integral_error, velocity, kalman = VelocityErrors(bias)
+			self.assertLess(kalman_error, integral_error / 2, "bias %g" % bias)
+
+
+	def testUnbiasedTrackingMatchesIntegral(self):
+		#-----------------------------------------------------------------------------------
+		# With no bias to remove the integral is as good as it gets; the bias the filter
+		# learns from a second at rest is itself a little off, but mustn't cost more than
+		# a centimetre or so a second
+		#-----------------------------------------------------------------------------------
+		for seed in range(6):
+			kalman_error, integral_error, velocity, kalman = VelocityErrors(0.0, seed=seed)
+			self.assertLess(kalman_error, integral_error + 0.015, "seed %d" % seed)
+
+
+	def testDriftIsFollowed(self):
+		#-----------------------------------------------------------------------------------
+		# Knocked to 0.5m/s while the target is zero, the estimate must stay with the true
+		# velocity so the PIDs correct it, not decay towards the target
+		#-----------------------------------------------------------------------------------
+		for bias in (0.0, 0.005, -0.01):
+			kalman_error, integral_error, velocity, kalman = VelocityErrors(bias, HOVER_PLAN, gust=0.5)
+			self.assertAlmostEqual(velocity, 0.5, places=6)
+			self.assertLess(abs(kalman - velocity), 0.05, "bias %g" % bias)
+			self.assertLess(kalman_error, 0.05, "bias %g" % bias)
+
+
+if __name__ == '__main__':
+	unittest.main()